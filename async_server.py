@@ -0,0 +1,280 @@
+import asyncio
+import concurrent.futures
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import (
+    FrameSocket, Frame, ProtocolError, HEADER, HEADER_SIZE, MAX_MESSAGE_SIZE,
+)
+from liveness import enable_keepalive
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+class AsyncFrameChannel(FrameSocket):
+    """
+    FrameSocket facade over an asyncio stream pair.
+    The event loop owns the reader and writer; the blocking methods inherited from
+    FrameSocket are called from worker threads and hop onto the loop for every read or write.
+    This lets the command handlers of FileServer run unchanged on the asyncio engine.
+    """
+
+    def __init__(self, reader, writer, loop):
+        super().__init__(sock=None)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.write_lock = asyncio.Lock()  # Keeps a sendfile payload from being split by other frames
+        self.flush_task = None  # Task writing the outbox, the loop is the single writer of pushed messages
+
+    def fileno(self):
+        return self.writer.get_extra_info('socket').fileno()
+
+    def close(self):
+        with self.outbox_cond:
+            self.closed = True
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def wake_writer(self):
+        # Hand the outbox to the loop instead of starting a writer thread
+        try:
+            self.loop.call_soon_threadsafe(self.schedule_flush)
+        except RuntimeError:
+            pass  # Loop already closed, the connection is going away
+
+    def run(self, coroutine):
+        # Run a coroutine on the loop and wait for its result from a worker thread.
+        # A coroutine handed over while the server shuts down may never run, so the wait
+        # gives up once the loop is closed instead of blocking the worker forever.
+        try:
+            future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        except RuntimeError:
+            coroutine.close()
+            raise ConnectionError("Server is shutting down")
+        while True:
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if self.loop.is_closed():
+                    future.cancel()
+                    raise ConnectionError("Server is shutting down")
+            except concurrent.futures.CancelledError:
+                raise ConnectionError("Connection is closed")
+
+    # ---- coroutines, only used on the loop thread ------------------------
+
+    async def write_frame_async(self, header, payload):
+        async with self.write_lock:
+            self.writer.write(header)
+            if payload:
+                self.writer.write(payload)
+            self.bytes_sent += len(header) + len(payload)
+            await self.writer.drain()
+
+    def schedule_flush(self):
+        # Loop thread only: at most one flush task per connection
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = self.loop.create_task(self.flush_outbox_async())
+
+    async def flush_outbox_async(self):
+        # Write the outbox until it stays empty. Between the last take_outbox and the end of
+        # the task nothing else runs on the loop, so a later post always finds the task done.
+        try:
+            while True:
+                frames = self.take_outbox()
+                if not frames or self.writer.is_closing():
+                    return
+                for opcode, payload in frames:
+                    await self.write_frame_async(HEADER.pack(opcode, 0, 0, len(payload)), payload)
+        except (ConnectionError, OSError):
+            with self.outbox_cond:
+                self.closed = True
+
+    async def sendfile_frame_async(self, header, fileobj, offset, length):
+        async with self.write_lock:
+            self.writer.write(header)
+            await self.writer.drain()
+            # Native os.sendfile on the transport socket, plain reads when unsupported
+            sent = await self.loop.sendfile(self.writer.transport, fileobj, offset, length, fallback=True)
+            self.bytes_sent += len(header) + sent
+            return sent
+
+    async def read_header_async(self):
+        try:
+            header = await self.reader.readexactly(HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None  # Clean close between frames
+            raise ConnectionError("Connection closed by peer")
+        self.bytes_received += HEADER_SIZE
+        return HEADER.unpack(header)
+
+    async def read_frame_async(self, max_payload=MAX_MESSAGE_SIZE):
+        header = await self.read_header_async()
+        if header is None:
+            return None
+        opcode, flags, request_id, length = header
+        if length > max_payload:
+            raise ProtocolError(f"Frame too large: {length} bytes")
+        try:
+            payload = await self.reader.readexactly(length) if length else b""
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by peer")
+        self.bytes_received += length
+        return Frame(opcode, flags, request_id, payload)
+
+    # ---- blocking facade for the handlers --------------------------------
+
+    def send_frame(self, opcode, request_id=0, payload=b"", flags=0):
+        header = HEADER.pack(opcode, flags, request_id, len(payload))
+        # The transport may keep a reference to the payload, so never hand it a reusable buffer
+        self.run(self.write_frame_async(header, bytes(payload)))
+
+    def sendfile_frame(self, header, fileobj, offset, length):
+        return self.run(self.sendfile_frame_async(header, fileobj, offset, length))
+
+    def read_frame(self, max_payload=MAX_MESSAGE_SIZE):
+        return self.run(self.read_frame_async(max_payload))
+
+    def recv_header(self):
+        return self.run(self.read_header_async())
+
+    def recv_some(self, view):
+        # StreamReader has no readinto, copy what is buffered into the caller's view
+        data = self.run(self.reader.read(len(view)))
+        view[:len(data)] = data
+        self.bytes_received += len(data)
+        return len(data)
+
+
+class AsyncServerEngine:
+    """
+    Runs the FileServer command set on a single asyncio event loop.
+    Idle connections only cost a coroutine and a small stream buffer. When a frame arrives
+    the matching handler runs in a bounded thread pool, which also absorbs the blocking disk work.
+    Bulk transfers and everything else get separate pools, so listings and small files never
+    wait for a worker behind large uploads and downloads.
+    """
+
+    def __init__(self, server, max_workers=32, backlog=1024, stream_limit=64 * 1024, priority_workers=8):
+        self.server = server  # FileServer that owns the clients, handlers and logging
+        self.max_workers = max_workers  # Upper bound of concurrently running commands
+        self.backlog = backlog  # listen() backlog for bursts of new connections
+        self.stream_limit = stream_limit  # Per-connection read buffer limit
+        self.loop = None
+        self.priority_workers = priority_workers  # Workers kept for commands that are not bulk transfers
+        self.pool = None
+        self.priority_pool = None
+        self.thread = None
+        self.stop_event = None
+        self.start_error = None
+        self.port = None  # Port actually bound, useful when started on port 0
+
+    def start(self, host, port):
+        # Start the event loop in a background thread and wait until the port is bound
+        self.raise_file_limit()
+        self.loop = asyncio.new_event_loop()
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="file-io")
+        self.priority_pool = ThreadPoolExecutor(max_workers=self.priority_workers, thread_name_prefix="file-io-priority")
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, args=(host, port, started), daemon=True)
+        self.thread.start()
+        started.wait()
+        if self.start_error is not None:
+            raise self.start_error
+
+    def stop(self):
+        if self.loop is None:
+            return
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.pool.shutdown(wait=False)
+        self.priority_pool.shutdown(wait=False)
+        self.loop = None
+
+    def raise_file_limit(self):
+        # Each connection is a file descriptor, lift the soft limit as far as allowed
+        if resource is None:
+            return
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            self.server.log_message(f"Could not raise the open file limit: {str(e)}", "WARNING")
+
+    def run_loop(self, host, port, started):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve(host, port, started))
+        except Exception as e:
+            self.start_error = e
+        finally:
+            started.set()
+            self.loop.close()
+
+    async def serve(self, host, port, started):
+        self.stop_event = asyncio.Event()
+        listener = await asyncio.start_server(
+            self.handle_connection, host, port,
+            backlog=self.backlog, limit=self.stream_limit, reuse_address=True
+        )
+        self.port = listener.sockets[0].getsockname()[1]
+        started.set()
+        async with listener:
+            await self.stop_event.wait()
+        # Closing the listener does not touch accepted connections, close them explicitly
+        for task in [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]:
+            task.cancel()
+
+    async def run_blocking(self, function, *args, pool=None):
+        # The queue depth gauge counts calls that are waiting for a free worker
+        queue_depth = self.server.command_queue
+        queue_depth.add(1)
+
+        def call():
+            queue_depth.add(-1)
+            return function(*args)
+        return await self.loop.run_in_executor(pool or self.pool, call)
+
+    async def handle_connection(self, reader, writer):
+        channel = AsyncFrameChannel(reader, writer, self.loop)
+        self.server.byte_counters.open(channel)
+        address = writer.get_extra_info('peername')[:2]
+        enable_keepalive(writer.get_extra_info('socket'))
+        username = None
+        try:
+            # A connection that does not log in within the socket timeout is dropped
+            hello = await asyncio.wait_for(channel.read_frame_async(), self.server.socket_timeout)
+            username = await self.run_blocking(self.server.register_client, channel, hello, address,
+                                               pool=self.priority_pool)
+            if not username:
+                return
+
+            while self.server.is_running:
+                # Frames a handler put aside for later come first, then wait on the socket without a thread
+                if channel.pending:
+                    frame = channel.pending.popleft()
+                else:
+                    frame = await channel.read_frame_async()
+                pool = self.pool if self.server.is_bulk(frame) else self.priority_pool
+                keep_going = await self.run_blocking(self.server.dispatch_frame, channel, username, frame, pool=pool)
+                if not keep_going:
+                    break
+
+        except (ConnectionError, ProtocolError) as e:
+            self.server.log_message(f"Connection error ({username or address[0]}): {str(e)}", "WARNING")
+        except asyncio.TimeoutError:
+            self.server.log_message(f"Handshake timeout ({address[0]}:{address[1]})", "WARNING")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if username:
+                self.server.unregister_client(username, channel)
+            self.server.byte_counters.close(channel)
+            writer.close()
@@ -0,0 +1,273 @@
+"""
+Fair-share bandwidth scheduler for the file content the server sends and receives.
+
+A transfer asks for its bytes frame by frame before it sends them (downloads) or as it reads
+them (uploads). Bytes are paid from two token buckets, the global one and the one of the
+transfer's user. While both have tokens nobody waits. When they run dry, the waiting transfers
+are served by weighted fair queuing (start-time fair queuing): a frame gets the start tag
+max(virtual time, finish tag of the transfer's previous frame) and a finish tag of start plus
+bytes / weight, and the dispatcher grants the smallest start tag whose user still has tokens.
+A transfer's weight is its user's weight split over the user's active transfers, so opening 16
+parallel streams does not buy a larger share than one.
+
+Small transfers go ahead of every bulk frame in the queue, but they pay for their bytes like
+any other transfer and still wait for their user's bucket, so splitting a large upload into
+small files gains nothing. Commands that move no file content do not pass through here at all.
+Frames are paid in pieces of at most one burst, and a bucket's debt is capped at a few bursts.
+
+set_limits() changes rates and weights at any time; waiting transfers get the new rates on the
+next grant. Without any limit, transfers never take the scheduler's lock.
+"""
+import itertools
+import threading
+import time
+
+BURST_SECONDS = 0.1  # A bucket saves at most this many seconds of its rate
+DEBT_BURSTS = 4  # A bucket owes at most this many bursts
+MIN_PIECE = 16 * 1024  # Smallest piece a frame is paid in, however low the rate
+PACED_FRAME_SIZE = 256 * 1024  # Largest sendfile frame while a limit is set, keeps the pacing smooth
+
+
+class TokenBucket:
+    # rate bytes per second, None for unlimited; tokens may go negative (debt)
+    def __init__(self, rate=None):
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+        self.tokens = self.burst  # A new bucket starts full
+
+    def set_rate(self, rate):
+        self.refill(time.monotonic())
+        self.rate = rate or None
+        self.burst = self.rate * BURST_SECONDS if self.rate else 0.0
+        self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now):
+        self.refill(now)
+        return self.rate is None or self.tokens > 0
+
+    def wait_time(self, now):
+        # Seconds until ready() turns True
+        self.refill(now)
+        if self.rate is None or self.tokens > 0:
+            return 0.0
+        return -self.tokens / self.rate + 0.0001
+
+    def full(self, now):
+        self.refill(now)
+        return self.rate is None or self.tokens >= self.burst
+
+    def take(self, count):
+        if self.rate is not None:
+            self.tokens = max(self.tokens - count, -DEBT_BURSTS * self.burst)
+
+
+class Transfer:
+    """
+    One upload or download on one connection. As a context manager it is registered with the
+    scheduler and installed as the connection's throttle, which FrameSocket calls with the
+    byte count of every DATA frame.
+    """
+
+    def __init__(self, scheduler, conn, user, size):
+        self.scheduler = scheduler
+        self.conn = conn
+        self.user = user
+        self.small = size <= scheduler.small_transfer  # Served ahead of the queue
+        self.finish = 0.0  # Finish tag of the last frame, in virtual time
+
+    def __enter__(self):
+        self.scheduler.register(self)
+        self.conn.throttle = self
+        return self
+
+    def __exit__(self, *exc):
+        self.conn.throttle = None
+        self.scheduler.unregister(self)
+        return False
+
+    def __call__(self, count):
+        if self.scheduler.limited:
+            self.scheduler.acquire(self, count)
+
+    def frame_size(self, size):
+        # Payload size for frames the sender may size freely (sendfile)
+        return min(size, PACED_FRAME_SIZE) if self.scheduler.limited else size
+
+
+class BandwidthScheduler:
+    """
+    Token buckets plus one dispatcher thread that hands out the frames of waiting transfers in
+    fair order. Rates are bytes per second, None (or 0) for no limit. Without limits every
+    acquire returns at once, the scheduler only counts.
+    """
+
+    def __init__(self, limit=None, user_limit=None, small_transfer=1024 * 1024):
+        self.cond = threading.Condition()
+        self.small_transfer = small_transfer  # Transfers up to this size never wait in the queue
+        self.user_limit = user_limit or None  # Rate of every user without an override
+        self.user_limits = {}  # username -> rate, overrides user_limit
+        self.weights = {}  # username -> weight, 1 when not set
+        self.bucket = TokenBucket(limit)
+        self.user_buckets = {}  # username -> TokenBucket
+        self.active = {}  # username -> transfers in progress
+        self.waiting = []  # [priority, start tag, order, transfer, bytes, event] of frames waiting for a grant
+        self.order = itertools.count()
+        self.virtual_time = 0.0  # Start tag of the last frame granted
+        self.wait_seconds = 0.0  # Time transfers spent waiting for a grant, summed
+        self.limited = self.bucket.rate is not None or self.user_limit is not None  # Any limit set at all
+        self.running = False
+        self.thread = None
+
+    @property
+    def limit(self):
+        return self.bucket.rate
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name="bandwidth", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Let every waiting transfer go, they are about to be closed anyway
+        with self.cond:
+            self.running = False
+            for entry in self.waiting:
+                entry[5].set()
+            self.waiting = []
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def set_limits(self, limit, user_limit, user_limits=None, weights=None):
+        # Replace the global and per-user rates; user_limits and weights replace the overrides
+        # when given
+        with self.cond:
+            self.bucket.set_rate(limit)
+            self.user_limit = user_limit or None
+            if user_limits is not None:
+                self.user_limits = dict(user_limits)
+            if weights is not None:
+                self.weights = dict(weights)
+            self.limited = self.bucket.rate is not None or self.user_limit is not None or bool(self.user_limits)
+            self.prune_locked(time.monotonic())
+            for user, bucket in self.user_buckets.items():
+                bucket.set_rate(self.user_limits.get(user, self.user_limit))
+            self.cond.notify()
+
+    def transfer(self, conn, user, size):
+        return Transfer(self, conn, user, size)
+
+    def register(self, transfer):
+        with self.cond:
+            self.active[transfer.user] = self.active.get(transfer.user, 0) + 1
+            if transfer.user not in self.user_buckets:
+                self.user_buckets[transfer.user] = TokenBucket(self.user_limits.get(transfer.user, self.user_limit))
+            # A new transfer starts at the current virtual time, it gets no credit for the past
+            transfer.finish = self.virtual_time
+
+    def unregister(self, transfer):
+        with self.cond:
+            count = self.active.get(transfer.user, 0) - 1
+            if count > 0:
+                self.active[transfer.user] = count
+            else:
+                self.active.pop(transfer.user, None)
+                self.prune_locked(time.monotonic())
+
+    def prune_locked(self, now):
+        # Forget the buckets of users without transfers once they are full again. A bucket in
+        # debt is kept, or a user could shed its debt by starting a new transfer.
+        idle = [user for user, bucket in self.user_buckets.items()
+                if user not in self.active and bucket.full(now)]
+        for user in idle:
+            del self.user_buckets[user]
+
+    def acquire(self, transfer, count):
+        # Block until count bytes of transfer may move, paid in pieces of at most one burst
+        while count > 0:
+            piece = min(count, self.piece_size(transfer.user))
+            self.acquire_piece(transfer, piece)
+            count -= piece
+
+    def piece_size(self, user):
+        bursts = [bucket.burst for bucket in (self.bucket, self.user_buckets[user]) if bucket.rate is not None]
+        return max(MIN_PIECE, int(min(bursts))) if bursts else float("inf")
+
+    def acquire_piece(self, transfer, count):
+        with self.cond:
+            user_bucket = self.user_buckets[transfer.user]
+            if not self.running:
+                self.bucket.take(count)
+                user_bucket.take(count)
+                return
+            if transfer.small:
+                # Ahead of every bulk frame; only other small frames may be in front of it
+                priority, start = 0, self.virtual_time
+                first = not any(entry[0] == 0 for entry in self.waiting)
+            else:
+                priority, start = 1, max(self.virtual_time, transfer.finish)
+                weight = self.weights.get(transfer.user, 1) / self.active.get(transfer.user, 1)
+                transfer.finish = start + count / weight
+                first = not self.waiting
+            now = time.monotonic()
+            if first and self.bucket.ready(now) and user_bucket.ready(now):
+                self.grant_locked(start, transfer, count)
+                return
+            event = threading.Event()
+            self.waiting.append([priority, start, next(self.order), transfer, count, event])
+            self.cond.notify()
+        started = time.monotonic()
+        event.wait()
+        waited = time.monotonic() - started
+        with self.cond:
+            self.wait_seconds += waited
+
+    def grant_locked(self, start, transfer, count):
+        self.virtual_time = max(self.virtual_time, start)
+        self.bucket.take(count)
+        self.user_buckets[transfer.user].take(count)
+
+    def run(self):
+        # Dispatcher: grant what the buckets allow, then sleep until one refills or a frame arrives
+        with self.cond:
+            while self.running:
+                self.cond.wait(self.dispatch_locked())
+
+    def dispatch_locked(self):
+        # Grant waiting frames small transfers first, then in start tag order, skipping users
+        # whose bucket is empty. Returns the seconds until the next grant is possible, None
+        # when nothing waits.
+        while self.waiting:
+            now = time.monotonic()
+            ready = [entry for entry in self.waiting if self.user_buckets[entry[3].user].ready(now)]
+            if not ready:
+                return min(self.user_buckets[entry[3].user].wait_time(now) for entry in self.waiting)
+            if not self.bucket.ready(now):
+                return self.bucket.wait_time(now)
+            entry = min(ready)
+            self.waiting.remove(entry)
+            _, start, _, transfer, count, event = entry
+            self.grant_locked(start, transfer, count)
+            event.set()
+        return None
+
+    def stats(self):
+        with self.cond:
+            return {
+                "limit": self.bucket.rate,
+                "user_limit": self.user_limit,
+                "transfers": sum(self.active.values()),
+                "waiting": len(self.waiting),
+                "wait_seconds": self.wait_seconds,
+            }
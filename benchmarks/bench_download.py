@@ -0,0 +1,105 @@
+"""
+Download path benchmark: CPU time the sending side spends per GB.
+
+Compares the old loop (read 64 KiB into Python bytes, sendall each piece) with the
+sendfile path used by handle_download. A local TCP connection is drained by a reader
+thread; only the CPU time of the sending thread is measured.
+
+    python benchmarks/bench_download.py --size-mb 512 --rounds 3
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import FrameSocket  # noqa: E402
+
+
+def drain(sock, total):
+    # Read and discard everything the sender writes
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    while True:
+        count = sock.recv_into(buffer)
+        if not count:
+            break
+        received += count
+    total.append(received)
+
+
+def run_once(mode, filepath, filesize):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    receiver = socket.create_connection(listener.getsockname())
+    sender, _ = listener.accept()
+    listener.close()
+
+    received = []
+    reader = threading.Thread(target=drain, args=(receiver, received))
+    reader.start()
+
+    conn = FrameSocket(sender)
+    with open(filepath, 'rb') as f:
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        if mode == "read+sendall":
+            conn.send_stream(1, f, filesize, chunk_size=65536)
+        else:
+            conn.send_file(1, f, 0, filesize)
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+
+    sender.shutdown(socket.SHUT_WR)
+    reader.join()
+    sender.close()
+    receiver.close()
+    return cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512, help="Size of the test file in MiB")
+    parser.add_argument("--rounds", type=int, default=3, help="Repetitions per mode, the best one is reported")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    filesize = args.size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            tmp.write(block)
+        filepath = tmp.name
+
+    results = {}
+    try:
+        # Warm the page cache so both modes read from memory
+        with open(filepath, 'rb') as f:
+            while f.read(8 * 1024 * 1024):
+                pass
+
+        for mode in ("read+sendall", "sendfile"):
+            runs = [run_once(mode, filepath, filesize) for _ in range(args.rounds)]
+            cpu, wall = min(runs)
+            gigabytes = filesize / (1024 ** 3)
+            results[mode] = {
+                "cpu_seconds_per_gb": cpu / gigabytes,
+                "throughput_mb_s": filesize / wall / (1024 ** 2),
+            }
+            print(f"{mode:>13}: {cpu / gigabytes:6.3f} CPU s/GB, {filesize / wall / (1024 ** 2):8.1f} MiB/s")
+    finally:
+        os.remove(filepath)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"size_mb": args.size_mb, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
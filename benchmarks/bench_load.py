@@ -0,0 +1,505 @@
+"""
+Load generator: N concurrent clients driving a headless server with a mix of commands.
+
+The server runs as its own process (`server.py --headless`) so its CPU time and memory can be
+measured apart from the clients. Every client logs in, uploads --files seed files and then
+loops for --seconds picking LIST, UPLOAD, DOWNLOAD, UPDATE or DELETE by the weights of --mix,
+with sizes drawn from --sizes. Downloads read the seed files of all clients (so owners get
+notifications), updates and deletes only touch the client's own files and a delete only
+removes a file the client uploaded during the run. The first --warmup seconds are not counted.
+
+Reported per command: operations per second, MiB/s of file content, p50/p95/p99 latency;
+for the server: CPU seconds and share of one core, and resident memory. With --json the
+results are written to a file, together with the metrics the server reports through STATS
+after the run (these include the seeding). --baseline compares the results with an earlier
+file and exits with status 1 when a command lost more than --tolerance of its throughput or
+p95 latency.
+
+    python benchmarks/bench_load.py --clients 16 --seconds 20 --mix list=1,upload=2,download=6,update=1,delete=1 \\
+        --sizes 4k 64k 1m --engine asyncio --json load.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client_channel import ClientChannel  # noqa: E402
+from compression import get_codec  # noqa: E402
+from protocol import (  # noqa: E402
+    OP_HELLO, OP_OK, OP_LIST, OP_UPLOAD, OP_DOWNLOAD, OP_UPDATE, OP_DELETE, OP_READY, OP_STATS,
+)
+from server import ENGINES, STORAGE_MODES  # noqa: E402
+
+try:
+    import psutil  # Optional, /proc is read on Linux without it
+except ImportError:
+    psutil = None
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+COMMANDS = ("list", "upload", "download", "update", "delete")
+UNITS = {"": 1, "b": 1, "k": 1024, "kb": 1024, "m": 1024 ** 2, "mb": 1024 ** 2, "g": 1024 ** 3, "gb": 1024 ** 3}
+
+
+def parse_size(text):
+    # "512", "64k", "1m" -> bytes
+    text = text.strip().lower()
+    digits = text.rstrip("bkmg")
+    return int(float(digits) * UNITS[text[len(digits):]])
+
+
+def parse_mix(text):
+    # "list=1,download=6" -> {"list": 1.0, "download": 6.0}
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip().lower()
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"Unknown command in mix: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("The mix needs at least one command with a weight above 0")
+    return mix
+
+
+def percentile(ordered, share):
+    # Nearest-rank percentile of a sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(share * len(ordered))) - 1))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Discard:
+    # Event queue and download target that keep nothing
+    def put(self, item):
+        pass
+
+    def write(self, data):
+        return len(data)
+
+
+class ServerProcess:
+    """
+    `server.py --headless` in a scratch folder, with its CPU time and resident memory.
+    Memory is sampled in the background so the peak of the run is known.
+    """
+
+    def __init__(self, workdir, engine, storage, extra_args):
+        self.port = free_port()
+        command = [sys.executable, SERVER_SCRIPT, "--headless", "--port", str(self.port),
+                   "--storage-dir", os.path.join(workdir, "store"), "--engine", engine,
+                   "--storage", storage] + extra_args
+        # The server log file goes into the scratch folder
+        self.process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.handle = psutil.Process(self.process.pid) if psutil is not None else None
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.wait_until_listening()
+        threading.Thread(target=self.sample_loop, daemon=True).start()
+
+    def wait_until_listening(self, timeout=15):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with status {self.process.returncode}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Server did not start listening")
+                time.sleep(0.05)
+
+    def cpu_seconds(self):
+        # User plus system time of the server so far, None where it cannot be read
+        if self.handle is not None:
+            times = self.handle.cpu_times()
+            return times.user + times.system
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # Fields 14 and 15 of stat (utime, stime), counted from the state field after the name
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss(self):
+        if self.handle is not None:
+            return self.handle.memory_info().rss
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def sample_loop(self):
+        while not self.stopped.wait(0.25):
+            try:
+                rss = self.rss()
+            except Exception:
+                return
+            if rss:
+                self.peak_rss = max(self.peak_rss, rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.process.send_signal(signal.SIGTERM if hasattr(signal, "SIGTERM") else signal.CTRL_BREAK_EVENT)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Recorder:
+    # Latencies and content bytes per command, only while the measurement window is open
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counting = False
+        self.latencies = {name: [] for name in COMMANDS}
+        self.bytes = dict.fromkeys(COMMANDS, 0)
+        self.errors = dict.fromkeys(COMMANDS, 0)
+
+    def add(self, command, seconds, size=0, failed=False):
+        if not self.counting:
+            return
+        with self.lock:
+            if failed:
+                self.errors[command] += 1
+            else:
+                self.latencies[command].append(seconds)
+                self.bytes[command] += size
+
+
+class LoadClient:
+    """
+    One simulated user on its own connection. A ClientChannel receives the frames, so
+    replies are routed by request id and PINGs from the server are answered.
+    """
+
+    def __init__(self, port, username, contents, rng, compression):
+        self.username = username
+        self.contents = contents  # size -> bytes, shared by all clients
+        self.rng = rng
+        self.request_id = 0
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn = ClientChannel(sock, Discard())
+        self.conn.start()
+        self.conn.open_request(0)
+        self.conn.send_message(OP_HELLO, 0, username=username, compression=compression)
+        reply = self.conn.recv_reply(0)
+        self.conn.close_request(0)
+        if reply.opcode != OP_OK:
+            raise RuntimeError(f"Login refused for {username}: {reply.fields().get('message')}")
+        self.conn.codec = get_codec(reply.fields().get("compression"))
+        self.seeds = []  # Server names of the seed files, never deleted
+        self.uploaded = []  # Server names of files uploaded during the run
+        self.serial = 0
+
+    def request(self, opcode, **fields):
+        self.request_id += 1
+        self.conn.open_request(self.request_id)
+        self.conn.send_message(opcode, self.request_id, **fields)
+        return self.request_id
+
+    def reply(self, request_id):
+        frame = self.conn.recv_reply(request_id)
+        if frame.opcode != OP_OK:
+            raise RuntimeError(frame.fields().get("message", frame.name))
+        return frame.fields()
+
+    def finish(self, request_id):
+        self.conn.close_request(request_id)
+
+    def send_content(self, opcode, filename, size):
+        request_id = self.request(opcode, filename=filename, filesize=size)
+        try:
+            self.conn.send_stream(request_id, io.BytesIO(self.contents[size]), size)
+            self.reply(request_id)
+        finally:
+            self.finish(request_id)
+
+    def upload(self, sizes):
+        self.serial += 1
+        size = self.rng.choice(sizes)
+        filename = f"load{self.serial}.bin"
+        self.send_content(OP_UPLOAD, filename, size)
+        return f"{self.username}_{filename}", size
+
+    def run_list(self):
+        request_id = self.request(OP_LIST, limit=1000)
+        try:
+            return 0, len(self.reply(request_id).get("entries", []))
+        finally:
+            self.finish(request_id)
+
+    def run_download(self, filename):
+        request_id = self.request(OP_DOWNLOAD, filename=filename)
+        try:
+            size = self.reply(request_id)["filesize"]
+            self.conn.send_frame(OP_READY, request_id)
+            self.conn.receive_stream(request_id, Discard(), size)
+            return size
+        finally:
+            self.finish(request_id)
+
+    def run_update(self, sizes):
+        filename = self.rng.choice(self.seeds + self.uploaded)
+        size = self.rng.choice(sizes)
+        self.send_content(OP_UPDATE, filename, size)
+        return size
+
+    def run_delete(self):
+        filename = self.uploaded.pop(self.rng.randrange(len(self.uploaded)))
+        request_id = self.request(OP_DELETE, filename=filename)
+        try:
+            self.reply(request_id)
+        finally:
+            self.finish(request_id)
+
+    def stats(self):
+        # The server's own metrics (STATS), kept next to the client-side numbers
+        request_id = self.request(OP_STATS)
+        try:
+            return self.reply(request_id).get("metrics")
+        finally:
+            self.finish(request_id)
+
+    def step(self, command, sizes, shared):
+        # Run one command, returns the bytes of file content it moved
+        if command == "list":
+            self.run_list()
+            return 0
+        if command == "download":
+            return self.run_download(self.rng.choice(shared))
+        if command == "update":
+            return self.run_update(sizes)
+        if command == "delete":
+            self.run_delete()
+            return 0
+        filename, size = self.upload(sizes)
+        self.uploaded.append(filename)
+        return size
+
+    def close(self):
+        self.conn.close()
+
+
+def client_loop(client, mix, sizes, shared, stop, recorder):
+    commands = list(mix)
+    weights = [mix[name] for name in commands]
+    while not stop.is_set():
+        command = client.rng.choices(commands, weights)[0]
+        if command == "delete" and not client.uploaded:
+            command = "upload"  # Nothing of its own to delete yet
+        start = time.perf_counter()
+        try:
+            size = client.step(command, sizes, shared)
+        except (ConnectionError, OSError):
+            recorder.add(command, 0, failed=True)
+            raise
+        except Exception:
+            recorder.add(command, 0, failed=True)
+            continue
+        recorder.add(command, time.perf_counter() - start, size)
+
+
+def summarize(recorder, seconds):
+    results = {}
+    for command in COMMANDS:
+        latencies = sorted(recorder.latencies[command])
+        if not latencies and not recorder.errors[command]:
+            continue
+        results[command] = {
+            "count": len(latencies),
+            "errors": recorder.errors[command],
+            "ops_per_s": len(latencies) / seconds,
+            "mib_per_s": recorder.bytes[command] / seconds / 1024 ** 2,
+            "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else None,
+            "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+            "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "max_ms": latencies[-1] * 1000 if latencies else None,
+        }
+    return results
+
+
+def run(args):
+    workdir = tempfile.mkdtemp()
+    server = ServerProcess(workdir, args.engine, args.storage, shlex.split(args.server_args))
+    clients = []
+    try:
+        sizes = args.sizes
+        contents = {size: os.urandom(size) for size in set(sizes)}
+        compression = [name for name in args.compression.split(",") if name and name != "none"]
+        for i in range(args.clients):
+            clients.append(LoadClient(server.port, f"load{i}", contents, random.Random(args.seed + i),
+                                      compression))
+        # Seed files every client may download; they are never deleted
+        shared = []
+        for client in clients:
+            for _ in range(args.files):
+                filename, _ = client.upload(sizes)
+                client.seeds.append(filename)
+                shared.append(filename)
+
+        recorder = Recorder()
+        stop = threading.Event()
+        errors = []
+
+        def guarded(client):
+            try:
+                client_loop(client, args.mix, sizes, shared, stop, recorder)
+            except Exception as e:
+                errors.append(f"{client.username}: {e}")
+
+        threads = [threading.Thread(target=guarded, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        cpu_start = server.cpu_seconds()
+        recorder.counting = True
+        start = time.perf_counter()
+        time.sleep(args.seconds)
+        recorder.counting = False
+        elapsed = time.perf_counter() - start
+        cpu_end = server.cpu_seconds()
+        rss = server.rss()
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+        try:
+            server_metrics = clients[0].stats()
+        except Exception:
+            server_metrics = None  # A server without STATS, or the client lost its connection
+        return {
+            "commands": summarize(recorder, elapsed),
+            "total_ops_per_s": sum(len(values) for values in recorder.latencies.values()) / elapsed,
+            "server": {
+                "cpu_seconds": cpu,
+                "cpu_percent": cpu / elapsed * 100 if cpu is not None else None,
+                "rss_bytes": rss,
+                "peak_rss_bytes": server.peak_rss or None,
+                "metrics": server_metrics,
+            },
+            "client_errors": errors,
+        }
+    finally:
+        for client in clients:
+            client.close()
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    # Commit of the tree being measured, so result files can be told apart
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SERVER_SCRIPT),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # Commands that got slower than the baseline by more than tolerance, as readable lines
+    regressions = []
+    for command, old in baseline.get("commands", {}).items():
+        new = results["commands"].get(command)
+        if new is None or not old.get("count"):
+            continue
+        if new["ops_per_s"] < old["ops_per_s"] * (1 - tolerance):
+            regressions.append(f"{command}: {new['ops_per_s']:.1f} ops/s, was {old['ops_per_s']:.1f}")
+        if old.get("p95_ms") and new.get("p95_ms") and new["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{command}: p95 {new['p95_ms']:.2f} ms, was {old['p95_ms']:.2f}")
+    return regressions
+
+
+def format_ms(value):
+    return f"{value:9.2f}" if value is not None else f"{'-':>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent simulated clients")
+    parser.add_argument("--seconds", type=float, default=10, help="Length of the measurement")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds of load before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("list=1,upload=2,download=6,update=1,delete=1"),
+                        help="Relative weights of the commands, e.g. list=1,download=6")
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[4096, 65536, 1024 ** 2],
+                        help="File sizes to pick from, e.g. 4k 64k 1m")
+    parser.add_argument("--files", type=int, default=4, help="Seed files each client uploads before the run")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded")
+    parser.add_argument("--storage", choices=STORAGE_MODES, default="flat")
+    parser.add_argument("--compression", default="none", help="Codecs the clients offer, or 'none'")
+    parser.add_argument("--server-args", default="", help="Extra options for server.py, e.g. '--cache-size 0'")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the command and size choices")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--baseline", help="Earlier JSON result to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Share of throughput or p95 latency a command may lose against the baseline")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+
+    print(f"{args.clients} clients, {args.engine}/{args.storage}, {args.seconds:g} s")
+    print(f"{'command':>9} {'ops':>7} {'ops/s':>9} {'MiB/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>6}")
+    for command, stats in results["commands"].items():
+        print(f"{command:>9} {stats['count']:7d} {stats['ops_per_s']:9.1f} {stats['mib_per_s']:8.2f} "
+              f"{format_ms(stats['p50_ms'])} {format_ms(stats['p95_ms'])} {format_ms(stats['p99_ms'])} "
+              f"{stats['errors']:6d}")
+    server = results["server"]
+    if server["cpu_seconds"] is not None:
+        print(f"server: {server['cpu_seconds']:.2f} CPU s ({server['cpu_percent']:.0f}% of a core), "
+              f"RSS {(server['rss_bytes'] or 0) / 1024 ** 2:.1f} MiB, peak {(server['peak_rss_bytes'] or 0) / 1024 ** 2:.1f} MiB")
+    for error in results["client_errors"]:
+        print(f"client stopped: {error}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                "commit": git_commit(),
+                "config": {
+                    "clients": args.clients, "seconds": args.seconds, "mix": args.mix, "sizes": args.sizes,
+                    "files": args.files, "engine": args.engine, "storage": args.storage,
+                    "compression": args.compression, "server_args": args.server_args,
+                },
+                **results,
+            }, f, indent=2)
+
+    failed = bool(results["client_errors"])
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Parallel transfer benchmark: upload and download throughput at 1, 4 and 16 streams.
+
+A headless server is started behind a local TCP proxy that delays every byte by a fixed
+one-way latency and keeps at most --window bytes in flight per connection and direction.
+That models a window-limited high-latency path, where one stream tops out at about
+window / latency and parallel streams add up.
+
+    python benchmarks/bench_parallel.py --size-mb 64 --latency-ms 25 --streams 1 4 16
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parallel_transfer  # noqa: E402
+from file_index import file_sha256  # noqa: E402
+from protocol import FrameSocket, OP_HELLO, OP_OK, OP_SESSION_OPEN, OP_SESSION_COMMIT  # noqa: E402
+from server import FileServer  # noqa: E402
+
+
+class DelayedPipe:
+    # One direction of a proxied connection: bytes are delivered `delay` seconds after they
+    # were read, with at most `window` bytes read but not yet delivered
+    def __init__(self, source, target, delay, window):
+        self.source = source
+        self.target = target
+        self.delay = delay
+        self.window = window
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def read_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.in_flight >= self.window:
+                        self.condition.wait()
+                    room = self.window - self.in_flight
+                data = self.source.recv(min(room, 256 * 1024))
+                with self.condition:
+                    if not data:
+                        break
+                    self.queue.append((time.perf_counter() + self.delay, data))
+                    self.in_flight += len(data)
+                    self.condition.notify_all()
+        except OSError:
+            pass
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def write_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.closed:
+                        self.condition.wait()
+                    if not self.queue:
+                        break
+                    due, data = self.queue.popleft()
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                self.target.sendall(data)
+                with self.condition:
+                    self.in_flight -= len(data)
+                    self.condition.notify_all()
+            self.target.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class LatencyProxy:
+    def __init__(self, target, delay, window):
+        self.target = target
+        self.delay = delay
+        self.window = window
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.address = self.listener.getsockname()
+
+    def start(self):
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            DelayedPipe(client, upstream, self.delay, self.window).start()
+            DelayedPipe(upstream, client, self.delay, self.window).start()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def login(address, username):
+    conn = FrameSocket(socket.create_connection(address))
+    conn.send_message(OP_HELLO, 0, username=username)
+    reply = conn.recv_reply(0)
+    if reply.opcode != OP_OK:
+        raise RuntimeError(reply.fields().get("message"))
+    return conn, reply.fields()["token"]
+
+
+def upload(address, username, token, conn, filepath, filesize, name, streams, chunk_size):
+    conn.send_message(OP_SESSION_OPEN, 1, filename=name, filesize=filesize, chunk_size=chunk_size)
+    session = conn.recv_reply(1).fields()
+    parallel_transfer.parallel_send_chunks(
+        address, username, token, session["session"], filepath, filesize,
+        session["chunk_size"], list(range(session["chunks"])), streams
+    )
+    conn.send_message(OP_SESSION_COMMIT, 2, session=session["session"], hash=file_sha256(filepath))
+    reply = conn.recv_reply(2)
+    if reply.opcode != OP_OK:
+        raise RuntimeError(reply.fields().get("message"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the test file in MiB")
+    parser.add_argument("--latency-ms", type=float, default=25, help="One-way delay added by the proxy")
+    parser.add_argument("--window-kb", type=int, default=256, help="Bytes in flight per connection and direction")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 4, 16], help="Stream counts to compare")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)  # Only warnings from the server
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)  # The server log file goes into the scratch folder
+    filesize = args.size_mb * 1024 * 1024
+    filepath = os.path.join(workdir, "source.bin")
+    with open(filepath, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+    digest = file_sha256(filepath)
+
+    server = FileServer(upload_dir=os.path.join(workdir, "store"), port=free_port())
+    server.max_streams_per_client = 64
+    server.start_server()
+    proxy = LatencyProxy(('127.0.0.1', server.port), args.latency_ms / 1000, args.window_kb * 1024)
+    proxy.start()
+
+    results = {}
+    try:
+        conn, token = login(proxy.address, "bench")
+        for streams in args.streams:
+            name = f"file{streams}.bin"
+            start = time.perf_counter()
+            upload(proxy.address, "bench", token, conn, filepath, filesize, name, streams, 1024 * 1024)
+            upload_time = time.perf_counter() - start
+
+            target = os.path.join(workdir, f"download{streams}.bin")
+            start = time.perf_counter()
+            parallel_transfer.parallel_download(
+                proxy.address, "bench", token, f"bench_{name}", target, filesize, streams,
+                expected_hash=digest
+            )
+            download_time = time.perf_counter() - start
+            os.remove(target)
+
+            results[streams] = {
+                "upload_mb_s": filesize / upload_time / (1024 ** 2),
+                "download_mb_s": filesize / download_time / (1024 ** 2),
+            }
+            print(f"{streams:>3} streams: upload {results[streams]['upload_mb_s']:7.1f} MiB/s, "
+                  f"download {results[streams]['download_mb_s']:7.1f} MiB/s")
+        conn.close()
+    finally:
+        server.cleanup_server()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                "size_mb": args.size_mb,
+                "latency_ms": args.latency_ms,
+                "window_kb": args.window_kb,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
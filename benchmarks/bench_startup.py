@@ -0,0 +1,140 @@
+"""
+Startup benchmark: time until the server has its file index, with a million files.
+
+The storage folder is made up directly in the catalog (the files themselves are not needed
+when the server starts from the catalog), then the server's metadata start-up is timed:
+
+- clean: the previous run stopped cleanly, the index is loaded from the catalog
+- crash: the previous run crashed with --changes journaled changes and a few interrupted
+  writes since the last checkpoint; the journal is replayed before the load
+- scan: the previous run crashed and there is no journal, so the catalog is checked against
+  every stored file. This needs real files; --scan-files of them are created and the time is
+  also scaled to --files (the check is linear in the number of files).
+
+    python benchmarks/bench_startup.py --files 1000000 --changes 10000 --scan-files 100000
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog, CATALOG_FILE, UPSERT_FILE  # noqa: E402
+from journal import JOURNAL_FILE, encode_record  # noqa: E402
+from server import FileServer  # noqa: E402
+from storage import FlatStore, file_name  # noqa: E402
+
+OWNERS = 1000
+
+
+def names(count):
+    for number in range(count):
+        yield file_name(f"user{number % OWNERS}", f"file{number}.txt")
+
+
+def fill_catalog(folder, count):
+    # A catalog of count files, closed cleanly
+    FlatStore(folder).load()  # Marks the folder as sharded
+    catalog = Catalog(os.path.join(folder, CATALOG_FILE))
+    catalog.open()
+    now = time.time()
+    with catalog.db:
+        catalog.db.executemany(UPSERT_FILE, (
+            (name, name.partition("_")[0], 1000 + number % 5000, now, f"{number:064x}", 1, 0)
+            for number, name in enumerate(names(count))))
+    catalog.close()
+
+
+def simulate_crash(folder, count, changes, interrupted):
+    # Leave the catalog unclean and a journal with changes and open writes behind
+    db = sqlite3.connect(os.path.join(folder, CATALOG_FILE))
+    with db:
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('clean', '0')")
+    db.close()
+    now = time.time()
+    with open(os.path.join(folder, JOURNAL_FILE), 'ab') as f:
+        for sequence, name in enumerate(names(changes), 1):
+            entry = {"name": name, "owner": name.partition("_")[0], "size": 7, "mtime": now,
+                     "hash": f"{sequence:064x}", "version": 2, "downloads": 0}
+            f.write(encode_record({"seq": sequence, "op": "update", "entry": entry}))
+        for number, name in enumerate(names(min(interrupted, count)), 1):
+            f.write(encode_record({"op": "begin", "id": number, "names": [name]}))
+
+
+def start(folder, check=False):
+    # Seconds until the index is loaded, the way start_server does it
+    server = FileServer(upload_dir=folder, port=12345, check_catalog=check)
+    server.logger.disabled = True
+    started = time.perf_counter()
+    server.open_metadata()
+    elapsed = time.perf_counter() - started
+    files = len(server.index)
+    server.catalog.close()
+    server.journal.checkpoint(server.catalog.sequence)
+    server.journal.close()
+    return elapsed, files
+
+
+def create_files(folder, count):
+    # count empty files in the sharded layout, plus their catalog
+    store = FlatStore(folder)
+    store.load()
+    for name in names(count):
+        path = store.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+    fill_catalog(folder, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000000, help="Files in the catalog")
+    parser.add_argument("--changes", type=int, default=10000, help="Journaled changes since the last checkpoint")
+    parser.add_argument("--interrupted", type=int, default=10, help="Writes the crash interrupted")
+    parser.add_argument("--scan-files", type=int, default=0,
+                        help="Real files for the scan case, 0 to skip it (creating them takes a while)")
+    parser.add_argument("--dir", default=None, help="Where to build the folders (default: a temp dir)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="bench-startup-", dir=args.dir)
+    results = {"files": args.files}
+    try:
+        folder = os.path.join(base, "catalog")
+        os.makedirs(folder)
+        print(f"Building a catalog of {args.files} files ...")
+        fill_catalog(folder, args.files)
+
+        seconds, files = start(folder)
+        results["clean"] = seconds
+        print(f"clean start:   {seconds:8.2f} s  ({files} files)")
+
+        simulate_crash(folder, args.files, args.changes, args.interrupted)
+        seconds, files = start(folder)
+        results["crash"] = seconds
+        print(f"crash, replay: {seconds:8.2f} s  ({args.changes} changes, {args.interrupted} interrupted writes)")
+
+        if args.scan_files:
+            scan_folder = os.path.join(base, "files")
+            os.makedirs(scan_folder)
+            print(f"Creating {args.scan_files} files ...")
+            create_files(scan_folder, args.scan_files)
+            seconds, files = start(scan_folder, check=True)
+            scaled = seconds * args.files / args.scan_files
+            results["scan"] = {"files": args.scan_files, "seconds": seconds, "scaled": scaled}
+            print(f"crash, scan:   {seconds:8.2f} s  ({files} files), about {scaled:.1f} s for {args.files}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
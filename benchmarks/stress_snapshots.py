@@ -0,0 +1,188 @@
+"""
+Snapshot isolation stress run: UPDATE and DOWNLOAD hammering the same file at once.
+
+One writer keeps replacing a file with new versions while several readers download it
+in a loop. Every version has its own size and is filled with its version number, so a
+download that mixes two versions, is cut short or reads a half written file is detected.
+Exits with status 1 if any download was torn.
+
+    python benchmarks/stress_snapshots.py --seconds 10 --readers 4 --storage flat dedup
+"""
+import argparse
+import collections
+import io
+import logging
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import (  # noqa: E402
+    FrameSocket, ProtocolError, OP_HELLO, OP_OK, OP_NOTIFICATION, OP_UPLOAD, OP_UPDATE, OP_DOWNLOAD, OP_READY,
+)
+from server import FileServer, ENGINES, STORAGE_MODES  # noqa: E402
+
+WORD = struct.Struct("!Q")
+
+
+def version_content(version, base_size):
+    # Version n: base_size plus n % 7 blocks of 4 KiB, every 8 byte word holds n
+    size = base_size + (version % 7) * 4096
+    return WORD.pack(version) * (size // WORD.size)
+
+
+def check_content(content, base_size):
+    # Returns the version of a consistent download, None for a torn one
+    if len(content) < WORD.size:
+        return None
+    (version,) = WORD.unpack_from(content)
+    if content != version_content(version, base_size):
+        return None
+    return version
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def login(port, username):
+    conn = FrameSocket(socket.create_connection(('127.0.0.1', port)))
+    conn.send_message(OP_HELLO, 0, username=username)
+    if conn.recv_reply(0).opcode != OP_OK:
+        raise RuntimeError(f"Login refused for {username}")
+    return conn
+
+
+def send_version(conn, request_id, opcode, version, base_size, **fields):
+    content = version_content(version, base_size)
+    conn.send_message(opcode, request_id, filesize=len(content), **fields)
+    conn.send_stream(request_id, io.BytesIO(content), len(content))
+    reply = conn.recv_reply(request_id)
+    if reply.opcode != OP_OK:
+        raise RuntimeError(reply.fields().get("message"))
+    # Download notifications for the owner were put aside while waiting, drop them
+    conn.pending = collections.deque(f for f in conn.pending if f.opcode != OP_NOTIFICATION)
+
+
+def writer_loop(port, base_size, stop, ready, stats):
+    conn = login(port, "writer")
+    # The first version is a normal upload, everything after it is an UPDATE
+    send_version(conn, 1, OP_UPLOAD, 1, base_size, filename="data.bin")
+    ready.set()
+    version = 1
+    while not stop.is_set():
+        version += 1
+        send_version(conn, version, OP_UPDATE, version, base_size, filename="writer_data.bin")
+        stats["updates"] += 1
+    conn.close()
+
+
+def reader_loop(port, name, base_size, stop, ready, stats, lock):
+    ready.wait()
+    logins = 0
+    while not stop.is_set():
+        # A download that breaks off counts as torn too; continue on a new connection
+        logins += 1
+        conn = login(port, f"{name}-{logins}")
+        try:
+            download_loop(conn, base_size, stop, stats, lock)
+        except (ConnectionError, ProtocolError):
+            with lock:
+                stats["downloads"] += 1
+                stats["torn"] += 1
+        finally:
+            conn.close()
+
+
+def download_loop(conn, base_size, stop, stats, lock):
+    request_id = 0
+    while not stop.is_set():
+        request_id += 1
+        conn.send_message(OP_DOWNLOAD, request_id, filename="writer_data.bin")
+        reply = conn.recv_reply(request_id)
+        if reply.opcode != OP_OK:
+            raise RuntimeError(reply.fields().get("message"))
+        conn.send_frame(OP_READY, request_id)
+        content = io.BytesIO()
+        conn.receive_stream(request_id, content, reply.fields()["filesize"])
+        version = check_content(content.getvalue(), base_size)
+        with lock:
+            stats["downloads"] += 1
+            if version is None:
+                stats["torn"] += 1
+            else:
+                stats["versions"].add(version)
+
+
+def run(storage, engine, seconds, readers, base_size):
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)  # The server log file goes into the scratch folder
+    server = FileServer(upload_dir=os.path.join(workdir, "store"), port=free_port(),
+                        engine=engine, storage=storage)
+    server.start_server()
+    try:
+        stats = {"updates": 0, "downloads": 0, "torn": 0, "versions": set()}
+        lock = threading.Lock()
+        stop = threading.Event()
+        ready = threading.Event()
+        errors = []
+
+        def guarded(target, *args):
+            try:
+                target(*args)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+                ready.set()
+
+        threads = [
+            threading.Thread(target=guarded, args=(writer_loop, server.port, base_size, stop, ready, stats))
+        ]
+        threads += [
+            threading.Thread(target=guarded, args=(reader_loop, server.port, f"reader{i}", base_size,
+                                                   stop, ready, stats, lock))
+            for i in range(readers)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return stats
+    finally:
+        server.cleanup_server()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10, help="Duration of each run")
+    parser.add_argument("--readers", type=int, default=4, help="Clients downloading in a loop")
+    parser.add_argument("--size-kb", type=int, default=512, help="Base size of a version in KiB")
+    parser.add_argument("--storage", nargs="+", choices=STORAGE_MODES, default=STORAGE_MODES)
+    parser.add_argument("--engine", choices=ENGINES, default="threaded")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    failed = False
+    for storage in args.storage:
+        stats = run(storage, args.engine, args.seconds, args.readers, args.size_kb * 1024)
+        print(f"{storage:>6}: {stats['updates']} updates, {stats['downloads']} downloads, "
+              f"{len(stats['versions'])} distinct versions read, {stats['torn']} torn")
+        failed = failed or stats["torn"] > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Persistent metadata catalog of the server, a SQLite database in WAL mode.
+
+It holds what used to exist only in memory or had to be read back from the file system:
+the stored files with owner, size, mtime, hash, version and download counter, and the
+registry of usernames with their resume tokens. The server still answers every request
+from memory (FileIndex and its username sets); the catalog is what those are loaded from at
+start, so a restart after a clean stop needs no scan of the storage folder.
+
+Writes follow the change log of the FileIndex: sync() applies every change after the last one
+it wrote in one transaction, in sequence order, so concurrent uploads share a commit and the
+catalog never sees two changes of a file in the wrong order. Download counters are added up
+in memory and written by flush().
+
+check() is the consistency checker: it compares the catalog with what the store really holds
+and, with fix, brings the catalog in line. The server runs it at start when the previous run
+did not close the catalog cleanly; `python catalog.py check <storage folder>` runs it by hand.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from storage import split_file_name
+
+CATALOG_FILE = ".catalog.db"  # In the storage folder; hidden, so scans never take it for an upload
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    downloads INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_owner ON files (owner, name);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    token TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+UPSERT_FILE = """
+INSERT INTO files (name, owner, size, mtime, hash, version, downloads) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, size = excluded.size, mtime = excluded.mtime,
+    hash = excluded.hash, version = excluded.version
+"""
+
+
+class Catalog:
+    """
+    One SQLite connection shared by all threads behind a lock. Every method is a no-op once
+    the catalog is closed, so handlers finishing during a shutdown do not fail on it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        self.sequence = 0  # Last change of the index written, see sync()
+        self.downloads = {}  # name -> downloads not written yet
+        self.was_clean = False  # The previous run closed the catalog, its contents can be trusted
+
+    def open(self):
+        # Returns True if the catalog was closed cleanly by the previous run
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # WAL: readers never wait for the writer, and a commit is an append to the log.
+        # synchronous=NORMAL syncs at checkpoints only; a power loss may drop the last commits,
+        # which check() repairs, but never corrupts the database.
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        version = db.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+        if version is not None and int(version[0]) != SCHEMA_VERSION:
+            db.close()
+            raise RuntimeError(f"Catalog {self.path} has schema {version[0]}, expected {SCHEMA_VERSION}")
+        clean = db.execute("SELECT value FROM meta WHERE key = 'clean'").fetchone()
+        with db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('schema', ?)", (str(SCHEMA_VERSION),))
+            # Until close() says otherwise, a crash leaves the catalog marked as possibly stale
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('clean', '0')")
+        self.db = db
+        self.was_clean = clean is not None and clean[0] == "1"
+        return self.was_clean
+
+    def close(self, clean=True):
+        # clean=False leaves the catalog marked for a check at the next start
+        with self.lock:
+            if self.db is None:
+                return
+            self.flush_locked()
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('clean', ?)", ("1" if clean else "0",))
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+            self.db = None
+
+    # ---- files --------------------------------------------------------------
+
+    def entries(self):
+        # Rows of all files as (name, owner, size, mtime, hash, version, downloads), read as
+        # they are consumed, so a large catalog is never held in memory a second time
+        with self.lock:
+            if self.db is None:
+                return
+            yield from self.db.execute("SELECT name, owner, size, mtime, hash, version, downloads FROM files")
+
+    def sync(self, index):
+        # Write the changes of index after the last one written, in one transaction
+        with self.lock:
+            if self.db is None:
+                return
+            while True:
+                result = index.changes_since(self.sequence, 10000)
+                if result is None:
+                    # Fell behind the change log (cannot happen while sync runs after every
+                    # change); write the whole index instead
+                    self.replace_locked(entry.to_dict() for entry in index.entries.values())
+                    self.sequence = index.sequence
+                    return
+                changes, more = result
+                if not changes:
+                    return
+                self.apply_locked(changes)
+                self.sequence = changes[-1]["seq"]
+                if not more:
+                    return
+
+    def replay(self, changes):
+        # Apply changes of the journal that a crash may have kept from the catalog. Every
+        # change carries the full entry, so applying one the catalog already has is harmless.
+        with self.lock:
+            if self.db is not None:
+                self.apply_locked(changes)
+
+    def apply_locked(self, changes):
+        # Only the last change of each file matters
+        final = {}
+        for change in changes:
+            final[change["name"] if change["op"] == "delete" else change["entry"]["name"]] = change
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE name = ?",
+                                ((name,) for name, change in final.items() if change["op"] == "delete"))
+            self.db.executemany(UPSERT_FILE, (file_row(change["entry"])
+                                              for change in final.values() if change["op"] != "delete"))
+
+    def replace_locked(self, entries):
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany(UPSERT_FILE, (file_row(entry) for entry in entries))
+
+    def checkpoint(self):
+        # Make every commit so far durable (synchronous=NORMAL leaves the last ones in the
+        # unsynced WAL). Returns the index sequence the catalog is durable up to.
+        with self.lock:
+            if self.db is None:
+                return self.sequence
+            self.db.execute("PRAGMA wal_checkpoint(FULL)")
+            return self.sequence
+
+    def set_hash(self, name, digest):
+        # Hashes computed in the background after a scan are not changes of the file
+        with self.lock:
+            if self.db is not None:
+                with self.db:
+                    self.db.execute("UPDATE files SET hash = ? WHERE name = ?", (digest, name))
+
+    def count_download(self, name):
+        # Counted in memory, flush() writes the sums
+        with self.lock:
+            self.downloads[name] = self.downloads.get(name, 0) + 1
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.db is None or not self.downloads:
+            return
+        counts, self.downloads = self.downloads, {}
+        with self.db:
+            self.db.executemany("UPDATE files SET downloads = downloads + ? WHERE name = ?",
+                                ((count, name) for name, count in counts.items()))
+
+    # ---- username registry --------------------------------------------------
+
+    def users(self):
+        # {username: resume token} of every username that ever logged in
+        with self.lock:
+            if self.db is None:
+                return {}
+            return dict(self.db.execute("SELECT username, token FROM users"))
+
+    def register_user(self, username, token):
+        # Record a login: a new username is added, a known one gets its last_seen updated
+        now = time.time()
+        with self.lock:
+            if self.db is None:
+                return
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO users VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (username) DO UPDATE SET token = excluded.token, last_seen = excluded.last_seen",
+                    (username, token, now, now))
+
+    # ---- consistency check --------------------------------------------------
+
+    def check(self, store, fix=False, names=None):
+        """
+        Compare the catalog with the files the store holds. Returns a report with the names
+        missing from the catalog, those the store no longer has, and those whose size or
+        mtime differ. With fix the catalog is brought in line: new files are added (without
+        hash), vanished ones removed and changed ones get the new size and mtime, no hash
+        and the next version. Download counters of surviving files are kept.
+        names limits the check to those files, which are looked up instead of scanning the store.
+        """
+        if names is None:
+            stored = {name: (owner, size, mtime, digest) for name, owner, size, mtime, digest in store.scan()}
+        else:
+            stored = {}
+            for name in names:
+                try:
+                    size, mtime = store.stat(name)
+                except (OSError, KeyError):
+                    continue
+                stored[name] = (split_file_name(name)[0], size, mtime, None)
+        with self.lock:
+            if self.db is None:
+                raise RuntimeError("Catalog is closed")
+            query = "SELECT name, owner, size, mtime, hash, version FROM files"
+            if names is None:
+                known = {row[0]: row for row in self.db.execute(query)}
+            else:
+                known = {}
+                for name in names:
+                    known.update((row[0], row) for row in self.db.execute(query + " WHERE name = ?", (name,)))
+            missing = sorted(name for name in stored if name not in known)
+            vanished = sorted(name for name in known if name not in stored)
+            changed = sorted(name for name, (owner, size, mtime, _) in stored.items()
+                             if name in known and (known[name][1], known[name][2], known[name][3]) != (owner, size, mtime))
+            if fix and (missing or vanished or changed):
+                with self.db:
+                    self.db.executemany("DELETE FROM files WHERE name = ?", ((name,) for name in vanished))
+                    self.db.executemany(UPSERT_FILE, (
+                        (name, owner, size, mtime, digest, 1, 0)
+                        for name in missing for owner, size, mtime, digest in (stored[name],)))
+                    self.db.executemany(UPSERT_FILE, (
+                        (name, owner, size, mtime, digest, known[name][5] + 1, 0)
+                        for name in changed for owner, size, mtime, digest in (stored[name],)))
+        return {"files": len(stored) if names is None else len(names), "missing": missing, "vanished": vanished, "changed": changed}
+
+
+def file_row(entry):
+    # Parameters of UPSERT_FILE for an entry dict (FileEntry.to_dict)
+    return (entry["name"], entry["owner"], entry["size"], entry["mtime"], entry["hash"],
+            entry.get("version", 1), entry.get("downloads", 0))
+
+
+def main():
+    # python catalog.py check <storage folder> [--fix] [--storage dedup]
+    from storage import FlatStore, BlobStore
+
+    parser = argparse.ArgumentParser(description="Check the metadata catalog against the stored files")
+    parser.add_argument("command", choices=["check"])
+    parser.add_argument("storage_dir", help="Storage folder of the server (stop the server first to fix it)")
+    parser.add_argument("--storage", choices=["flat", "dedup"], default="flat", help="Storage mode of the folder")
+    parser.add_argument("--fix", action="store_true", help="Bring the catalog in line with the files")
+    args = parser.parse_args()
+
+    store = BlobStore(args.storage_dir) if args.storage == "dedup" else FlatStore(args.storage_dir)
+    store.load()
+    catalog = Catalog(os.path.join(args.storage_dir, CATALOG_FILE))
+    catalog.open()
+    report = None
+    try:
+        report = catalog.check(store, fix=args.fix)
+    finally:
+        # A catalog found out of line stays marked, so the server repairs it when it starts
+        problems = sum(len(report[key]) for key in ("missing", "vanished", "changed")) if report else 1
+        catalog.close(clean=args.fix or not problems)
+    for key in ("missing", "vanished", "changed"):
+        for name in report[key]:
+            print(f"{key}: {name}")
+    print(f"{report['files']} files, {problems} differences{' fixed' if args.fix and problems else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,25 @@ import socket
 import os
 import threading
 import time
+import itertools
+import queue
+import contextlib
+import parallel_transfer
+import delta
+import compression
+import io
+from file_index import file_sha256
+import hashlib
+import json
+from client_channel import ClientChannel
+from listing_cache import ListingCache
+from liveness import enable_keepalive
+from protocol import (
+    OP_HELLO, OP_ERROR, OP_EXIT,
+    OP_LIST, OP_UPLOAD, OP_DOWNLOAD, OP_DELETE, OP_UPDATE,
+    OP_SESSION_OPEN, OP_SESSION_CHUNK, OP_SESSION_STATUS, OP_SESSION_COMMIT,
+    OP_SIGNATURE, OP_READY, OP_CANCEL, OP_MULTI_DELETE, OP_MULTI_STAT, OP_MULTI_DOWNLOAD, OP_WATCH,
+)
 
 class FileClient:
     def __init__(self, root):
@@ -13,17 +32,35 @@ class FileClient:
         
         # Initialize socket and connection status
         self.socket = None
+        self.conn = None  # Framed protocol wrapper around self.socket
         self.connected = False
         self.username = ""  # Store the client's username
         self.is_downloading = False
-        self.chunk_size = 4096  # Set the chunk size for data transfer
+        self.chunk_size = 65536  # Set the chunk size for data transfer
+        self.list_page_size = 500  # Entries requested per LIST page
+        self.features = {}  # Optional protocol features announced by the server
+        self.server_address = None  # (ip, port) of the current or last connection
+        self.resume_token = None  # Lets this client log in again under the same username
+        self.reconnect_attempts = 5  # Automatic reconnects after a dropped download
+        self.pending_downloads_file = os.path.join(os.getcwd(), "pending_downloads.json")  # Sidecar files of partial downloads
+        self.pending_uploads_file = os.path.join(os.getcwd(), "pending_uploads.json")  # Open upload sessions
+        self.session_threshold = 16 * 1024 * 1024  # Files from this size on are uploaded in resumable sessions
+        self.session_window = 4  # Chunks sent ahead of their acknowledgement
+        self.parallel_threshold = 64 * 1024 * 1024  # Transfers from this size on are split over several streams
+        self.delta_threshold = 64 * 1024  # Updates from this size on only send the changed blocks
+        self.delta_ratio = 0.5  # A delta larger than this share of the file is not worth it
+        self.request_ids = itertools.count(1)  # Source of request ids for outgoing commands
+        self.request_lock = threading.RLock()  # Held while an operation is using the connection
+        self.exchange_depth = 0  # Nesting of exchange() blocks holding request_lock
+        self.events = queue.Queue()  # Notifications and connection losses from the connection reader
+        self.listing = ListingCache()  # The server's file list, kept current by pushed changes
         
         # Set up the GUI components for the client application
         self.setup_gui()
         
-        # Start a separate thread to check for notifications from the server
-        self.notification_thread = threading.Thread(target=self.check_notifications, daemon=True)
-        self.notification_thread.start()
+        # Start a separate thread that shows notifications as the reader hands them over
+        self.event_thread = threading.Thread(target=self.handle_events, daemon=True)
+        self.event_thread.start()
         
         # Capture the event for closing the window and handle it properly
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -34,11 +71,10 @@ class FileClient:
             return
 
         try:
-            # Get file list from server
-            self.socket.send("LIST".encode())
-            response = self.socket.recv(4096).decode()
+            # Get file list, cached since the connect
+            files = self.listed_files()
 
-            if "There is no file in server." in response:
+            if not files:
                 self.log_message("There is no file in server.")
                 return
 
@@ -54,127 +90,38 @@ class FileClient:
             scrollbar = ttk.Scrollbar(frame)
             scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
-            listbox = tk.Listbox(frame, yscrollcommand=scrollbar.set)
+            # Several files can be selected, they are fetched together into one folder
+            listbox = tk.Listbox(frame, yscrollcommand=scrollbar.set, selectmode=tk.EXTENDED)
             listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
             scrollbar.config(command=listbox.yview)
 
-            files = [f.strip() for f in response.split('\n') if f.strip()]
-            for file in files:
-                listbox.insert(tk.END, file)
+            for entry in files:
+                listbox.insert(tk.END, entry["name"])
 
             def start_download():
                 if not listbox.curselection():
                     self.log_message("Please choose a file!", "ERROR")
                     return
 
-                selected_file = listbox.get(listbox.curselection())
+                selected_files = [listbox.get(index) for index in listbox.curselection()]
                 file_window.destroy()
 
-                try:
-                    ### 1) Increase the timeout (e.g. 600 sec = 10 minutes) or remove it
-                    original_timeout = self.socket.gettimeout()
-                    self.socket.settimeout(600)  # Örnek: 10 dakika
-
-                    try:
-                        # Send DOWNLOAD request
-                        self.socket.send(f"DOWNLOAD|{selected_file}".encode())
-
-                        # Get response from server: "DOWNLOAD|filename|filesize" or "ERROR: ..."
-                        response = self.socket.recv(1024).decode()
-                        if not response:
-                            raise Exception("No response from server")
-                        if response.startswith("ERROR"):
-                            raise Exception(response)
-
-                        # 2) Parse file information
-                        parts = response.split('|')
-                        if len(parts) != 3:
-                            raise Exception("Invalid server response")
-
-                        _, filename, filesize_str = parts
-                        filesize = int(filesize_str.strip())
-
-                        # 3) Save location
-                        save_path = filedialog.asksaveasfilename(
-                            initialfile=filename,
-                            defaultextension=os.path.splitext(filename)[1]
-                        )
-                        if not save_path:
-                            return
-
-                        self.log_message(f"{filename} downloading...")
-
-                        # 4) İndirme ilerlemesi penceresi
-                        progress_window = tk.Toplevel(self.root)
-                        progress_window.title("Download Progress")
-                        progress_window.geometry("300x150")
-
-                        progress_var = tk.DoubleVar()
-                        progress_bar = ttk.Progressbar(progress_window, variable=progress_var, maximum=100)
-                        progress_bar.pack(pady=10, padx=10, fill=tk.X)
-
-                        status_label = ttk.Label(progress_window, text="0%")
-                        status_label.pack(pady=5)
-
-                        # 5) Send "READY" message to server
-                        self.socket.send("READY".encode())
-
-                        ### 2) Large file import
-                        try:
-                            received = 0
-                            start_time = time.time()
-                            last_update_time = start_time
-
-                            with open(save_path, 'wb') as f:
-                                # recv until the file is completely downloaded
-                                while received < filesize:
-                                    # You can make the chunk size (8192) even larger (e.g. 65536)
-                                    chunk_size = min(65536, filesize - received)
-                                    chunk = self.socket.recv(chunk_size)
-                                    if not chunk:
-                                        # In case of disconnection
-                                        break
-
-                                    f.write(chunk)
-                                    received += len(chunk)
-
-                                    # 6) Progress update
-                                    current_time = time.time()
-                                    if current_time - last_update_time >= 0.1:
-                                        if progress_window.winfo_exists():
-                                            progress = (received / filesize) * 100
-                                            progress_var.set(progress)
-
-                                            speed = received / (current_time - start_time)
-                                            status = (f"%{progress:.1f} - "
-                                                    f"{self.format_size(received)}/"
-                                                    f"{self.format_size(filesize)} - "
-                                                    f"{self.format_size(speed)}/s")
-                                            status_label.config(text=status)
-                                            progress_window.update()
-
-                                            last_update_time = current_time
-
-                            # 7) Dosya tam inmiş mi?
-                            if received == filesize:
-                                self.log_message(f"File downloaded successfully: {filename}")
-                            else:
-                                raise Exception("File downloaded incompletely")
-
-                        except Exception as e:
-                            if os.path.exists(save_path):
-                                os.remove(save_path)
-                            raise Exception(f"Download error: {str(e)}")
-                        finally:
-                            if progress_window.winfo_exists():
-                                progress_window.destroy()
-
-                    finally:
-                        ### 3) Revert timeout
-                        self.socket.settimeout(original_timeout)
+                if len(selected_files) > 1:
+                    folder = filedialog.askdirectory(title="Download files to")
+                    if folder:
+                        self.run_multi_download(selected_files, folder)
+                    return
+                selected_file = selected_files[0]
 
-                except Exception as e:
-                    self.log_message(f"Download error: {str(e)}", "ERROR")
+                # Save location
+                save_path = filedialog.asksaveasfilename(
+                    initialfile=selected_file,
+                    defaultextension=os.path.splitext(selected_file)[1]
+                )
+                if not save_path:
+                    return
+
+                self.run_download(selected_file, save_path)
 
             button_frame = ttk.Frame(file_window)
             button_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -185,6 +132,330 @@ class FileClient:
             self.log_message(f"Download error: {str(e)}", "ERROR")
 
             
+    def run_download(self, filename, save_path):
+        # Download with automatic recovery: a dropped connection keeps the partial file
+        # and schedules a reconnect, after which the download continues where it stopped
+        try:
+            self.fetch_download(filename, save_path)
+        except (ConnectionError, socket.timeout) as e:
+            self.log_message(f"Download interrupted: {str(e)}", "ERROR")
+            self.cleanup_connection()
+            self.schedule_reconnect()
+        except Exception as e:
+            self.log_message(f"Download error: {str(e)}", "ERROR")
+
+    def run_multi_download(self, filenames, folder):
+        # Several whole files into folder; a dropped connection reconnects like a single download
+        try:
+            count = self.fetch_many(filenames, folder)
+            self.log_message(f"Files downloaded successfully: {count} of {len(filenames)}")
+        except (ConnectionError, socket.timeout) as e:
+            self.log_message(f"Download interrupted: {str(e)}", "ERROR")
+            self.cleanup_connection()
+            self.schedule_reconnect()
+        except Exception as e:
+            self.log_message(f"Download error: {str(e)}", "ERROR")
+
+    def fetch_many(self, filenames, folder):
+        """
+        Download whole files into folder with MULTI_DOWNLOAD and return how many arrived.
+        All batch requests are sent before the first reply is read, then the manifest and
+        DATA frames of each batch are taken in turn. Every file goes through a .part file
+        that is renamed once complete; there is no resume state, a broken batch is asked
+        for again. Servers without batch commands get one download per file.
+        """
+        batch = self.features.get("batch")
+        if not batch:
+            for filename in filenames:
+                self.fetch_download(filename, os.path.join(folder, filename))
+            return len(filenames)
+
+        size = batch["max_items"]
+        count = 0
+        with self.exchange():
+            request_ids = [self.send_request(OP_MULTI_DOWNLOAD, filenames=filenames[start:start + size])
+                           for start in range(0, len(filenames), size)]
+            for request_id in request_ids:
+                reply = self.receive_response(request_id)
+                for item in reply["files"]:
+                    if not item["ok"]:
+                        self.log_message(f"{item['filename']}: {item['message']}", "ERROR")
+                self.conn.send_frame(OP_READY, request_id)
+                for item in reply["files"]:
+                    if not item["ok"]:
+                        continue
+                    save_path = os.path.join(folder, item["filename"])
+                    part_path = save_path + ".part"
+                    with open(part_path, 'wb') as f:
+                        self.conn.receive_stream(request_id, f, int(item["filesize"]))
+                    os.replace(part_path, save_path)
+                    count += 1
+        return count
+
+    def fetch_download(self, filename, save_path):
+        """
+        Download filename into save_path through save_path + ".part".
+        The sidecar state file next to it records which version of the file the partial
+        bytes belong to; when both exist the DOWNLOAD asks only for the missing range.
+        """
+        part_path = save_path + ".part"
+        state_path = part_path + ".json"
+        state = self.load_download_state(state_path)
+        offset = os.path.getsize(part_path) if state and os.path.exists(part_path) else 0
+
+        # The connection belongs to this request until the transfer is over
+        with self.exchange():
+            # Send DOWNLOAD request, the server answers with the file size or an ERROR frame
+            request_id = self.send_request(OP_DOWNLOAD, filename=filename, offset=offset)
+            try:
+                info = self.receive_response(request_id)
+            except (ConnectionError, socket.timeout):
+                raise
+            except Exception:
+                # The server refused, e.g. the file was deleted: the partial file is useless now
+                if state:
+                    self.discard_download(part_path, state_path)
+                raise
+            if offset and not self.same_version(state, info):
+                # The file changed on the server since the partial download, start over
+                self.log_message(f"{filename} changed on the server, downloading it again")
+                self.conn.send_frame(OP_CANCEL, request_id)
+                offset = 0
+                request_id = self.send_request(OP_DOWNLOAD, filename=filename, offset=0)
+                info = self.receive_response(request_id)
+
+            filesize = int(info["filesize"])
+            length = int(info["length"])
+
+            # Record the version before the first byte is written
+            self.save_download_state(state_path, {
+                "server": list(self.server_address),
+                "filename": filename,
+                "save_path": save_path,
+                "filesize": filesize,
+                "mtime": info.get("mtime"),
+                "hash": info.get("hash"),
+            })
+
+            if not offset and filesize >= self.parallel_threshold and self.parallel_streams() > 1:
+                # Large file: give up the single stream and fetch byte ranges in parallel
+                self.conn.send_frame(OP_CANCEL, request_id)
+                self.parallel_fetch(filename, save_path, part_path, state_path, info)
+                return
+
+            if offset:
+                self.log_message(f"{filename} resuming at {self.format_size(offset)} "
+                                 f"of {self.format_size(filesize)}...")
+            else:
+                self.log_message(f"{filename} downloading...")
+
+            # Download progress window
+            progress_window = tk.Toplevel(self.root)
+            progress_window.title("Download Progress")
+            progress_window.geometry("300x150")
+
+            progress_var = tk.DoubleVar()
+            progress_bar = ttk.Progressbar(progress_window, variable=progress_var, maximum=100)
+            progress_bar.pack(pady=10, padx=10, fill=tk.X)
+
+            status_label = ttk.Label(progress_window, text="0%")
+            status_label.pack(pady=5)
+
+            # Send READY frame to server
+            self.conn.send_frame(OP_READY, request_id)
+
+            try:
+                start_time = time.time()
+                last_update = [start_time]
+
+                def show_progress(received, total):
+                    # Progress update over the whole file, not only the resumed range
+                    current_time = time.time()
+                    if current_time - last_update[0] >= 0.1:
+                        if progress_window.winfo_exists():
+                            done = offset + received
+                            progress = (done / max(filesize, 1)) * 100
+                            progress_var.set(progress)
+
+                            speed = received / max(current_time - start_time, 1e-6)
+                            status = (f"%{progress:.1f} - "
+                                    f"{self.format_size(done)}/"
+                                    f"{self.format_size(filesize)} - "
+                                    f"{self.format_size(speed)}/s")
+                            status_label.config(text=status)
+                            progress_window.update()
+
+                            last_update[0] = current_time
+
+                # DATA frames are appended to the partial file until the range arrived
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    received = self.conn.receive_stream(request_id, f, length, show_progress)
+
+                # Is the file complete?
+                if offset + received != filesize:
+                    raise Exception("File downloaded incompletely")
+                os.replace(part_path, save_path)
+                self.forget_download(state_path)
+                self.log_message(f"File downloaded successfully: {filename}")
+
+            finally:
+                if progress_window.winfo_exists():
+                    progress_window.destroy()
+
+
+    def parallel_streams(self):
+        # Stream count from the connection form, 1 disables parallel transfers
+        try:
+            return max(1, min(int(self.entries["Streams:"].get()), 16))
+        except ValueError:
+            return 1
+
+    def poll_gui(self, report):
+        # poll() callback for the stream threads: keep the window alive while waiting
+        def poll():
+            report()
+            self.root.update()
+        return poll
+
+    def parallel_fetch(self, filename, save_path, part_path, state_path, info):
+        # Download byte ranges over several attached connections into the partial file,
+        # then verify the reassembled file against the server hash
+        streams = self.parallel_streams()
+        filesize = int(info["filesize"])
+        self.log_message(f"{filename} downloading over {streams} streams...")
+        start_time = time.time()
+        progress = parallel_transfer.Progress()
+        meter = parallel_transfer.Meter(
+            progress, filesize, lambda done, total: self.update_progress(done, total, start_time)
+        )
+        try:
+            parallel_transfer.parallel_download(
+                self.server_address, self.username, self.resume_token, filename, part_path, filesize,
+                streams, mtime=info.get("mtime"), expected_hash=info.get("hash"),
+                progress=progress, poll=self.poll_gui(meter)
+            )
+        except Exception:
+            # The ranges are not a prefix of the file, a later attempt has to start over
+            self.discard_download(part_path, state_path)
+            raise
+        os.replace(part_path, save_path)
+        self.forget_download(state_path)
+        self.log_message(f"File downloaded successfully: {filename}")
+
+    def same_version(self, state, info):
+        # A partial download may only be continued if the server still has the same content
+        if int(info["filesize"]) != state.get("filesize") or info.get("mtime") != state.get("mtime"):
+            return False
+        if info.get("hash") and state.get("hash"):
+            return info["hash"] == state["hash"]
+        return True
+
+    def load_download_state(self, state_path):
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_download_state(self, state_path, state):
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+        # The registry lets a new session find partial downloads after a restart
+        pending = self.load_pending_downloads()
+        if state_path not in pending:
+            pending.append(state_path)
+            self.save_pending_downloads(pending)
+
+    def forget_download(self, state_path):
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+        pending = self.load_pending_downloads()
+        if state_path in pending:
+            pending.remove(state_path)
+            self.save_pending_downloads(pending)
+
+    def discard_download(self, part_path, state_path):
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        self.forget_download(state_path)
+
+    def load_pending_downloads(self):
+        try:
+            with open(self.pending_downloads_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def save_pending_downloads(self, pending):
+        with open(self.pending_downloads_file, 'w') as f:
+            json.dump(pending, f)
+
+    def resume_downloads(self):
+        # Continue the partial downloads of this server, called after every (re)connect
+        pending = []
+        for state_path in self.load_pending_downloads():
+            state = self.load_download_state(state_path)
+            if state is None:
+                self.forget_download(state_path)
+                continue
+            if tuple(state.get("server", ())) == tuple(self.server_address):
+                pending.append((state_path, state))
+        if not pending:
+            return
+
+        # One MULTI_STAT tells which partial files are still worth continuing
+        try:
+            current = self.stat_files([state["filename"] for _, state in pending])
+        except Exception as e:
+            self.log_message(f"Could not check partial downloads: {str(e)}", "ERROR")
+            current = None
+
+        for state_path, state in pending:
+            if not self.connected:
+                return
+            part_path = state["save_path"] + ".part"
+            if current is not None:
+                entry = current.get(state["filename"])
+                if entry is None:
+                    self.log_message(f"{state['filename']} is no longer on the server, partial download removed")
+                    self.discard_download(part_path, state_path)
+                    continue
+                if not self.same_version(state, {"filesize": entry["size"], "mtime": entry["mtime"],
+                                                 "hash": entry["hash"]}):
+                    # Changed since: start from the beginning without asking for the old range first
+                    self.log_message(f"{state['filename']} changed on the server, downloading it again")
+                    self.discard_download(part_path, state_path)
+            self.log_message(f"Resuming download: {state['filename']}")
+            self.run_download(state["filename"], state["save_path"])
+
+    def schedule_reconnect(self, attempt=1):
+        # Retry with a growing delay on the Tk loop, so the window stays responsive meanwhile
+        if self.connected or self.server_address is None:
+            return
+        if attempt > self.reconnect_attempts:
+            self.log_message("Could not reconnect, partial downloads are kept for the next connection.", "ERROR")
+            return
+        delay = min(2 ** attempt, 30)
+        self.log_message(f"Reconnecting in {delay} seconds (attempt {attempt}/{self.reconnect_attempts})...")
+        self.root.after(delay * 1000, self.try_reconnect, attempt)
+
+    def try_reconnect(self, attempt):
+        if self.connected:
+            return
+        try:
+            self.open_connection(*self.server_address)
+        except Exception as e:
+            self.log_message(f"Reconnect failed: {str(e)}", "ERROR")
+            self.cleanup_connection()
+            self.schedule_reconnect(attempt + 1)
+            return
+        self.resume_uploads()
+        self.resume_downloads()
+
     def setup_gui(self):
         # Set the window dimensions and minimum size
         self.root.geometry("800x600")
@@ -203,7 +474,8 @@ class FileClient:
         for i, (label, default) in enumerate([
             ("Server IP:", ""),  # Default to an empty string
             ("Port:", ""),       # Default to an empty string
-            ("Username:", "")
+            ("Username:", ""),
+            ("Streams:", "4")    # Parallel connections for large transfers
         ]):
             # Create label and entry for each server detail
             ttk.Label(connection_frame, text=label).grid(row=i, column=0, padx=5, pady=5, sticky="w")
@@ -278,59 +550,99 @@ class FileClient:
             # Get server IP, port, and username from the input fields
             ip = self.entries["Server IP:"].get()
             port = int(self.entries["Port:"].get())
-            self.username = self.entries["Username:"].get()
+            username = self.entries["Username:"].get()
             
              # Ensure the username is not empty
-            if not self.username:
+            if not username:
                 self.log_message("Username cannot be empty!", "ERROR")
                 return
+            if username != self.username or (ip, port) != self.server_address:
+                self.resume_token = None  # The token only belongs to the previous identity
+                self.listing.clear()
+            self.username = username
             
-            # Create a socket and connect to the server
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)  # Set a 10-second timeout for the connection attempt
-            self.socket.connect((ip, port))
-            
-            # Send the username to the server
-            self.socket.send(self.username.encode())
-            response = self.socket.recv(1024).decode()
-            
-            # Handle error responses from the server
-            if response.startswith("ERROR"):
-                raise Exception(response)
-            
-            # Set the connection status to True if connection is successful
-            self.connected = True
-             # Update the connect button to show that the client is connected
-            self.connect_button.config(text="Connected", state="disabled")
-            
-            # Enable file operation buttons since the client is now connected
-            for button in self.operation_buttons:
-                button.config(state=tk.NORMAL)
-            
-            # Disable entry fields to prevent changes after connection
-            for entry in self.entries.values():
-                entry.config(state="disabled")
-            
-            # Log the successful connection message
-            self.log_message(response)
+            self.open_connection(ip, port)
 
         # Handle various connection errors   
         except socket.timeout as e:
             # Log timeout errors if the server does not respond in time
             self.log_message(f"Connection timeout: {str(e)}", "ERROR")
             self.cleanup_connection()
+            return
         except socket.error as e:
             # Log socket errors that may occur during connection attempts
             self.log_message(f"Socket error: {str(e)}", "ERROR")
             self.cleanup_connection()
+            return
         except ValueError as e:
             # Log errors related to invalid port numbers
             self.log_message(f"Invalid port number: {str(e)}", "ERROR")
             self.cleanup_connection()
+            return
         except Exception as e:
             # Log any other exceptions that occur
             self.log_message(f"Connection error: {str(e)}", "ERROR")
             self.cleanup_connection()
+            return
+
+        # Continue the transfers an earlier connection left unfinished
+        self.resume_uploads()
+        self.resume_downloads()
+
+    def open_connection(self, ip, port):
+        # Connect and log in as self.username; raises on failure
+        # Create a socket and connect to the server
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(10)  # Set a 10-second timeout for the connection attempt
+        self.socket.connect((ip, port))
+        # A command frame and the DATA frame after it must not wait for the server's delayed ACK
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        enable_keepalive(self.socket)  # A server that vanished is noticed even while idle
+        
+        # From now on only the reader thread of the channel receives from the socket
+        self.conn = ClientChannel(self.socket, self.events)
+        self.conn.start()
+        
+        # Send the username to the server in a HELLO frame, with the token of an earlier session
+        self.conn.open_request(0)
+        self.conn.send_message(OP_HELLO, 0, username=self.username, token=self.resume_token,
+                               compression=compression.PREFERENCE)
+        self.conn.timeout = 10  # Same limit as the connection attempt
+        reply = self.conn.recv_reply(0)
+        self.conn.timeout = 600  # Large files may take a while between two frames
+        self.conn.close_request(0)
+        fields = reply.fields()
+        response = fields.get("message", "")
+        
+        # Handle error responses from the server
+        if reply.opcode == OP_ERROR:
+            raise Exception(response)
+        
+        # Remember what the server supports, e.g. chunk deduplication
+        self.features = fields.get("features") or {}
+        self.resume_token = fields.get("token")
+        # DATA frames are compressed from now on if the server picked one of our codecs
+        self.conn.codec = compression.get_codec(fields.get("compression"))
+        self.server_address = (ip, port)
+        
+        # Set the connection status to True if connection is successful
+        self.connected = True
+         # Update the connect button to show that the client is connected
+        self.connect_button.config(text="Connected", state="disabled")
+        
+        # Enable file operation buttons since the client is now connected
+        for button in self.operation_buttons:
+            button.config(state=tk.NORMAL)
+        
+        # Disable entry fields to prevent changes after connection
+        for entry in self.entries.values():
+            entry.config(state="disabled")
+        
+        # Log the successful connection message
+        self.log_message(response)
+        
+        # Bring the cached file list up to date, the pickers use it from now on
+        self.watch_listing()
 
 
     def cleanup_connection(self):
@@ -340,12 +652,13 @@ class FileClient:
         # Close the socket if it is open
         if self.socket:
             try:
-                self.socket.close()
+                (self.conn or self.socket).close()
             except Exception as e:
                 # Log any errors that occur while closing the socket
                 self.log_message(f"Error: {str(e)}", "ERROR")
             # Set socket to None to mark it as closed
             self.socket = None
+            self.conn = None
         
         # Reset GUI components to allow reconnection
         self.connect_button.config(text="Connect", state="normal")
@@ -370,78 +683,362 @@ class FileClient:
         # Return the size formatted to 2 decimal places with the appropriate unit
         return f"{size:.2f} {units[unit]}"
 
-    def safe_send(self, socket, message, retries=3, timeout=10.0):
-        # Store the original socket timeout to restore later
-        original_timeout = socket.gettimeout()
-        socket.settimeout(timeout)
-
-        try:
-            # Attempt to send the message a specified number of retries
-            for attempt in range(retries):
+    def send_request(self, opcode, **fields):
+        # Send a command frame under a fresh request id and return that id
+        # The reply route exists before the command leaves, so no frame of it can be missed
+        request_id = next(self.request_ids)
+        self.conn.open_request(request_id)
+        self.conn.send_message(opcode, request_id, **fields)
+        return request_id
+
+    @contextlib.contextmanager
+    def exchange(self):
+        # Hold the connection for one operation. Requests still open when the outermost
+        # block ends were abandoned: they are closed, so the reader drops their late frames.
+        with self.request_lock:
+            self.exchange_depth += 1
+            try:
+                yield
+            finally:
+                self.exchange_depth -= 1
+                if not self.exchange_depth and self.conn is not None:
+                    self.conn.close_requests()
+
+    def receive_response(self, request_id):
+        # Wait for the reply to request_id; an ERROR frame is raised as an exception
+        frame = self.conn.recv_reply(request_id)
+        fields = frame.fields()
+        if frame.opcode == OP_ERROR:
+            raise Exception(fields.get("message", "ERROR"))
+        return fields
+
+    def pipeline(self, requests):
+        # Send (opcode, fields) requests back to back, then collect their replies: n requests
+        # cost one round trip instead of n. Returns per request, in order, its reply fields or
+        # the exception of its ERROR reply. A lost connection is raised.
+        with self.exchange():
+            request_ids = [self.send_request(opcode, **fields) for opcode, fields in requests]
+            replies = []
+            for request_id in request_ids:
                 try:
-                    # Convert the message to bytes if it is a string
-                    if isinstance(message, str):
-                        message = message.encode()
-                    # Send the entire message using socket.sendall()
-                    socket.sendall(message) # Return True if send is successfu
-                    return True
-                except socket.timeout as e:
-                     # If timeout occurs, check remaining attempts
-                    remaining = retries - attempt - 1
-                    if remaining > 0:
-                        # Log a warning and retry after waiting
-                        self.log_message(f"Sending timeout - {remaining} deneme kaldı", "WARNING")
-                        time.sleep(min(2 ** attempt, 5))  # Exponential backoff, max wait of 5 seconds
-                    else:
-                        # Log warning if last send fails
-                        self.log_message("Last send failed", "WARNING")
+                    replies.append(self.receive_response(request_id))
+                except (ConnectionError, socket.timeout):
+                    raise
                 except Exception as e:
-                     # Log any other sending errors
-                    self.log_message(f"Sending error: {str(e)}", "ERROR")
-                    break
-            # Return False if all send attempts fail
+                    replies.append(e)
+            return replies
+
+    def batched(self, opcode, filenames):
+        # One batch command per max_items files, all of them pipelined; returns the results
+        size = self.features["batch"]["max_items"]
+        results = []
+        for reply in self.pipeline([(opcode, {"filenames": filenames[start:start + size]})
+                                    for start in range(0, len(filenames), size)]):
+            if isinstance(reply, Exception):
+                raise reply
+            results.extend(reply["results"])
+        return results
+
+    def delete_files(self, filenames):
+        # Delete files in as few round trips as possible; returns (filename, ok, message) per file
+        if self.features.get("batch"):
+            return [(item["filename"], item["ok"], item["message"])
+                    for item in self.batched(OP_MULTI_DELETE, filenames)]
+        # Servers without batch commands still get all the DELETEs in one go
+        replies = self.pipeline([(OP_DELETE, {"filename": filename}) for filename in filenames])
+        return [(filename, not isinstance(reply, Exception),
+                 str(reply) if isinstance(reply, Exception) else reply.get("message", ""))
+                for filename, reply in zip(filenames, replies)]
+
+    def stat_files(self, filenames):
+        # {filename: entry dict} of the files that exist on the server, in one round trip per
+        # batch; None when the server has no batch commands
+        if not self.features.get("batch"):
+            return None
+        return {item["filename"]: item for item in self.batched(OP_MULTI_STAT, filenames) if item["ok"]}
+
+    def show_notification(self, fields):
+        # The server folds repeated notifications into one frame with a count
+        message = fields.get('message', '')
+        count = fields.get('count', 1)
+        self.log_message(f"Notification: {message}" + (f" (x{count})" if count > 1 else ""))
+
+    def fetch_file_list(self, owner=None, prefix=""):
+        # Ask the server for the stored files page by page; returns a list of entry dicts
+        # with name, owner, size, mtime and hash
+        entries = []
+        cursor = None
+        with self.exchange():
+            while True:
+                request_id = self.send_request(
+                    OP_LIST, owner=owner, prefix=prefix, cursor=cursor, limit=self.list_page_size
+                )
+                page = self.receive_response(request_id)
+                entries.extend(page.get("entries", []))
+                cursor = page.get("next_cursor")
+                if not cursor:
+                    return entries
+
+    def listed_files(self, owner=None):
+        # The cached file list when it is in step with the server, otherwise LIST pages
+        entries = self.listing.list(owner)
+        return entries if entries is not None else self.fetch_file_list(owner=owner)
+
+    def watch_listing(self):
+        # Ask the server to push the changes of the file list, then bring the cache up to date:
+        # after a reconnect only the changes missed meanwhile arrive, the first time (or after
+        # a server restart) the whole list is loaded. Changes pushed during the load are held
+        # by the cache and applied afterwards.
+        if "watch" not in self.features:
+            self.listing.clear()
+            return
+        for _ in range(3):
+            if not self.listing.begin_load():
+                return  # Another thread is loading it already
+            try:
+                with self.exchange():
+                    request_id = self.send_request(OP_WATCH, epoch=self.listing.epoch,
+                                                   sequence=self.listing.sequence)
+                    reply = self.receive_response(request_id)
+                entries = None if reply.get("resumed") else self.fetch_file_list()
+                in_step = self.listing.finish_load(reply["epoch"], reply["sequence"], entries)
+            except Exception as e:
+                self.listing.abort_load()
+                self.log_message(f"File list could not be cached: {str(e)}", "ERROR")
+                return
+            if in_step:
+                return
+
+    def chunk_hashes(self, filepath, chunk_size):
+        # SHA-256 of every fixed-size chunk, the way a dedup store cuts the file
+        hashes = []
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hashes.append(hashlib.sha256(chunk).hexdigest())
+        return hashes
+
+    def send_file_content(self, opcode, filepath, **fields):
+        # Send an UPLOAD or UPDATE with the content of filepath and wait for the result.
+        # When the server stores deduplicated chunks, only the chunks it lacks are sent.
+        filesize = os.path.getsize(filepath)
+        if opcode == OP_UPDATE and self.features.get("delta") and filesize >= self.delta_threshold:
+            # Only the blocks that changed since the stored version travel
+            result = self.send_delta_update(filepath, filesize, **fields)
+            if result is not None:
+                return result
+
+        if self.features.get("sessions") and filesize >= self.session_threshold:
+            # Large files go through a resumable session instead
+            return self.upload_in_session(filepath, fields["filename"], update=opcode == OP_UPDATE)
+
+        start_time = time.time()
+        progress = lambda sent, total: self.update_progress(sent, total, start_time)
+        dedup = self.features.get("dedup")
+
+        with self.exchange():
+            if not dedup:
+                request_id = self.send_request(opcode, filesize=filesize, **fields)
+                # Send the file as DATA frames, updating the progress after each one
+                with open(filepath, 'rb') as f:
+                    self.conn.send_stream(request_id, f, filesize, self.chunk_size, progress=progress)
+                return self.receive_response(request_id)
+
+            chunk_size = int(dedup["chunk_size"])
+            hashes = self.chunk_hashes(filepath, chunk_size)
+            request_id = self.send_request(opcode, filesize=filesize, chunks=hashes, **fields)
+            # The server answers with the indices of the chunks it does not have yet
+            missing = self.receive_response(request_id)["missing"]
+            total = sum(min(chunk_size, filesize - index * chunk_size) for index in missing)
+            sent = 0
+            with open(filepath, 'rb') as f:
+                for index in missing:
+                    length = min(chunk_size, filesize - index * chunk_size)
+                    f.seek(index * chunk_size)
+                    # Every chunk is its own run of DATA frames
+                    self.conn.send_stream(
+                        request_id, f, length, self.chunk_size,
+                        progress=lambda done, _: progress(sent + done, total)
+                    )
+                    sent += length
+            if filesize > total:
+                self.log_message(f"{self.format_size(filesize - total)} already on the server, skipped")
+            return self.receive_response(request_id)
+
+    def send_delta_update(self, filepath, filesize, **fields):
+        # rsync-style UPDATE: fetch the block signatures of the stored version, match them
+        # against the new file and send only COPY references and literal bytes.
+        # Returns None when the delta would not be much smaller than the file itself.
+        with self.exchange():
+            request_id = self.send_request(OP_SIGNATURE, filename=fields["filename"])
+            info = self.receive_response(request_id)
+            signature = io.BytesIO()
+            self.conn.receive_stream(request_id, signature, info["length"])
+
+        block_size = info["block_size"]
+        ops = delta.compute_delta(filepath, signature.getvalue(), block_size, info["filesize"],
+                                  max_literal=int(filesize * self.delta_ratio))
+        if ops is None:
+            self.log_message("Most of the file changed, sending it whole")
+            return None
+        length = delta.encoded_size(ops)
+
+        start_time = time.time()
+        with self.exchange():
+            request_id = self.send_request(
+                OP_UPDATE, filesize=filesize, hash=file_sha256(filepath),
+                delta={"base_size": info["filesize"], "base_mtime": info["mtime"],
+                       "block_size": block_size, "length": length},
+                **fields
+            )
+            with open(filepath, 'rb') as f:
+                self.conn.send_stream(
+                    request_id, delta.DeltaReader(ops, f), length, self.chunk_size,
+                    progress=lambda sent, total: self.update_progress(sent, total, start_time)
+                )
+            result = self.receive_response(request_id)
+        self.log_message(f"Delta update: sent {self.format_size(length)} "
+                         f"for {self.format_size(filesize)}")
+        return result
+
+    def upload_in_session(self, filepath, filename, update=False):
+        # Open a resumable upload session and send the file through it. The session is
+        # recorded in pending_uploads.json until it is committed, so a dropped connection
+        # or a restart of either side only costs the chunks that had not arrived yet.
+        filesize = os.path.getsize(filepath)
+        with self.exchange():
+            request_id = self.send_request(
+                OP_SESSION_OPEN, filename=filename, filesize=filesize, update=update,
+                chunk_size=self.features["sessions"].get("chunk_size")
+            )
+            info = self.receive_response(request_id)
+
+        record = {
+            "session": info["session"],
+            "server": list(self.server_address),
+            "filepath": filepath,
+            "filesize": filesize,
+            "mtime": os.path.getmtime(filepath),
+            "target": info["filename"],
+        }
+        pending = self.load_pending_uploads()
+        pending.append(record)
+        self.save_pending_uploads(pending)
+
+        if not self.run_upload_session(record):
+            raise Exception("Connection lost, the upload continues after reconnecting")
+        return {"message": "SUCCESS: File successfully uploaded!"}
+
+    def run_upload_session(self, record):
+        # Send what the session still misses and commit; returns False when the connection dropped
+        try:
+            self.continue_upload(record)
+            return True
+        except (ConnectionError, socket.timeout) as e:
+            self.log_message(f"Upload interrupted: {str(e)}", "ERROR")
+            self.cleanup_connection()
+            self.schedule_reconnect()
             return False
-        finally:
-            # Restore the original socket timeout
-            socket.settimeout(original_timeout)
 
-    def safe_receive(self, socket, buffer_size=4096, retries=3, timeout=10.0):
-        # Store the original timeout value of the socket to restore it later
-        original_timeout = socket.gettimeout()
-        socket.settimeout(timeout)  # Set a new timeout for the receive operation
-        
+    def continue_upload(self, record):
+        filepath = record["filepath"]
         try:
-            # Attempt to receive data a specified number of times
-            for attempt in range(retries):
-                try:
-                    # Receive data from the socket
-                    data = socket.recv(buffer_size)
-                    if data:
-                        # Decode the data if it is in bytes, otherwise return the data as-is
-                        return data.decode() if isinstance(data, bytes) else data
-                    # Return None if no data is received
-                    return None
-                except socket.timeout as e:
-                    # If a timeout occurs, check remaining attempts
-                    remaining = retries - attempt - 1
-                    if remaining > 0:
-                        # Log a warning and retry after waiting
-                        self.log_message(f"Receiving timeout - {remaining} attempts left", "WARNING")
-                        time.sleep(min(2 ** attempt, 5))  # Exponential backoff, max wait of 5 seconds
-                    else:
-                        # Log a warning if the last receive attempt fails
-                        self.log_message("Last import attempt failed", "WARNING")
-                except Exception as e:
-                    # Log any other error that occurs during receiving
-                    self.log_message(f"Receiving error: {str(e)}", "ERROR")
-                    break
-            # Return None if all attempts to receive data fail
-            return None
-        finally:
-            # Restore the original socket timeout
-            socket.settimeout(original_timeout)
+            changed = (os.path.getsize(filepath) != record["filesize"]
+                       or os.path.getmtime(filepath) != record["mtime"])
+        except OSError:
+            changed = True
+        if changed:
+            # The local file is gone or different, the server drops the session after its TTL
+            self.forget_upload(record)
+            raise Exception(f"{filepath} changed since the upload started, please upload it again")
+
+        start_time = time.time()
+        with self.exchange():
+            request_id = self.send_request(OP_SESSION_STATUS, session=record["session"])
+            try:
+                status = self.receive_response(request_id)
+            except (ConnectionError, socket.timeout):
+                raise
+            except Exception:
+                # Expired or unknown on the server, nothing left to resume
+                self.forget_upload(record)
+                raise
+
+            chunk_size = int(status["chunk_size"])
+            received = set(status["received"])
+            missing = [index for index in range(status["chunks"]) if index not in received]
+            if received:
+                self.log_message(f"Resuming upload of {record['target']}: "
+                                 f"{len(received)}/{status['chunks']} chunks already on the server")
+
+            total = sum(min(chunk_size, record["filesize"] - index * chunk_size) for index in missing)
+            streams = self.parallel_streams()
+            if total >= self.parallel_threshold and streams > 1:
+                # Large remainder: stripe the chunks over several attached connections
+                self.log_message(f"Uploading {record['target']} over {streams} streams...")
+                progress = parallel_transfer.Progress()
+                meter = parallel_transfer.Meter(
+                    progress, total, lambda done, size: self.update_progress(done, size, start_time)
+                )
+                parallel_transfer.parallel_send_chunks(
+                    self.server_address, self.username, self.resume_token, record["session"],
+                    filepath, record["filesize"], chunk_size, missing, streams,
+                    window=self.session_window, progress=progress, poll=self.poll_gui(meter)
+                )
+                missing = []
 
-    
+            # Chunks are pipelined: up to session_window of them wait for their OK at once
+            in_flight = []
+            sent = 0
+            with open(filepath, 'rb') as f:
+                for index in missing:
+                    length = min(chunk_size, record["filesize"] - index * chunk_size)
+                    chunk_request = self.send_request(OP_SESSION_CHUNK, session=record["session"], index=index)
+                    f.seek(index * chunk_size)
+                    self.conn.send_stream(chunk_request, f, length, self.chunk_size)
+                    in_flight.append(chunk_request)
+                    sent += length
+                    self.update_progress(sent, total, start_time)
+                    if len(in_flight) >= self.session_window:
+                        self.receive_response(in_flight.pop(0))
+                for chunk_request in in_flight:
+                    self.receive_response(chunk_request)
+
+            # The server checks the reassembled file against the local hash before storing it
+            request_id = self.send_request(
+                OP_SESSION_COMMIT, session=record["session"], hash=file_sha256(filepath)
+            )
+            self.receive_response(request_id)
+        self.forget_upload(record)
+        self.log_message(f"Upload session committed: {record['target']}")
+
+    def load_pending_uploads(self):
+        try:
+            with open(self.pending_uploads_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def save_pending_uploads(self, pending):
+        with open(self.pending_uploads_file, 'w') as f:
+            json.dump(pending, f)
+
+    def forget_upload(self, record):
+        pending = [r for r in self.load_pending_uploads() if r["session"] != record["session"]]
+        self.save_pending_uploads(pending)
+
+    def resume_uploads(self):
+        # Continue the open upload sessions of this server, called after every (re)connect
+        for record in self.load_pending_uploads():
+            if tuple(record.get("server", ())) != tuple(self.server_address):
+                continue
+            if not self.connected:
+                return
+            self.log_message(f"Resuming upload: {record['target']}")
+            try:
+                if not self.run_upload_session(record):
+                    return
+            except Exception as e:
+                self.log_message(f"File uploading error: {str(e)}", "ERROR")
 
     def update_progress(self, total_processed, total_size, start_time):
         # If the total size is zero, there's nothing to process, so return "0%"
@@ -469,49 +1066,25 @@ class FileClient:
         return status
 
 
-    def check_notifications(self):
-        """
-    It reads messages coming in the form of "NOTIFICATION|..."
-    on the server side at all times and prints them in the log. 
-    We removed the 'if self.is_downloading:' line so that 
-    it can also be read if a notification arrives during downloading.  
-        """
+    def handle_events(self):
+        # Show the notifications and changes the connection reader hands over, and react to a
+        # connection that broke while no request was using it
         while True:
-            if not self.connected:
-                time.sleep(0.1)
-                continue
-
+            event = self.events.get()
             try:
-                # Let's wait for data with 0.1 sec timeout
-                self.socket.settimeout(0.1)
-                data = self.socket.recv(1024)
-                if data:
-                    decoded = data.decode(errors='ignore')
-                    # 1) NOTIFICATION?
-                    if decoded.startswith("NOTIFICATION|"):
-                        _, message = decoded.split("|", 1)
-                        self.log_message(f"Notification: {message}")
-                    else:
-                        # Download chunk or another message?
-                        # This is a complicated situation. If you want to separate the protocol completely, 
-                        # you can put an extra control here.
-                        pass
-
-            except socket.timeout:
-                pass
-            except ConnectionResetError as e:
-                self.log_message(f"Connection reset by peer: {str(e)}", "ERROR")
-                self.cleanup_connection()
-                break
-            except Exception as e:
-                if self.connected:
-                    self.log_message(f"Connection closed: {str(e)}", "ERROR")
+                if event[0] == "notification":
+                    self.show_notification(event[1])
+                elif event[0] == "changes":
+                    # Out of step (missed changes, server restart): load the list again
+                    if not self.listing.apply(event[1]) and self.connected:
+                        threading.Thread(target=self.watch_listing, daemon=True).start()
+                elif event[0] == "closed" and event[1] is self.conn and self.connected:
+                    # A request that was running reports the error itself and may reconnect
+                    self.log_message(f"Connection closed: {event[2]}", "ERROR")
                     self.cleanup_connection()
-                break
-
-            time.sleep(0.1)
+            except Exception as e:
+                self.log_message(f"Event error: {str(e)}", "ERROR")
 
-            
     def upload_file(self):
         # Check if the client is connected to the server
         if not self.connected:
@@ -529,54 +1102,14 @@ class FileClient:
             if not filepath:
                 return
                 
-            # Get the file size and file name
-            filesize = os.path.getsize(filepath)
+            # Get the file name
             filename = os.path.basename(filepath)
             
-            # Send an upload request to the server with the filename and file size
-            if not self.safe_send(self.socket, f"UPLOAD|{filename}|{filesize}"):
-                raise Exception("Upload request cannot send")
-                
             # Log the start of the file upload
             self.log_message(f"File uploading: {filename}")
-            start_time = time.time()  # Track the start time for calculating progress
-            total_sent = 0
-            retry_count = 0
-            max_retries = 3
-            
-            # Open the selected file in binary read mode
-            with open(filepath, 'rb') as f:
-                # Continue sending chunks of the file until the whole file is uploaded or retries are exhausted
-                while total_sent < filesize and retry_count < max_retries:
-                    # Read a chunk of the file, either up to chunk_size or the remaining part of the file
-                    chunk = f.read(min(self.chunk_size, filesize - total_sent))
-                    if not chunk:
-                        break
-                        
-                    try:
-                        # Send the chunk through the socket
-                        self.socket.send(chunk)
-                        total_sent += len(chunk)
-                        # Update the progress based on the amount of data sent
-                        self.update_progress(total_sent, filesize, start_time)
-                        # Reset retry count after a successful send
-                        retry_count = 0
-                    except socket.timeout as e:
-                        # Handle a timeout during sending, retry if not exceeded max retries
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            self.log_message(f"Upload interruption - Retrying ({retry_count}/{max_retries})", "WARNING")
-                            time.sleep(1)  # Wait for a second before retrying
-                        else:
-                            # Raise an exception if the maximum number of retries is reached
-                            raise Exception("Maximum number of retries reached")
             
-            # Receive response from the server about the upload status
-            response = self.safe_receive(self.socket)
-            if not response:
-                raise Exception("No response from server!")
-            if response.startswith("ERROR"):
-                raise Exception(response)
+            # Send the upload request and the content, then wait for the upload status
+            self.send_file_content(OP_UPLOAD, filepath, filename=filename)
             
             # Log successful upload completion
             self.log_message(f"File uploading completed: {filename}")
@@ -595,21 +1128,15 @@ class FileClient:
             return
         
         try:
-            # Send the list request to the server
-            if not self.safe_send(self.socket, "LIST"):
-                raise Exception("Failed to send list request to server.")
-            
-            # Receive the server's response
-            response = self.safe_receive(self.socket)
-            if response is None:
-                raise Exception("No response from server")
+            # The cached file list, the server is only asked when it is not in step
+            files = self.listed_files()
             
             # Log the list of files available on the server
             self.log_message("\n=== Files in Server ===")
-            files = response.split('\n')
-            for file in files:
-                if file.strip():  # Check for non-empty lines and log them
-                    self.log_message(file.strip())
+            if not files:
+                self.log_message("There is no file in server.")
+            for entry in files:
+                self.log_message(f"{entry['name']} ({entry['owner']}, {self.format_size(entry['size'])})")
                     
         except Exception as e:
             # Log any errors that occur during the listing process
@@ -623,12 +1150,11 @@ class FileClient:
             return
         
         try:
-            # Send a request to the server to list all available files
-            self.socket.send("LIST".encode())
-            response = self.socket.recv(4096).decode()
+            # All available files, from the cached list
+            files = self.listed_files()
             
             # If no files are available, log a message and return
-            if "There is no file in server." in response:
+            if not files:
                 self.log_message("There is no file in server.")
                 return
             
@@ -652,17 +1178,17 @@ class FileClient:
             scrollbar = ttk.Scrollbar(file_frame)
             scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
             
-            listbox = tk.Listbox(file_frame, yscrollcommand=scrollbar.set)
+            # Several files can be selected and are deleted with one request
+            listbox = tk.Listbox(file_frame, yscrollcommand=scrollbar.set, selectmode=tk.EXTENDED)
             listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
             
             scrollbar.config(command=listbox.yview)
             
             # Add all files to the listbox and highlight user's own files in blue
-            files = [f.strip() for f in response.split('\n') if f.strip()]
-            for file in files:
-                listbox.insert(tk.END, file)
+            for entry in files:
+                listbox.insert(tk.END, entry["name"])
                 # Highlight user's own files in blue
-                if file.startswith(f"{self.username}_"):
+                if entry["owner"] == self.username:
                     listbox.itemconfig(listbox.size() - 1, {'fg': 'blue'})
             
             # Function to handle file deletion
@@ -672,20 +1198,21 @@ class FileClient:
                     self.log_message("Please choose a file!")
                     return
                 
-                # Get the selected file and close the file selection window
-                selected_file = listbox.get(listbox.curselection())
+                # Get the selected files and close the file selection window
+                selected_files = [listbox.get(index) for index in listbox.curselection()]
                 file_window.destroy()
                 
-                # Send the delete request to the server and log the request
-                self.log_message(f"File deleting request sending: {selected_file}")
-                self.socket.send(f"DELETE|{selected_file}".encode())
-                response = self.socket.recv(1024).decode()
-                
-                # Log the response from the server
-                if response.startswith("ERROR"):
-                    self.log_message(response, "ERROR")
-                else:
-                    self.log_message(f"File successfully deleted: {selected_file}")
+                # Send the delete request to the server and log the result of every file
+                self.log_message(f"File deleting request sending: {', '.join(selected_files)}")
+                try:
+                    for filename, ok, message in self.delete_files(selected_files):
+                        if ok:
+                            self.log_message(f"File successfully deleted: {filename}")
+                        else:
+                            self.log_message(f"{filename}: {message}", "ERROR")
+                except Exception as e:
+                    # Log the error reply from the server
+                    self.log_message(str(e), "ERROR")
             
             # Create a frame for the delete and cancel buttons
             button_frame = ttk.Frame(file_window)
@@ -707,18 +1234,8 @@ class FileClient:
                 self.log_message("You are not connected to the server!", "ERROR")
                 return
 
-            # Send a request to the server to list all available files
-            self.socket.send("LIST".encode())
-            response = self.safe_receive(self.socket)
-            
-            # If there are no files on the server, log a message and return
-            if not response or "There is no file in server." in response:
-                self.log_message("There is no file in server.")
-                return
-            
-            # Filter the list of files to find the ones owned by the user
-            files = [f.strip() for f in response.split('\n') if f.strip()]
-            user_files = [f for f in files if f.startswith(f"{self.username}_")]
+            # The files owned by the user only
+            user_files = [entry["name"] for entry in self.listed_files(owner=self.username)]
             
             # If the user has no files, log a message and return
             if not user_files:
@@ -767,52 +1284,21 @@ class FileClient:
                 if not new_file:
                     return
                 
-                # Get the size of the new file
-                filesize = os.path.getsize(new_file)
-                
-                # Send an update request to the server
-                if not self.safe_send(self.socket, f"UPDATE|{selected_file}|{os.path.basename(new_file)}|{filesize}"):
-                    raise Exception("Update request could not be sent.")
-                
-                # Log that the update is starting
-                self.log_message(f"Updating files: {selected_file}")
-                start_time = time.time()
-                total_sent = 0
-                retry_count = 0
-                max_retries = 3
-
-                # Open the new file in binary mode and send its contents
-                with open(new_file, 'rb') as f:
-                    while total_sent < filesize and retry_count < max_retries:
-                        chunk = f.read(min(self.chunk_size, filesize - total_sent))
-                        if not chunk:
-                            break
-                        
-                        try:
-                            # Send the chunk through the socket
-                            self.socket.send(chunk)
-                            total_sent += len(chunk)
-                             # Update the progress of the upload
-                            self.update_progress(total_sent, filesize, start_time)
-                            retry_count = 0
-                        except socket.timeout:
-                            # Handle socket timeouts by retrying a specified number of times
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                self.log_message(f"Update interruption - Retrying ({retry_count}/{max_retries})", "WARNING")
-                                time.sleep(1)
-                            else:
-                                raise Exception("Maximum number of retries reached.")
-                
-                # Receive the server's response to the update
-                response = self.safe_receive(self.socket)
-                if not response:
-                    raise Exception("No response from server.")
-                if response.startswith("ERROR"):
-                    raise Exception(response)
-                
-                # Log that the file update was completed successfully
-                self.log_message(f"File updating completed: {selected_file}")
+                try:
+                    # Log that the update is starting
+                    self.log_message(f"Updating files: {selected_file}")
+                    
+                    # Send the update request and the new content, then wait for the response
+                    self.send_file_content(
+                        OP_UPDATE, new_file,
+                        filename=selected_file,
+                        new_filename=os.path.basename(new_file)
+                    )
+                    
+                    # Log that the file update was completed successfully
+                    self.log_message(f"File updating completed: {selected_file}")
+                except Exception as e:
+                    self.log_message(f"File updating error: {str(e)}", "ERROR")
             
             # Create a frame for the update and cancel buttons
             button_frame = ttk.Frame(file_window)
@@ -831,8 +1317,9 @@ class FileClient:
         # If currently connected, send EXIT command and close the socket
         if self.connected and self.socket:
             try:
-                self.socket.send("EXIT".encode())
-                self.socket.close()
+                with self.request_lock:
+                    self.conn.send_frame(OP_EXIT)
+                    self.conn.close()
             except Exception as e:
                 self.log_message(f"Error while disconnecting: {str(e)}", "ERROR")
             
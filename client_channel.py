@@ -0,0 +1,165 @@
+"""
+Client end of a connection with one reader thread.
+
+Only the reader thread receives from the socket. It parses every frame and routes it:
+frames of a request go to the queue of that request id, notifications and listing changes
+(request id 0) go to an event queue the client consumes. Requests wait on their own queue,
+so nothing polls the socket and no request can read bytes that belong to another one or
+to a notification.
+"""
+import queue
+import socket
+import threading
+
+from protocol import (
+    FrameSocket, ProtocolError, OP_NOTIFICATION, OP_CHANGES, OP_PING, OP_PONG, OP_ERROR, OP_DATA, FLAG_COMPRESSED,
+    MAX_MESSAGE_SIZE,
+)
+
+MAX_BUFFERED = 32 * 1024 * 1024  # Payload bytes the reader queues before it waits for the requests to catch up
+
+
+class ClientChannel(FrameSocket):
+    """
+    FrameSocket whose receiving side is a demultiplexing reader thread.
+    open_request(request_id) must be called before the request is sent; recv_reply and
+    receive_stream then take the frames of that id from its queue. Frames of ids nobody
+    opened (late replies of abandoned requests) are dropped. events receives
+    ("notification", fields), ("changes", fields) and, when the connection breaks,
+    ("closed", channel, error).
+    """
+
+    def __init__(self, sock, events, timeout=600):
+        super().__init__(sock)
+        self.events = events
+        self.timeout = timeout  # Seconds a request waits for its next frame before it gives up
+        self.routes = {}  # request id -> queue.Queue of frames
+        self.route_lock = threading.Lock()
+        self.buffered = 0  # Payload bytes sitting in the route queues
+        self.buffer_cond = threading.Condition()
+        self.error = None  # Why the reader stopped
+        self.closing = False  # The client closed the connection itself
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+
+    def start(self):
+        self.sock.settimeout(None)  # Only the reader blocks on the socket, it waits as long as it takes
+        self.reader.start()
+
+    def close(self):
+        self.closing = True  # Set before the reader wakes up, so it does not report a lost connection
+        super().close()
+
+    # ---- routing ---------------------------------------------------------
+
+    def open_request(self, request_id):
+        with self.route_lock:
+            if self.error is not None:
+                raise ConnectionError(self.error)
+            self.routes[request_id] = queue.Queue()
+
+    def close_request(self, request_id):
+        # Forget a request, frames still queued or arriving later for it are dropped
+        with self.route_lock:
+            route = self.routes.pop(request_id, None)
+        if route is not None:
+            while True:
+                try:
+                    self.release(route.get_nowait())
+                except queue.Empty:
+                    break
+
+    def close_requests(self):
+        with self.route_lock:
+            request_ids = list(self.routes)
+        for request_id in request_ids:
+            self.close_request(request_id)
+
+    def read_loop(self):
+        error = "Connection closed by peer"
+        try:
+            while True:
+                frame = self.read_frame(MAX_MESSAGE_SIZE)
+                if frame is None:
+                    break
+                if frame.request_id == 0 and frame.opcode == OP_NOTIFICATION:
+                    self.events.put(("notification", frame.fields()))
+                    continue
+                if frame.request_id == 0 and frame.opcode == OP_CHANGES:
+                    self.events.put(("changes", frame.fields()))
+                    continue
+                if frame.opcode == OP_PING:
+                    # Answered through the outbox, the reader never waits for the send lock
+                    self.post(OP_PONG)
+                    continue
+                with self.route_lock:
+                    route = self.routes.get(frame.request_id)
+                if route is None:
+                    continue  # Reply of a request that was given up
+                self.reserve(len(frame.payload))
+                route.put(frame)
+        except (OSError, ProtocolError) as e:
+            error = str(e) or error
+        # Wake every waiting request, and tell the client unless it closed the connection itself
+        with self.route_lock:
+            self.error = error
+            routes = list(self.routes.values())
+        for route in routes:
+            route.put(None)
+        with self.buffer_cond:
+            self.buffer_cond.notify_all()
+        if not self.closing:
+            self.events.put(("closed", self, error))
+
+    def reserve(self, size):
+        # Back-pressure: the reader stops receiving while too much is waiting to be consumed
+        with self.buffer_cond:
+            while self.buffered and self.buffered + size > MAX_BUFFERED and not self.closing:
+                self.buffer_cond.wait()
+            self.buffered += size
+
+    def release(self, frame):
+        if frame is None:
+            return
+        with self.buffer_cond:
+            self.buffered -= len(frame.payload)
+            self.buffer_cond.notify_all()
+
+    # ---- receiving, from the request threads -------------------------------
+
+    def recv_reply(self, request_id, max_payload=MAX_MESSAGE_SIZE):
+        # Next frame of request_id, waiting at most self.timeout seconds for it
+        with self.route_lock:
+            route = self.routes.get(request_id)
+            if route is None:
+                raise ConnectionError(self.error or f"Request {request_id} is not open")
+        try:
+            frame = route.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout(f"No reply from the server in {self.timeout} seconds")
+        if frame is None:
+            route.put(None)  # Keep the request failing on later calls too
+            raise ConnectionError(self.error)
+        self.release(frame)
+        if len(frame.payload) > max_payload:
+            raise ProtocolError(f"Frame too large: {len(frame.payload)} bytes ({frame.name})")
+        return frame
+
+    def receive_stream(self, request_id, fileobj, size, progress=None, buffer=None):
+        # Write the DATA frames of request_id to fileobj until size bytes arrived
+        received = 0
+        while received < size:
+            frame = self.recv_reply(request_id)
+            if frame.opcode == OP_ERROR:
+                raise ProtocolError(frame.fields().get("message", "Transfer failed"))
+            if frame.opcode != OP_DATA:
+                raise ProtocolError(f"Unexpected {frame.name} frame during transfer")
+            payload = frame.payload
+            if frame.flags & FLAG_COMPRESSED:
+                payload = self.decompress(payload, size - received)
+            if len(payload) > size - received:
+                raise ProtocolError("DATA frame exceeds the announced size")
+            fileobj.write(payload)
+            received += len(payload)
+            if progress:
+                progress(received, size)
+        return received
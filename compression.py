@@ -0,0 +1,168 @@
+"""
+Compression of DATA frames and stored chunks.
+
+The codec is negotiated in the HELLO exchange: the client lists the codecs it has in order
+of preference, the server picks the first one it also allows and both sides set it on the
+connection. DATA frames are then compressed one by one and flagged with FLAG_COMPRESSED;
+a frame that would not shrink is sent as is, and a stream that keeps failing to shrink
+(or starts with the signature of a compressed format) stops trying. zlib and lzma come
+with Python, zstd is used when the zstandard package is installed.
+"""
+import lzma
+import zlib
+
+try:
+    import zstandard  # Optional
+except ImportError:
+    zstandard = None
+
+
+MIN_SAVING = 0.1  # A frame is only sent compressed when it shrinks by at least this share
+MAX_MISSES = 2  # Frames in a row that did not shrink before a stream stops compressing
+SAMPLE_SIZE = 64  # Bytes looked at to recognise an already compressed format
+
+# Leading bytes of formats that are compressed already (archives, images, audio, video)
+COMPRESSED_SIGNATURES = (
+    b"\x1f\x8b",  # gzip
+    b"PK\x03\x04",  # zip, docx, xlsx, jar, apk
+    b"\xfd7zXZ\x00",  # xz
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"BZh",  # bzip2
+    b"7z\xbc\xaf\x27\x1c",  # 7-Zip
+    b"Rar!\x1a\x07",  # rar
+    b"\x89PNG\r\n\x1a\n",  # png
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF87a", b"GIF89a",  # gif
+    b"OggS",  # ogg
+    b"fLaC",  # flac
+    b"ID3",  # mp3
+    b"\x04\x22\x4d\x18",  # lz4
+)
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def __init__(self, level=1):
+        self.level = level  # Fast by default, text still shrinks several times
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, limit):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, limit)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Compressed frame is corrupt or larger than announced")
+        return result
+
+
+class LzmaCodec:
+    name = "lzma"
+
+    def __init__(self, preset=0):
+        self.preset = preset
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data, limit):
+        decompressor = lzma.LZMADecompressor()
+        try:
+            result = decompressor.decompress(data, limit)
+        except lzma.LZMAError as e:
+            raise ValueError(f"Compressed frame is corrupt: {str(e)}")
+        if not decompressor.eof:
+            raise ValueError("Compressed frame is corrupt or larger than announced")
+        return result
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self, level=3):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data, limit):
+        try:
+            return self.decompressor.decompress(data, max_output_size=limit)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Compressed frame is corrupt or larger than announced: {str(e)}")
+
+
+CODECS = {"zlib": ZlibCodec(), "lzma": LzmaCodec()}
+if zstandard is not None:
+    CODECS["zstd"] = ZstdCodec()
+
+# Preference of a client that was not told otherwise: fast codecs first, lzma is slow on the wire
+PREFERENCE = [name for name in ("zstd", "zlib", "lzma") if name in CODECS]
+
+
+def get_codec(name):
+    # Codec by name; None for no compression or an unknown name
+    return CODECS.get(name) if name else None
+
+
+def storage_codec(name):
+    # Codec for files at rest: written once and sent many times, so worth a slower, stronger level.
+    # The output is read by the wire codec of the same name.
+    if not name:
+        return None
+    if name == "zlib":
+        return ZlibCodec(level=6)
+    if name == "lzma":
+        return LzmaCodec(preset=6)
+    if name == "zstd" and zstandard is not None:
+        return ZstdCodec(level=10)
+    raise ValueError(f"Unknown compression codec: {name}")
+
+
+def negotiate(offered, allowed):
+    # First codec of the client's list the server allows, None when there is no common one
+    for name in offered or []:
+        if name in allowed and name in CODECS:
+            return CODECS[name]
+    return None
+
+
+def looks_compressed(data):
+    # True for content that starts like an already compressed file format
+    head = bytes(data[:SAMPLE_SIZE])
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return True
+    # mp4/mov/heic: a box size followed by "ftyp"; webp/avi: a RIFF container
+    return head[4:8] == b"ftyp" or (head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"AVI "))
+
+
+class FrameCompressor:
+    """
+    Compresses the DATA frames of one stream. pack(data) returns (compressed, payload);
+    compression is given up for the rest of the stream when the content is recognised as
+    compressed already or MAX_MISSES frames in a row did not shrink by MIN_SAVING.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.enabled = True
+        self.first = True
+        self.misses = 0
+
+    def pack(self, data):
+        if self.first:
+            self.first = False
+            if looks_compressed(data):
+                self.enabled = False
+        if not self.enabled:
+            return False, data
+        payload = self.codec.compress(data)
+        if len(payload) <= len(data) * (1 - MIN_SAVING):
+            self.misses = 0
+            return True, payload
+        self.misses += 1
+        if self.misses >= MAX_MISSES:
+            self.enabled = False
+        return False, data
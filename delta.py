@@ -0,0 +1,258 @@
+"""
+rsync-style delta transfer for UPDATE.
+
+The server cuts its current version into blocks and sends a signature: a weak rolling
+checksum (Adler-32) and a strong hash (BLAKE2b, 16 bytes) per block. The client slides a
+window over the new file, rolling the weak checksum one byte at a time, and wherever a
+window matches a block by both hashes it refers to that block instead of sending it.
+The result is a stream of COPY (first block, count) and LITERAL (length, bytes) records;
+the server rebuilds the new version from its old blocks and the literals. Collisions of
+the block hashes are caught by the SHA-256 of the whole file, checked before the swap.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 64 * 1024
+ADLER_MOD = 65521
+
+SIGNATURE_RECORD = struct.Struct("!I16s")  # Weak checksum, strong hash of one block
+COPY_RECORD = struct.Struct("!cII")  # b"C", first block, block count
+LITERAL_RECORD = struct.Struct("!cI")  # b"L", length, followed by that many bytes
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+MAX_LITERAL = 1 << 30  # Longer literal runs are split into several records
+READ_SIZE = 1024 * 1024  # Bytes read at once when hashing or copying blocks
+
+
+def block_size_for(size):
+    # About sqrt(size) like rsync, in whole KiB: few blocks for big files, small ones for small files
+    block_size = int(size ** 0.5) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(block_size, MAX_BLOCK_SIZE))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signature(snapshot, block_size):
+    # Signature records of every block of a FileSnapshot, the last block may be shorter
+    records = []
+    batch = max(1, READ_SIZE // block_size) * block_size
+    for offset in range(0, snapshot.size, batch):
+        data = memoryview(snapshot.read(offset, batch))
+        for start in range(0, len(data), block_size):
+            block = data[start:start + block_size]
+            records.append(SIGNATURE_RECORD.pack(zlib.adler32(block), strong_hash(block)))
+    return b"".join(records)
+
+
+def compute_delta(path, signature_data, block_size, base_size, max_literal=None):
+    """
+    Match the file at path against the signature of a base_size byte version. Returns a
+    list of ("C", first, count) and ("L", offset, length) operations that rebuild the file,
+    literals referring to byte ranges of path. Returns None as soon as more than
+    max_literal bytes would have to be sent as literals.
+    """
+    blocks = [SIGNATURE_RECORD.unpack_from(signature_data, offset)
+              for offset in range(0, len(signature_data), SIGNATURE_RECORD.size)]
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return match_blocks(data, size, blocks, block_size, base_size, max_literal)
+
+
+def match_blocks(data, size, blocks, block_size, base_size, max_literal=None):
+    ops = []
+    limit = size if max_literal is None else max_literal
+    literal_total = 0
+    literal_start = 0
+
+    def add_literal(end):
+        nonlocal literal_total
+        if end > literal_start:
+            ops.append(("L", literal_start, end - literal_start))
+            literal_total += end - literal_start
+
+    def add_copy(index):
+        if ops and ops[-1][0] == "C" and ops[-1][1] + ops[-1][2] == index:
+            ops[-1] = ("C", ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(("C", index, 1))
+
+    # A short last block can only match the very end of the new file, it is checked separately
+    tail_length = base_size - (len(blocks) - 1) * block_size if blocks else block_size
+    full_blocks = len(blocks) if tail_length == block_size else len(blocks) - 1
+    table = {}  # Weak checksum -> indices of the full-size blocks that have it
+    for index in range(full_blocks):
+        table.setdefault(blocks[index][0], []).append(index)
+
+    position = 0
+    while position + block_size <= size:
+        checksum = zlib.adler32(data[position:position + block_size])
+        a, b = checksum & 0xffff, checksum >> 16
+        match = None
+        # Roll the window one byte at a time until a block matches or the data ends
+        while True:
+            indices = table.get((b << 16) | a)
+            if indices:
+                digest = strong_hash(data[position:position + block_size])
+                match = next((i for i in indices if blocks[i][1] == digest), None)
+                if match is not None:
+                    break
+            if position + block_size >= size:
+                break
+            if literal_total + position - literal_start >= limit:
+                return None
+            old, new = data[position], data[position + block_size]
+            a = (a - old + new) % ADLER_MOD
+            b = (b - block_size * old + a - 1) % ADLER_MOD
+            position += 1
+        if match is None:
+            break
+        add_literal(position)
+        add_copy(match)
+        position += block_size
+        literal_start = position
+
+    end = size
+    if full_blocks < len(blocks) and size - literal_start >= tail_length:
+        weak, digest = blocks[-1]
+        tail = data[size - tail_length:size]
+        if zlib.adler32(tail) == weak and strong_hash(tail) == digest:
+            end = size - tail_length
+    add_literal(end)
+    if end < size:
+        add_copy(len(blocks) - 1)
+    if literal_total > limit:
+        return None
+    return ops
+
+
+def encoded_size(ops):
+    # Bytes of the delta stream that DeltaReader produces for ops
+    total = 0
+    for op in ops:
+        if op[0] == "C":
+            total += COPY_RECORD.size
+        else:
+            pieces = (op[2] + MAX_LITERAL - 1) // MAX_LITERAL
+            total += pieces * LITERAL_RECORD.size + op[2]
+    return total
+
+
+def literal_size(ops):
+    return sum(op[2] for op in ops if op[0] == "L")
+
+
+class DeltaReader:
+    # File-like source for send_stream: encodes ops, reading the literals from fileobj
+    def __init__(self, ops, fileobj):
+        self.ops = iter(ops)
+        self.fileobj = fileobj
+        self.header = b""
+        self.literal = 0  # Literal bytes of the current record still to be read from fileobj
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if self.header:
+                part, self.header = self.header[:size], self.header[size:]
+            elif self.literal:
+                part = self.fileobj.read(min(size, self.literal))
+                if not part:
+                    raise ValueError("File changed while the delta was being sent")
+                self.literal -= len(part)
+            elif not self.next_record():
+                break
+            else:
+                continue
+            parts.append(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def next_record(self):
+        op = next(self.ops, None)
+        if op is None:
+            return False
+        if op[0] == "C":
+            self.header = COPY_RECORD.pack(OP_COPY, op[1], op[2])
+            return True
+        _, offset, length = op
+        piece = min(length, MAX_LITERAL)
+        if length > piece:
+            # Put the rest back as its own literal record
+            self.ops = iter([("L", offset + piece, length - piece)] + list(self.ops))
+        self.fileobj.seek(offset)
+        self.header = LITERAL_RECORD.pack(OP_LITERAL, piece)
+        self.literal = piece
+        return True
+
+
+class DeltaApplier:
+    """
+    File-like target for receive_stream on the server. Parses the delta records as they
+    arrive and writes the rebuilt content into writer: literals are passed through, COPY
+    records are read from the base snapshot. finish() checks the stream ended cleanly.
+    """
+
+    def __init__(self, base, block_size, writer, size):
+        if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+            raise ValueError(f"Invalid block size: {block_size}")
+        self.base = base
+        self.block_size = block_size
+        self.blocks = (base.size + block_size - 1) // block_size
+        self.writer = writer
+        self.size = size  # Announced size of the new version
+        self.written = 0
+        self.header = bytearray()
+        self.literal = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        consumed = len(data)
+        while data:
+            if self.literal:
+                part = data[:self.literal]
+                self.output(part)
+                self.literal -= len(part)
+                data = data[len(part):]
+                continue
+            # Collect a record header, it may be split over two DATA frames
+            op = bytes(self.header[:1] or data[:1])
+            need = COPY_RECORD.size if op == OP_COPY else LITERAL_RECORD.size
+            take = need - len(self.header)
+            self.header += data[:take]
+            data = data[take:]
+            if len(self.header) == need:
+                self.apply_header(bytes(self.header))
+                self.header.clear()
+        return consumed
+
+    def apply_header(self, header):
+        if header[:1] == OP_COPY:
+            _, first, count = COPY_RECORD.unpack(header)
+            if count == 0 or first + count > self.blocks:
+                raise ValueError("Delta refers to blocks outside the current version")
+            offset = first * self.block_size
+            end = min(self.base.size, (first + count) * self.block_size)
+            for start in range(offset, end, READ_SIZE):
+                self.output(self.base.read(start, min(READ_SIZE, end - start)))
+        elif header[:1] == OP_LITERAL:
+            _, self.literal = LITERAL_RECORD.unpack(header)
+        else:
+            raise ValueError("Invalid delta record")
+
+    def output(self, data):
+        self.written += len(data)
+        if self.written > self.size:
+            raise ValueError("Delta produces more data than announced")
+        self.writer.write(data)
+
+    def finish(self):
+        if self.header or self.literal or self.written != self.size:
+            raise ValueError("Delta ended before the file was complete")
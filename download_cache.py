@@ -0,0 +1,217 @@
+"""
+In-memory cache of hot downloads.
+
+Entries are the DATA frames of a whole file as they go on the wire for one codec: a hit
+is sent from memory without opening chunk files, reading or compressing again. The cache
+is bounded in bytes and follows W-TinyLFU: new entries go into a small LRU window, and
+when they fall out of it they only enter the main segmented LRU if a count-min sketch
+says they were asked for more often than the entry they would push out. A file that is
+downloaded once never gets in, so a scan over many cold files cannot flush the hot ones.
+"""
+import collections
+import threading
+
+from protocol import FLAG_COMPRESSED, COMPRESS_CHUNK_SIZE, SENDFILE_CHUNK_SIZE
+from compression import FrameCompressor
+
+WINDOW_SHARE = 0.01  # Share of the budget taken by the admission window
+PROTECTED_SHARE = 0.8  # Share of the main area for entries that were hit again
+ENTRY_OVERHEAD = 256  # Bytes charged per entry on top of its payloads
+MIN_FREQUENCY = 2  # Requests counted by the sketch before a file is built into the cache
+
+
+class FrequencySketch:
+    """
+    Count-min sketch with 4 rows of small saturating counters. Every counter is halved
+    after sample_size increments so old popularity fades away.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+    SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width=4096):
+        self.width = 1 << max(4, (width - 1).bit_length())  # Power of two, indexes are masked
+        self.rows = [bytearray(self.width) for _ in range(self.DEPTH)]
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def indexes(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        mask = self.width - 1
+        return [((h * seed) >> 17) & mask for seed in self.SEEDS]
+
+    def increment(self, key):
+        for row, index in zip(self.rows, self.indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+    def reset(self):
+        # Aging: halve every counter
+        for row in self.rows:
+            row[:] = bytes(count >> 1 for count in row)
+        self.additions //= 2
+
+
+class DownloadCache:
+    """
+    Byte-bounded W-TinyLFU cache of encoded downloads, safe to use from many threads.
+    Keys are (filename, codec name); every entry records the version (size, mtime) it was
+    built from and is only served for that version. Files above max_entry_size bypass it.
+    """
+
+    def __init__(self, max_bytes, max_entry_size=None):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size if max_entry_size is not None else max_bytes // 16
+        self.window_bytes = max(int(max_bytes * WINDOW_SHARE), 1)
+        self.main_bytes = max_bytes - self.window_bytes
+        self.protected_bytes = int(self.main_bytes * PROTECTED_SHARE)
+        # key -> (version, frames, cost), least recently used first
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.sizes = {"window": 0, "probation": 0, "protected": 0}
+        self.variants = {}  # filename -> keys cached for it
+        self.sketch = FrequencySketch(max(64, max_bytes // (64 * 1024)))
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "rejections": 0,
+                         "bypasses": 0, "invalidations": 0}
+
+    def get(self, key, version):
+        # Frames of key if they were built from this version, None otherwise
+        with self.lock:
+            self.sketch.increment(key)
+            for name, segment in (("window", self.window), ("probation", self.probation),
+                                  ("protected", self.protected)):
+                item = segment.get(key)
+                if item is None:
+                    continue
+                if item[0] != version:
+                    # Built from a version that was replaced since, the new one takes its place
+                    self.discard(key)
+                    break
+                self.counters["hits"] += 1
+                if name == "probation":
+                    # Hit again on probation: promote it to the protected segment
+                    del self.probation[key]
+                    self.sizes["probation"] -= item[2]
+                    self.protected[key] = item
+                    self.sizes["protected"] += item[2]
+                    self.demote_protected()
+                else:
+                    segment.move_to_end(key)
+                return item[1]
+            self.counters["misses"] += 1
+            return None
+
+    def wants(self, key, size):
+        # Whether a missed file is worth reading into memory. Called after get().
+        with self.lock:
+            if size > self.max_entry_size:
+                self.counters["bypasses"] += 1
+                return False
+            return self.sketch.frequency(key) >= MIN_FREQUENCY
+
+    def put(self, key, version, frames):
+        cost = sum(len(payload) for _, payload in frames) + ENTRY_OVERHEAD
+        if cost > self.max_entry_size + ENTRY_OVERHEAD:
+            return
+        with self.lock:
+            self.discard(key)
+            self.window[key] = (version, frames, cost)
+            self.sizes["window"] += cost
+            self.variants.setdefault(key[0], set()).add(key)
+            # Entries pushed out of the window compete for a place in the main area
+            while self.sizes["window"] > self.window_bytes:
+                candidate, item = self.window.popitem(last=False)
+                self.sizes["window"] -= item[2]
+                self.admit(candidate, item)
+
+    def invalidate(self, filename):
+        # Drop every cached encoding of filename, after an upload, update or delete
+        with self.lock:
+            for key in list(self.variants.get(filename, ())):
+                self.discard(key)
+                self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.window) + len(self.probation) + len(self.protected)
+            stats["bytes"] = sum(self.sizes.values())
+            stats["max_bytes"] = self.max_bytes
+            return stats
+
+    # The helpers below expect self.lock to be held
+
+    def admit(self, candidate, item):
+        # TinyLFU admission: evict main entries only while the candidate is more popular
+        frequency = self.sketch.frequency(candidate)
+        while self.sizes["probation"] + self.sizes["protected"] + item[2] > self.main_bytes:
+            segment = self.probation or self.protected
+            if not segment:
+                break
+            victim = next(iter(segment))
+            if self.sketch.frequency(victim) >= frequency:
+                self.forget(candidate)
+                self.counters["rejections"] += 1
+                return
+            self.discard(victim)
+            self.counters["evictions"] += 1
+        if item[2] > self.main_bytes:
+            self.forget(candidate)
+            self.counters["rejections"] += 1
+            return
+        self.probation[candidate] = item
+        self.sizes["probation"] += item[2]
+
+    def demote_protected(self):
+        while self.sizes["protected"] > self.protected_bytes and len(self.protected) > 1:
+            key, item = self.protected.popitem(last=False)
+            self.sizes["protected"] -= item[2]
+            self.probation[key] = item
+            self.sizes["probation"] += item[2]
+
+    def discard(self, key):
+        for name, segment in (("window", self.window), ("probation", self.probation),
+                              ("protected", self.protected)):
+            item = segment.pop(key, None)
+            if item is not None:
+                self.sizes[name] -= item[2]
+                self.forget(key)
+                return
+
+    def forget(self, key):
+        keys = self.variants.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.variants[key[0]]
+
+
+def build_frames(snapshot, codec):
+    # DATA frames (flags, payload) of the whole content of a FileSnapshot for a connection
+    # using codec, the way send_file and send_stored would send them
+    frames = []
+    compressor = FrameCompressor(codec) if codec is not None else None
+    for fileobj, file_offset, count, stored in snapshot.stored_segments(0, None, codec):
+        fileobj.seek(file_offset)
+        data = fileobj.read(count)
+        if len(data) != count:
+            raise ValueError("File ended before its recorded size")
+        if stored:
+            frames.append((FLAG_COMPRESSED, data))
+            continue
+        view = memoryview(data)
+        step = COMPRESS_CHUNK_SIZE if compressor else SENDFILE_CHUNK_SIZE
+        for start in range(0, count, step):
+            piece = view[start:start + step]
+            compressed, payload = compressor.pack(piece) if compressor else (False, piece)
+            frames.append((FLAG_COMPRESSED if compressed else 0, payload))
+    return frames
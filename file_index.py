@@ -0,0 +1,258 @@
+import bisect
+import hashlib
+import itertools
+import os
+import threading
+from collections import deque
+
+CHANGE_LOG_SIZE = 100000  # Changes kept for watchers that catch up; one further behind loads the list again
+
+
+class FileEntry:
+    # Metadata of one stored file
+    __slots__ = ("name", "owner", "size", "mtime", "hash", "version", "downloads")
+
+    def __init__(self, name, owner, size, mtime, hash=None, version=1, downloads=0):
+        self.name = name  # Stored file name, "<owner>_<filename>" (see storage.file_name)
+        self.owner = owner  # Username of the uploader
+        self.size = size  # Size in bytes
+        self.mtime = mtime  # Last modification time (epoch seconds)
+        self.hash = hash  # SHA-256 hex digest, None until it has been computed
+        self.version = version  # 1 for the first upload, one more for every update
+        self.downloads = downloads  # Complete downloads so far
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "owner": self.owner,
+            "size": self.size,
+            "mtime": self.mtime,
+            "hash": self.hash,
+            "version": self.version,
+            "downloads": self.downloads,
+        }
+
+
+class HashingWriter:
+    # File wrapper that feeds everything written through it into a SHA-256
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def file_sha256(path, block_size=1024 * 1024):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class FileIndex:
+    """
+    In-memory index of the stored files.
+    Names are kept in sorted lists (one global, one per owner) so a LIST page is a
+    bisect plus a slice: its cost depends on the page size, not on the number of files.
+    Uploads, updates and deletes keep it current; the store is only scanned once at start.
+    Every change also gets the next sequence number and goes into a bounded change log, which
+    is what watching clients are fed from (see changes_since). Sequences start over with the
+    epoch, a random id of this run of the index.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> FileEntry
+        self.names = []  # All names, sorted
+        self.owner_names = {}  # owner -> sorted names of that owner
+        self.epoch = os.urandom(8).hex()
+        self.sequence = 0  # Sequence number of the latest change
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE)  # Latest changes as {"seq", "op", ...}, oldest first
+        self.listeners = []  # Called without arguments after every change, outside the lock
+        self.hash_listeners = []  # Called with (name, digest) for every hash filled in after a load
+
+    def __len__(self):
+        return len(self.entries)
+
+    def build(self, store):
+        # Scan the store once. Owners come from the storage layout.
+        return self.load((FileEntry(name, owner, size, mtime, digest)
+                          for name, owner, size, mtime, digest in store.scan()), store)
+
+    def load(self, entries, store):
+        # Replace the contents with entries (from a scan or the catalog). Missing hashes are
+        # filled in from the store by a background thread afterwards, which is returned.
+        entries = {entry.name: entry for entry in entries}
+        owner_names = {}
+        for name, entry in entries.items():
+            owner_names.setdefault(entry.owner, []).append(name)
+        for names in owner_names.values():
+            names.sort()
+
+        with self.lock:
+            self.entries = entries
+            self.names = sorted(entries)
+            self.owner_names = owner_names
+
+        if all(entry.hash is not None for entry in entries.values()):
+            return None
+        hasher = threading.Thread(target=self.fill_hashes, args=(store,), daemon=True)
+        hasher.start()
+        return hasher
+
+    def fill_hashes(self, store):
+        # Compute the missing hashes of the scanned files without holding the lock while reading.
+        # These are not changes of the files and are not logged, a whole store of them would
+        # push every watcher out of the change log.
+        for name in list(self.entries):
+            entry = self.entries.get(name)
+            if entry is None or entry.hash is not None:
+                continue
+            try:
+                digest = store.file_hash(name)
+            except (OSError, KeyError):
+                continue
+            with self.lock:
+                # Only keep the digest if the file was not replaced in the meantime
+                if self.entries.get(name) is not entry:
+                    continue
+                entry.hash = digest
+            for listener in self.hash_listeners:
+                listener(name, digest)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def put(self, entry):
+        # Insert or replace the entry of a file; a replaced file keeps counting its versions
+        # and downloads
+        with self.lock:
+            old = self.entries.get(entry.name)
+            if old is not None:
+                entry.version = old.version + 1
+                entry.downloads = old.downloads
+            if old is not None and old.owner != entry.owner:
+                self.remove_name(self.owner_names.get(old.owner, []), entry.name)
+            if old is None:
+                bisect.insort(self.names, entry.name)
+            if old is None or old.owner != entry.owner:
+                bisect.insort(self.owner_names.setdefault(entry.owner, []), entry.name)
+            self.entries[entry.name] = entry
+            self.record("create" if old is None else "update", entry=entry.to_dict())
+        self.notify()
+
+    def remove(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                return None
+            self.remove_name(self.names, name)
+            owned = self.owner_names.get(entry.owner)
+            if owned is not None:
+                self.remove_name(owned, name)
+                if not owned:
+                    del self.owner_names[entry.owner]
+            self.record("delete", name=name)
+        self.notify()
+        return entry
+
+    def remove_many(self, names):
+        # Remove a batch of files under one lock. A large batch rebuilds the sorted lists in
+        # one pass instead of shifting them once per name. Returns the removed entries.
+        with self.lock:
+            removed = [entry for entry in (self.entries.pop(name, None) for name in set(names))
+                       if entry is not None]
+            if not removed:
+                return removed
+            if len(removed) * 64 > len(self.names):
+                gone = {entry.name for entry in removed}
+                self.names = [name for name in self.names if name not in gone]
+                for owner in {entry.owner for entry in removed}:
+                    owned = [name for name in self.owner_names.get(owner, []) if name not in gone]
+                    if owned:
+                        self.owner_names[owner] = owned
+                    else:
+                        self.owner_names.pop(owner, None)
+            else:
+                for entry in removed:
+                    self.remove_name(self.names, entry.name)
+                    owned = self.owner_names.get(entry.owner)
+                    if owned is not None:
+                        self.remove_name(owned, entry.name)
+                        if not owned:
+                            del self.owner_names[entry.owner]
+            for entry in removed:
+                self.record("delete", name=entry.name)
+        self.notify()
+        return removed
+
+    def count_download(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry.downloads += 1
+
+    def record(self, op, **fields):
+        # Log a change, with the lock held so sequence numbers follow the order of the changes
+        self.sequence += 1
+        self.changes.append(dict(seq=self.sequence, op=op, **fields))
+
+    def notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def changes_since(self, sequence, limit):
+        """
+        Return (changes, more): up to limit logged changes after sequence, oldest first, and
+        whether further ones follow. None when the log no longer reaches back to sequence
+        (or sequence is not one of this epoch); the caller has to start from a full list then.
+        """
+        with self.lock:
+            if sequence < 0 or sequence > self.sequence:
+                return None
+            behind = self.sequence - sequence
+            if behind > len(self.changes):
+                return None
+            start = len(self.changes) - behind
+            changes = list(itertools.islice(self.changes, start, start + limit))
+            return changes, start + len(changes) < len(self.changes)
+
+    @staticmethod
+    def remove_name(names, name):
+        position = bisect.bisect_left(names, name)
+        if position < len(names) and names[position] == name:
+            del names[position]
+
+    def list(self, owner=None, prefix="", cursor=None, limit=100):
+        """
+        Return (entries, next_cursor) for one page of names in sorted order.
+        owner restricts the page to one uploader, prefix to names starting with it,
+        cursor is the last name of the previous page. next_cursor is None on the last page.
+        """
+        with self.lock:
+            names = self.names if owner is None else self.owner_names.get(owner, [])
+            start = bisect.bisect_left(names, prefix)
+            if cursor is not None:
+                start = max(start, bisect.bisect_right(names, cursor))
+
+            page = []
+            position = start
+            while position < len(names) and len(page) < limit:
+                name = names[position]
+                if not name.startswith(prefix):
+                    break
+                page.append(self.entries[name])
+                position += 1
+
+            has_more = (
+                position < len(names)
+                and len(page) == limit
+                and names[position].startswith(prefix)
+            )
+            return page, (page[-1].name if has_more and page else None)
@@ -0,0 +1,232 @@
+"""
+Write-ahead journal of the storage folder, the redo log in front of the catalog.
+
+Two kinds of records are appended to .journal, one JSON object per line behind a CRC-32:
+
+- intents: "begin" names the files a write or delete is about to touch, "end" says it is over
+  (committed or failed). A begin without its end marks an operation a crash interrupted.
+- changes: the changes of the FileIndex (the same dicts its change log holds), written and
+  fsynced before the catalog commits them, so a catalog that lost its last commits (it does not
+  sync every commit) can be brought forward from here.
+
+A checkpoint makes the catalog durable up to the last change it wrote and rewrites the journal
+with only what the catalog does not have yet: the intents still open and any newer changes. The
+journal therefore only ever holds the changes since the last checkpoint, and a start after a
+crash replays those and looks at the few files interrupted writes left behind, instead of
+scanning the whole folder. Staged files of interrupted writes are moved to .quarantine/.
+This relies on the stores making a finished write durable, data and rename, before its change
+reaches the index and so the journal.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+
+from storage import fsync_directory
+
+JOURNAL_FILE = ".journal"
+QUARANTINE_DIR = ".quarantine"  # Staged files of writes a crash interrupted, kept for inspection
+
+
+def encode_record(record):
+    data = json.dumps(record, separators=(",", ":")).encode()
+    return b"%08x %s\n" % (zlib.crc32(data), data)
+
+
+def decode_record(line):
+    # The record of one journal line, None for a line torn by a crash or otherwise damaged
+    if not line.endswith(b"\n") or len(line) < 10 or line[8:9] != b" ":
+        return None
+    data = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+class Recovery:
+    """What the journal held at open: the changes since the last checkpoint, in order, and the
+    names touched by operations that began but never ended."""
+
+    def __init__(self):
+        self.changes = []
+        self.interrupted = set()
+        self.torn = False  # The journal ended in a damaged record, which was dropped
+
+    def __bool__(self):
+        return bool(self.changes or self.interrupted)
+
+
+class Journal:
+    """
+    Appends go straight to the file descriptor, so they survive a crash of the process as soon as
+    write() returns. Changes are also fsynced before the caller goes on; callers arriving during
+    an fsync find their changes written by it and share it. Every method is a no-op once the
+    journal is closed, like the catalog.
+    """
+
+    def __init__(self, path, checkpoint_every=10000):
+        self.path = path
+        self.checkpoint_every = checkpoint_every  # Records after which a checkpoint is due
+        self.lock = threading.Lock()
+        self.fd = None
+        self.sequence = 0  # Last change of the index written, see log_changes()
+        self.ids = itertools.count(1)
+        self.open_ops = {}  # operation id -> begin record, until its end
+        self.pending = []  # (sequence, line) of the changes since the last checkpoint
+        self.records = 0  # Records in the journal file
+
+    def open(self):
+        # Read what the previous run left and open the journal for appending. Returns a
+        # Recovery, or None if there was no journal at all.
+        recovery = None
+        try:
+            with open(self.path, 'rb') as f:
+                recovery = Recovery()
+                begun = {}
+                for line in f:
+                    record = decode_record(line)
+                    if record is None:
+                        # Nothing after a torn append can have been acknowledged
+                        recovery.torn = True
+                        break
+                    if record["op"] == "begin":
+                        begun[record["id"]] = record["names"]
+                    elif record["op"] == "end":
+                        begun.pop(record["id"], None)
+                    else:
+                        recovery.changes.append(record)
+                for names in begun.values():
+                    recovery.interrupted.update(names)
+        except FileNotFoundError:
+            pass
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.open_ops = {}
+        self.pending = []
+        self.records = 0
+        return recovery
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    # ---- intents ------------------------------------------------------------
+
+    def begin(self, names):
+        # Record that names are about to be written or deleted; returns the operation id
+        op_id = next(self.ids)
+        record = {"op": "begin", "id": op_id, "names": list(names)}
+        with self.lock:
+            if self.fd is not None:
+                os.write(self.fd, encode_record(record))
+                self.open_ops[op_id] = record
+                self.records += 1
+        return op_id
+
+    def end(self, op_id):
+        with self.lock:
+            if self.fd is not None and self.open_ops.pop(op_id, None) is not None:
+                os.write(self.fd, encode_record({"op": "end", "id": op_id}))
+                self.records += 1
+
+    def operation(self, *names):
+        # with journal.operation(name): ... brackets a store write and its index update
+        return JournalOperation(self, names)
+
+    # ---- changes ------------------------------------------------------------
+
+    def log_changes(self, index):
+        # Append and fsync the changes of index after the last one written
+        with self.lock:
+            if self.fd is None:
+                return
+            lines = []
+            while True:
+                result = index.changes_since(self.sequence, 10000)
+                if result is None:
+                    # Fell behind the change log (cannot happen while this runs after every
+                    # change); write the whole index as changes instead
+                    with index.lock:
+                        sequence = index.sequence
+                        entries = [entry.to_dict() for entry in index.entries.values()]
+                    lines.extend((sequence, encode_record({"seq": sequence, "op": "update", "entry": entry}))
+                                 for entry in entries)
+                    self.sequence = sequence
+                    break
+                changes, more = result
+                lines.extend((change["seq"], encode_record(change)) for change in changes)
+                if changes:
+                    self.sequence = changes[-1]["seq"]
+                if not more:
+                    break
+            if not lines:
+                return
+            os.write(self.fd, b"".join(line for _, line in lines))
+            os.fsync(self.fd)
+            self.pending.extend(lines)
+            self.records += len(lines)
+
+    def due(self):
+        return self.records >= self.checkpoint_every
+
+    def checkpoint(self, sequence):
+        """
+        Drop the changes up to sequence, which the catalog has made durable. The journal is
+        rewritten with the intents still open and the newer changes, and swapped in by rename,
+        so a crash during a checkpoint leaves either the old or the new journal.
+        """
+        with self.lock:
+            if self.fd is None:
+                return
+            kept = [line for change_sequence, line in self.pending if change_sequence > sequence]
+            data = b"".join([encode_record(record) for record in self.open_ops.values()] + kept)
+            tmp_path = self.path + ".tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, self.path)
+            fsync_directory(os.path.dirname(self.path))
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self.pending = [(change_sequence, line) for change_sequence, line in self.pending
+                            if change_sequence > sequence]
+            self.records = len(self.open_ops) + len(self.pending)
+
+
+class JournalOperation:
+    def __init__(self, journal, names):
+        self.journal = journal
+        self.names = names
+        self.op_id = None
+
+    def __enter__(self):
+        self.op_id = self.journal.begin(self.names)
+        return self
+
+    def __exit__(self, *exc):
+        self.journal.end(self.op_id)
+        return False
+
+
+def quarantine(paths, root):
+    # Move staged files of interrupted writes to root/.quarantine/; returns where they went
+    folder = os.path.join(root, QUARANTINE_DIR)
+    moved = []
+    for path in paths:
+        os.makedirs(folder, exist_ok=True)
+        target = os.path.join(folder, f"{int(time.time())}-{os.path.basename(path)}")
+        try:
+            os.replace(path, target)
+        except OSError:
+            continue
+        moved.append(target)
+    return moved
@@ -0,0 +1,100 @@
+"""
+Client copy of the server's file list, kept current by the changes the server pushes.
+
+The list is loaded once per connection with LIST pages, after a WATCH that tells the server
+to push every later upload, update and delete as a CHANGES frame. Changes carry consecutive
+sequence numbers of the server's epoch, so the cache knows exactly which ones it has applied:
+after a reconnect WATCH names the last one and the server only sends what was missed. A gap,
+a new epoch (the server restarted) or a reset (the client fell too far behind) means the list
+has to be loaded again.
+"""
+import threading
+
+
+class ListingCache:
+    """
+    Entries of the server's files as the dicts LIST returns, by name.
+    A (re)load runs between begin_load and finish_load; changes arriving meanwhile are held
+    and applied on top of the loaded list, skipping those it already contains. apply returns
+    False when the cache fell out of step and needs another load.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> entry dict
+        self.epoch = None  # Epoch of the server's sequence numbers
+        self.sequence = 0  # Sequence number of the last change applied
+        self.ready = False  # The entries match the server, pickers may use them
+        self.loading = False
+        self.held = []  # CHANGES payloads that arrived during a load
+
+    def clear(self):
+        # Forget everything, e.g. when connecting to another server or as another user
+        with self.lock:
+            self.entries = {}
+            self.epoch = None
+            self.sequence = 0
+            self.ready = False
+
+    def begin_load(self):
+        # Returns False if a load is already running
+        with self.lock:
+            if self.loading:
+                return False
+            self.loading = True
+            self.ready = False  # Changes may have been missed until the load is done
+            self.held = []
+            return True
+
+    def finish_load(self, epoch, sequence, entries=None):
+        # entries is the freshly listed file list, None to keep the cached one (resumed watch)
+        with self.lock:
+            if entries is not None:
+                self.entries = {entry["name"]: entry for entry in entries}
+            self.epoch = epoch
+            self.sequence = sequence
+            self.loading = False
+            self.ready = True
+            held, self.held = self.held, []
+            return all(self.apply_locked(fields) for fields in held)
+
+    def abort_load(self):
+        with self.lock:
+            self.loading = False
+            self.ready = False
+            self.held = []
+
+    def apply(self, fields):
+        # Apply one CHANGES payload
+        with self.lock:
+            if self.loading:
+                self.held.append(fields)
+                return True
+            return self.apply_locked(fields)
+
+    def apply_locked(self, fields):
+        if fields.get("reset") or fields.get("epoch") != self.epoch:
+            self.ready = False
+            return False
+        for change in fields.get("changes", []):
+            sequence = change["seq"]
+            if sequence <= self.sequence:
+                continue  # Already part of the loaded list
+            if sequence != self.sequence + 1:
+                self.ready = False
+                return False
+            if change["op"] == "delete":
+                self.entries.pop(change["name"], None)
+            else:
+                self.entries[change["entry"]["name"]] = change["entry"]
+            self.sequence = sequence
+        return True
+
+    def list(self, owner=None):
+        # Cached entries in name order like LIST, optionally of one owner; None when not ready
+        with self.lock:
+            if not self.ready:
+                return None
+            entries = [entry for entry in self.entries.values() if owner is None or entry["owner"] == owner]
+        entries.sort(key=lambda entry: entry["name"])
+        return entries
@@ -0,0 +1,160 @@
+"""
+Liveness of client connections: PING/PONG on a deadline heap, plus TCP keepalive.
+
+Every watched connection has one entry in a heap ordered by the time it next needs
+attention. The monitor thread sleeps until the earliest deadline and only looks at the
+entries that are due, so a tick costs O(due * log n) however many clients are idle.
+A connection that sent nothing for `interval` seconds gets a PING; if no frame at all has
+arrived `timeout` seconds later it is closed, which ends its handler and frees its name.
+Frames are noted with touch(), which only stores a timestamp. A connection that is
+running a command is never pinged: the transfer itself notices a dead peer.
+"""
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+from protocol import OP_PING
+
+KEEPALIVE_IDLE = 30  # Seconds without traffic before the kernel starts probing
+KEEPALIVE_INTERVAL = 10  # Seconds between two keepalive probes
+KEEPALIVE_COUNT = 3  # Unanswered probes before the kernel drops the connection
+USER_TIMEOUT = 60  # Seconds sent data may stay unacknowledged before a send fails
+
+
+def enable_keepalive(sock):
+    # TCP keepalive with short timers, and a bound on how long a send may hang on a
+    # dead peer. The tuning options are Linux/BSD names, missing ones are skipped.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPALIVE", KEEPALIVE_IDLE),
+                        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+                        ("TCP_USER_TIMEOUT", USER_TIMEOUT * 1000)):
+        option = getattr(socket, name, None)
+        if option is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError:
+                pass
+
+
+class Session:
+    __slots__ = ("conn", "name", "last_seen", "ping_sent", "busy", "removed")
+
+    def __init__(self, conn, name, now):
+        self.conn = conn
+        self.name = name
+        self.last_seen = now  # Time the last frame arrived
+        self.ping_sent = None  # Time of the PING still waiting for an answer
+        self.busy = 0  # Commands running on the connection
+        self.removed = False
+
+
+class LivenessMonitor:
+    def __init__(self, interval=30, timeout=10, on_dead=None):
+        self.interval = interval  # Idle seconds before a PING
+        self.timeout = timeout  # Seconds a pinged connection has to send something
+        self.on_dead = on_dead  # Called as on_dead(conn, name) for a connection that stopped answering
+        self.sessions = {}  # conn -> Session
+        self.heap = []  # (deadline, sequence, Session), one entry per watched connection
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.pings = 0
+        self.reaped = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def add(self, conn, name):
+        now = time.monotonic()
+        session = Session(conn, name, now)
+        with self.cond:
+            self.sessions[conn] = session
+            self.schedule(session, now + self.interval)
+
+    def remove(self, conn):
+        # The heap entry stays and is skipped when it comes up
+        with self.cond:
+            session = self.sessions.pop(conn, None)
+            if session is not None:
+                session.removed = True
+
+    def touch(self, conn):
+        # A frame arrived on conn. Called for every frame, so it takes no lock.
+        session = self.sessions.get(conn)
+        if session is not None:
+            session.last_seen = time.monotonic()
+
+    def begin(self, conn):
+        session = self.sessions.get(conn)
+        if session is not None:
+            session.busy += 1
+            session.last_seen = time.monotonic()
+
+    def end(self, conn):
+        session = self.sessions.get(conn)
+        if session is not None:
+            session.busy -= 1
+            session.last_seen = time.monotonic()
+
+    def schedule(self, session, deadline):
+        # self.cond must be held
+        first = not self.heap or deadline < self.heap[0][0]
+        heapq.heappush(self.heap, (deadline, next(self.sequence), session))
+        if first:
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.running:
+                    return
+                now = time.monotonic()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+            for session in due:
+                if not session.removed:
+                    self.check(session, now)
+
+    def check(self, session, now):
+        if session.busy:
+            # A running command owns the connection, look again later
+            session.ping_sent = None
+            deadline = now + self.interval
+        elif session.ping_sent is not None:
+            if session.last_seen < session.ping_sent:
+                self.reap(session)
+                return
+            session.ping_sent = None
+            deadline = session.last_seen + self.interval
+        elif session.last_seen + self.interval > now:
+            # Traffic since the entry was scheduled, push the PING back
+            deadline = session.last_seen + self.interval
+        else:
+            session.ping_sent = now
+            self.pings += 1
+            if not session.conn.post(OP_PING):
+                self.reap(session)
+                return
+            deadline = now + self.timeout
+        with self.cond:
+            if not session.removed:
+                self.schedule(session, deadline)
+
+    def reap(self, session):
+        self.remove(session.conn)
+        self.reaped += 1
+        if self.on_dead is not None:
+            self.on_dead(session.conn, session.name)
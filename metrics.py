@@ -0,0 +1,320 @@
+"""
+Server metrics: counters, gauges and latency histograms, cheap enough to leave on under load.
+
+Every thread updates its own shard (a plain dict reached through threading.local), so
+recording a sample takes no lock and never contends with other threads. A scrape adds the
+shards up; shards of threads that ended are folded into one retired shard at that point.
+Values that already live elsewhere (connected clients, cache counters, outbox sizes) are
+not mirrored: collectors registered with add_collector read them when a scrape happens.
+
+The result is served as JSON by the STATS command and as Prometheus text by an optional
+HTTP listener (MetricsHTTPServer).
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DISK_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Shard:
+    # Samples recorded by one thread: (name, labels) -> value, and -> [bucket counts..., sum]
+    __slots__ = ("thread", "values", "histograms")
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.values = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        for key, value in dict(other.values).items():
+            self.values[key] = self.values.get(key, 0) + value
+        for key, counts in dict(other.histograms).items():
+            counts = list(counts)
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = counts
+            else:
+                for i, count in enumerate(counts):
+                    mine[i] += count
+
+
+class Metric:
+    def __init__(self, registry, name, kind, help, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.kind = kind  # "counter", "gauge" or "histogram"
+        self.help = help
+        self.buckets = buckets
+
+
+class Counter(Metric):
+    def inc(self, value=1, labels=()):
+        # labels is a tuple of (name, value) pairs, the same tuple for the same series
+        values = self.registry.shard().values
+        key = (self.name, labels)
+        values[key] = values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    def add(self, delta, labels=()):
+        # Gauges are kept as per-thread deltas, so a thread may lower what another one raised
+        values = self.registry.shard().values
+        key = (self.name, labels)
+        values[key] = values.get(key, 0) + delta
+
+
+class Histogram(Metric):
+    def observe(self, value, labels=()):
+        histograms = self.registry.shard().histograms
+        key = (self.name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(self.buckets) + 2)  # Buckets, +Inf, sum
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, labels=()):
+        return Timer(self, labels)
+
+
+class Timer:
+    # with histogram.time(labels): ... observes the seconds the block took
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class TimedWriter:
+    # File-like wrapper that records the time of every write() in a histogram
+    def __init__(self, fileobj, histogram, labels=()):
+        self.fileobj = fileobj
+        self.histogram = histogram
+        self.labels = labels
+
+    def write(self, data):
+        start = time.perf_counter()
+        result = self.fileobj.write(data)
+        self.histogram.observe(time.perf_counter() - start, self.labels)
+        return result
+
+
+class Metrics:
+    """
+    Registry of the server's metrics. Metrics are declared once with counter(), gauge()
+    and histogram(), then updated from any thread. collect() returns the current values
+    as {name: (kind, help, buckets, {labels: value})}; for histograms the value is the
+    list of bucket counts followed by the sum.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()  # Guards the shard list, taken once per thread and on scrape
+        self.shards = []
+        self.retired = Shard()  # Samples of threads that have ended
+        self.metrics = {}  # name -> Metric, in declaration order
+        self.collectors = []  # Callables yielding (name, kind, help, labels, value) when scraped
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard(threading.current_thread())
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def declare(self, cls, name, kind, help, buckets=None):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(self, name, kind, help, buckets)
+        return metric
+
+    def counter(self, name, help):
+        return self.declare(Counter, name, "counter", help)
+
+    def gauge(self, name, help):
+        return self.declare(Gauge, name, "gauge", help)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.declare(Histogram, name, "histogram", help, tuple(buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        # Sum the shards; the owning threads keep writing, every read is a C-level dict copy
+        total = Shard()
+        with self.lock:
+            alive = []
+            for shard in self.shards:
+                if shard.thread.is_alive():
+                    alive.append(shard)
+                else:
+                    self.retired.merge(shard)
+            self.shards = alive
+            total.merge(self.retired)
+            for shard in alive:
+                total.merge(shard)
+
+        families = {name: (metric.kind, metric.help, metric.buckets, {})
+                    for name, metric in self.metrics.items()}
+        for (name, labels), value in total.values.items():
+            families[name][3][labels] = value
+        for (name, labels), counts in total.histograms.items():
+            families[name][3][labels] = counts
+        for collector in self.collectors:
+            for name, kind, help, labels, value in collector():
+                families.setdefault(name, (kind, help, None, {}))[3][labels] = value
+        return families
+
+    def snapshot(self):
+        # JSON-friendly view for the STATS command. Histograms become count, sum and
+        # p50/p95/p99 estimates (upper bound of the bucket the quantile falls in).
+        result = {}
+        for name, (kind, help, buckets, series) in self.collect().items():
+            entries = []
+            for labels, value in sorted(series.items()):
+                if kind == "histogram":
+                    value = summarize_histogram(buckets, value)
+                entries.append({"labels": dict(labels), "value": value} if labels else {"value": value})
+            if not entries:
+                continue
+            result[name] = entries[0]["value"] if len(entries) == 1 and not entries[0].get("labels") else entries
+        return result
+
+    def render_prometheus(self):
+        lines = []
+        for name, (kind, help, buckets, series) in self.collect().items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else format_value(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(value[-1])}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def summarize_histogram(buckets, counts):
+    count = sum(counts[:-1])
+    summary = {"count": count, "sum": counts[-1]}
+    for quantile in (0.5, 0.95, 0.99):
+        summary[f"p{int(quantile * 100)}"] = histogram_quantile(buckets, counts, quantile, count)
+    return summary
+
+
+def histogram_quantile(buckets, counts, quantile, count):
+    if not count:
+        return None
+    rank = quantile * count
+    seen = 0
+    for bound, bucket_count in zip(buckets, counts):
+        seen += bucket_count
+        if seen >= rank:
+            return bound
+    return buckets[-1]  # In the +Inf bucket: at least the largest bound
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class ByteCounters:
+    """
+    Bytes sent and received by the server's connections. Every FrameSocket counts its own
+    traffic in plain attributes; this sums the open connections and keeps the totals of the
+    closed ones. The lock is only taken when a connection opens or closes and on scrape.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.closed_sent = 0
+        self.closed_received = 0
+
+    def open(self, conn):
+        with self.lock:
+            self.connections.add(conn)
+
+    def close(self, conn):
+        with self.lock:
+            if conn in self.connections:
+                self.connections.discard(conn)
+                self.closed_sent += conn.bytes_sent
+                self.closed_received += conn.bytes_received
+
+    def totals(self):
+        with self.lock:
+            sent = self.closed_sent + sum(conn.bytes_sent for conn in self.connections)
+            received = self.closed_received + sum(conn.bytes_received for conn in self.connections)
+        return sent, received
+
+
+class MetricsHTTPServer:
+    # Serves GET /metrics in the Prometheus text format from a background thread
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would flood the server log
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,121 @@
+"""
+Convert a storage folder from the old flat layout to the sharded one.
+
+The flat layout kept every upload as upload_dir/<owner>_<filename> (and, in dedup mode, every
+manifest as .manifests/<owner>_<filename>.json), and took everything before the first "_" as
+the owner. The sharded layout puts each file under a folder of its owner (see
+storage.shard_path), so the owner no longer has to be guessed from the name.
+
+Files are moved with a rename on the same disk; chunks of a dedup store stay where they are.
+The folder is only marked as sharded once every file has moved, so an interrupted run can
+simply be started again.
+
+    python migrate_storage.py ./uploaded_files --user al_ice --dry-run
+"""
+import argparse
+import os
+import sys
+
+from storage import (
+    LAYOUT_FILE, TEMP_PREFIX, check_layout, count_legacy_files, file_name, fsync_directory, shard_path,
+)
+
+
+def legacy_owner(name, users):
+    # (owner, filename) of a flat-layout name. Known usernames that contain "_" are tried first,
+    # longest first; any other name is split at its first "_", the way the old server did it.
+    for user in users:
+        if name.startswith(user + "_") and len(name) > len(user) + 1:
+            return user, name[len(user) + 1:]
+    owner, separator, filename = name.partition("_")
+    if not separator or not owner or not filename:
+        return None
+    return owner, filename
+
+
+def legacy_files(folder, suffix=""):
+    # Names (without suffix) of the files kept directly in folder by the flat layout
+    with os.scandir(folder) as it:
+        for item in it:
+            if item.name.startswith(".") or not item.name.endswith(suffix) or not item.is_file():
+                continue
+            yield item.name[:len(item.name) - len(suffix)] if suffix else item.name
+
+
+def migrate_folder(folder, users, dry_run, log, suffix=""):
+    # Move the flat files of folder into their shards; returns (moved, skipped)
+    moved = skipped = 0
+    folders = set()
+    for name in sorted(legacy_files(folder, suffix)):
+        parsed = legacy_owner(name, users)
+        if parsed is None:
+            log(f"skipped {name}{suffix}: no owner in the name")
+            skipped += 1
+            continue
+        owner, filename = parsed
+        source = os.path.join(folder, name + suffix)
+        target = shard_path(folder, file_name(owner, filename), suffix)
+        if os.path.exists(target):
+            log(f"skipped {name}{suffix}: {target} exists already")
+            skipped += 1
+            continue
+        log(f"{name}{suffix} -> {os.path.relpath(target, folder)} (owner {owner})")
+        moved += 1
+        if dry_run:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+        folders.add(os.path.dirname(target))
+    # The renames are durable before the folder is marked as converted
+    for changed in folders | {folder}:
+        fsync_directory(changed)
+    return moved, skipped
+
+
+def migrate(root, users=(), dry_run=False, log=print):
+    """
+    Move the flat-layout files of a storage folder into the sharded layout and mark it.
+    Returns (moved, skipped); skipped files stay where they are and keep the folder unmarked.
+    """
+    users = sorted(set(users), key=len, reverse=True)
+    if os.path.exists(os.path.join(root, LAYOUT_FILE)) and not count_legacy_files(root):
+        log(f"{root} already uses the sharded layout")
+        return 0, 0
+
+    # Staged writes of the old server would otherwise look like uploads
+    for item in os.listdir(root):
+        if item.startswith(TEMP_PREFIX) and not dry_run:
+            os.remove(os.path.join(root, item))
+
+    moved, skipped = migrate_folder(root, users, dry_run, log)
+    manifest_dir = os.path.join(root, ".manifests")
+    if os.path.isdir(manifest_dir):
+        more_moved, more_skipped = migrate_folder(manifest_dir, users, dry_run, log, ".json")
+        moved += more_moved
+        skipped += more_skipped
+
+    if not dry_run and not skipped:
+        check_layout(root, 0)
+    return moved, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a storage folder to the sharded layout")
+    parser.add_argument("storage_dir", help="Storage folder of the server (stop the server first)")
+    parser.add_argument("--user", action="append", default=[],
+                        help="Username that contains '_', so its files are not given to the name before it "
+                             "(may be repeated)")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be moved")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.storage_dir):
+        parser.error(f"{args.storage_dir} is not a folder")
+    moved, skipped = migrate(args.storage_dir, args.user, args.dry_run)
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} files, skipped {skipped}")
+    if skipped:
+        print("Skipped files stay in the flat layout; move or remove them and run this again")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
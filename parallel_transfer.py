@@ -0,0 +1,184 @@
+"""
+Parallel range transfers over several connections of one client.
+
+A single TCP stream over a high-latency link is limited by its window, so large files are
+split into byte ranges that move over N extra connections at once. Extra connections
+attach to the client's login with its resume token (HELLO with "attach"). Downloads use
+ranged DOWNLOAD requests written at their offsets; uploads send the chunks of an upload
+session, striped over the streams. Both sides verify the reassembled file by SHA-256.
+"""
+import os
+import socket
+import threading
+import time
+
+import compression
+from file_index import file_sha256
+from liveness import enable_keepalive
+from protocol import FrameSocket, OP_HELLO, OP_ERROR, OP_DOWNLOAD, OP_READY, OP_SESSION_CHUNK
+from upload_sessions import ChunkWriter
+
+
+class Progress:
+    # Byte counter shared by the stream threads; the caller reads it from its own thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = 0
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+
+
+def split_ranges(size, streams, align=1):
+    # Cut [0, size) into at most `streams` contiguous (offset, length) ranges whose
+    # boundaries are multiples of align
+    units = max(1, (size + align - 1) // align)
+    streams = max(1, min(streams, units))
+    ranges = []
+    for index in range(streams):
+        start = min(size, (units * index // streams) * align)
+        end = min(size, (units * (index + 1) // streams) * align)
+        if end > start:
+            ranges.append((start, end - start))
+    return ranges
+
+
+def open_stream(address, username, token, timeout=600):
+    # Open an extra connection attached to the login of username
+    sock = socket.create_connection(address, timeout=10)
+    sock.settimeout(timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    enable_keepalive(sock)
+    conn = FrameSocket(sock)
+    try:
+        conn.send_message(OP_HELLO, 0, username=username, token=token, attach=True,
+                          compression=compression.PREFERENCE)
+        reply = conn.recv_reply(0)
+        if reply.opcode == OP_ERROR:
+            raise Exception(reply.fields().get("message", "Stream refused"))
+        conn.codec = compression.get_codec(reply.fields().get("compression"))
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def run_streams(address, username, token, jobs, work, poll=None, poll_interval=0.1):
+    """
+    Run work(conn, job) for every job, each on its own attached connection.
+    poll() is called from the calling thread while the streams run (e.g. to refresh a GUI).
+    The first error of any stream is raised once all of them stopped.
+    """
+    errors = []
+
+    def run(job):
+        try:
+            conn = open_stream(address, username, token)
+            try:
+                work(conn, job)
+            finally:
+                conn.close()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(job,), daemon=True) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(poll_interval)
+            if poll:
+                poll()
+    if errors:
+        raise errors[0]
+
+
+def parallel_download(address, username, token, filename, path, size, streams,
+                      mtime=None, expected_hash=None, progress=None, poll=None, align=1024 * 1024):
+    """
+    Download filename into path over `streams` connections.
+    mtime is the version the caller saw; a stream that gets another version fails the
+    transfer. With expected_hash the reassembled file is verified before returning.
+    """
+    progress = progress or Progress()
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    def work(conn, byte_range):
+        offset, length = byte_range
+        fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))  # No newline translation on Windows
+        try:
+            conn.send_message(OP_DOWNLOAD, 1, filename=filename, offset=offset, length=length)
+            reply = conn.recv_reply(1)
+            info = reply.fields()
+            if reply.opcode == OP_ERROR:
+                raise Exception(info.get("message", "Download refused"))
+            if mtime is not None and info.get("mtime") != mtime:
+                raise Exception(f"{filename} changed during the transfer")
+            last = [0]
+
+            def count(received, total):
+                progress.add(received - last[0])
+                last[0] = received
+
+            conn.send_frame(OP_READY, 1)
+            conn.receive_stream(1, ChunkWriter(fd, offset), length, progress=count)
+        finally:
+            os.close(fd)
+
+    run_streams(address, username, token, split_ranges(size, streams, align), work, poll=poll)
+    if expected_hash and file_sha256(path) != expected_hash:
+        raise Exception(f"{filename} failed verification after reassembly")
+
+
+def parallel_send_chunks(address, username, token, session_id, filepath, filesize, chunk_size,
+                         indices, streams, window=4, progress=None, poll=None):
+    """
+    Send the given chunks of an upload session over `streams` connections.
+    Chunks are striped over the streams; each stream keeps up to `window` chunks in flight.
+    Committing the session is left to the caller.
+    """
+    progress = progress or Progress()
+
+    def work(conn, stripe):
+        in_flight = []
+        request_ids = iter(range(1, len(stripe) + 1))
+        with open(filepath, 'rb') as f:
+            for index in stripe:
+                length = min(chunk_size, filesize - index * chunk_size)
+                request_id = next(request_ids)
+                conn.send_message(OP_SESSION_CHUNK, request_id, session=session_id, index=index)
+                f.seek(index * chunk_size)
+                conn.send_stream(request_id, f, length)
+                in_flight.append((request_id, length))
+                if len(in_flight) >= window:
+                    wait_chunk(conn, *in_flight.pop(0))
+            for request_id, length in in_flight:
+                wait_chunk(conn, request_id, length)
+
+    def wait_chunk(conn, request_id, length):
+        reply = conn.recv_reply(request_id)
+        if reply.opcode == OP_ERROR:
+            raise Exception(reply.fields().get("message", "Chunk refused"))
+        progress.add(length)
+
+    streams = max(1, min(streams, len(indices)))
+    stripes = [indices[start::streams] for start in range(streams)]
+    run_streams(address, username, token, [s for s in stripes if s], work, poll=poll)
+
+
+class Meter:
+    # poll() callback that calls report(done, total) at most every interval seconds
+    def __init__(self, progress, total, report, interval=1.0):
+        self.progress = progress
+        self.total = total
+        self.report = report
+        self.interval = interval
+        self.last = 0
+
+    def __call__(self):
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(self.progress.done, self.total)
@@ -0,0 +1,482 @@
+import json
+import socket
+import struct
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+from compression import FrameCompressor
+
+# Every message on the wire is a frame with a fixed 14 byte header:
+#   opcode (1 byte) | flags (1 byte) | request id (4 bytes) | payload length (8 bytes)
+# Commands and replies carry a small JSON payload, file contents travel in DATA frames.
+HEADER = struct.Struct("!BBIQ")
+HEADER_SIZE = HEADER.size
+FLAG_COMPRESSED = 0x01  # DATA payload is compressed with the codec negotiated in HELLO
+
+# Session opcodes
+OP_HELLO = 0x01          # client -> server: {"username": ...}
+OP_OK = 0x02             # reply to a request, always carries the request id
+OP_ERROR = 0x03          # error reply: {"message": ...}
+OP_NOTIFICATION = 0x04   # server push, request id 0: {"message": ...}
+OP_EXIT = 0x05           # client is leaving
+OP_PING = 0x06           # liveness check, either side; answered with a PONG of the same request id
+OP_PONG = 0x07
+OP_CHANGES = 0x08        # server push, request id 0: {"epoch", "changes": [{"seq", "op", ...}]} or {"epoch", "reset", "sequence"}
+
+# File command opcodes
+OP_LIST = 0x10
+OP_UPLOAD = 0x11
+OP_DOWNLOAD = 0x12
+OP_DELETE = 0x13
+OP_UPDATE = 0x14
+
+# Resumable upload session opcodes
+OP_SESSION_OPEN = 0x15    # {"filename", "filesize", "chunk_size", "update"} -> {"session", "chunk_size", "chunks"}
+OP_SESSION_CHUNK = 0x16   # {"session", "index"} followed by the DATA frames of that chunk
+OP_SESSION_STATUS = 0x17  # {"session"} -> {"received": [indices], ...}
+OP_SESSION_COMMIT = 0x18  # {"session", "hash"}, all chunks must have arrived
+
+# Delta update opcode
+OP_SIGNATURE = 0x19       # {"filename"} -> {"filesize", "mtime", "block_size", "length"} + DATA frames of block signatures
+
+# Observability
+OP_STATS = 0x1A           # {} -> {"metrics": {name: value}}, the server's counters, gauges and histograms
+
+# Batch opcodes: up to MAX_BATCH_ITEMS files per request, one result per file in request order
+OP_MULTI_DELETE = 0x1B    # {"filenames"} -> {"results": [{"filename", "ok", "message"}]}
+OP_MULTI_STAT = 0x1C      # {"filenames"} -> {"results": [{"filename", "ok", "size", "mtime", "hash", ...}]}
+OP_MULTI_DOWNLOAD = 0x1D  # {"filenames"} -> {"files": [manifest], "total"}, READY, then the DATA of every file in order
+
+# Listing changes: the server pushes CHANGES frames to a connection that sent WATCH
+OP_WATCH = 0x1E           # {"epoch", "sequence"} -> {"epoch", "sequence", "resumed"}
+
+# Transfer opcodes
+OP_READY = 0x20          # client is ready to receive a download
+OP_DATA = 0x21           # raw file bytes for the request id
+OP_CANCEL = 0x22         # client gives up on a pending request
+
+OP_NAMES = {
+    OP_HELLO: "HELLO",
+    OP_OK: "OK",
+    OP_ERROR: "ERROR",
+    OP_NOTIFICATION: "NOTIFICATION",
+    OP_EXIT: "EXIT",
+    OP_PING: "PING",
+    OP_PONG: "PONG",
+    OP_CHANGES: "CHANGES",
+    OP_LIST: "LIST",
+    OP_UPLOAD: "UPLOAD",
+    OP_DOWNLOAD: "DOWNLOAD",
+    OP_DELETE: "DELETE",
+    OP_UPDATE: "UPDATE",
+    OP_SESSION_OPEN: "SESSION_OPEN",
+    OP_SESSION_CHUNK: "SESSION_CHUNK",
+    OP_SESSION_STATUS: "SESSION_STATUS",
+    OP_SESSION_COMMIT: "SESSION_COMMIT",
+    OP_SIGNATURE: "SIGNATURE",
+    OP_STATS: "STATS",
+    OP_MULTI_DELETE: "MULTI_DELETE",
+    OP_MULTI_STAT: "MULTI_STAT",
+    OP_MULTI_DOWNLOAD: "MULTI_DOWNLOAD",
+    OP_WATCH: "WATCH",
+    OP_READY: "READY",
+    OP_DATA: "DATA",
+    OP_CANCEL: "CANCEL",
+}
+
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # Upper bound for a JSON control frame
+DATA_CHUNK_SIZE = 64 * 1024          # Default payload size of a DATA frame
+SENDFILE_CHUNK_SIZE = 4 * 1024 * 1024  # Payload size of DATA frames sent with sendfile
+COMPRESS_CHUNK_SIZE = 256 * 1024     # Bytes compressed into one DATA frame
+RECEIVE_BUFFER_SIZE = 1024 * 1024      # Default recv_into buffer of receive_stream
+MAX_PENDING_FRAMES = 1024            # Frames buffered while waiting for another request
+MAX_OUTBOX_FRAMES = 64               # Pushed messages queued for a connection before they are coalesced
+MAX_BATCH_ITEMS = 1000               # Files named in one batch command
+MAX_CHANGES_PER_FRAME = 500          # Listing changes carried by one CHANGES frame
+
+
+class ProtocolError(Exception):
+    # Raised when the peer sends something that is not a valid frame
+    pass
+
+
+class Frame(namedtuple("Frame", ["opcode", "flags", "request_id", "payload"])):
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return OP_NAMES.get(self.opcode, f"0x{self.opcode:02x}")
+
+    def fields(self):
+        # Decode the JSON payload of a control frame
+        if not self.payload:
+            return {}
+        try:
+            fields = json.loads(bytes(self.payload).decode())
+        except (UnicodeDecodeError, ValueError) as e:
+            raise ProtocolError(f"Invalid {self.name} payload: {str(e)}")
+        if not isinstance(fields, dict):
+            raise ProtocolError(f"Invalid {self.name} payload")
+        return fields
+
+
+def encode_message(**fields):
+    # Encode keyword fields as the JSON payload of a control frame
+    return json.dumps(fields, separators=(",", ":")).encode()
+
+
+class FrameSocket:
+    """
+    Wraps a connected socket and speaks the framed protocol on it.
+    Sends are serialised with a lock so frames written from different threads never interleave.
+    Frames that arrive for another request while waiting on a reply are kept in order
+    in a pending queue, which is what makes pipelined requests safe.
+    Messages pushed by other threads (notifications) go through a bounded outbox that a
+    single writer per connection delivers, between the frames of a running transfer.
+    Listing changes are not queued at all: post_changes only flags them, and the writer asks
+    change_feed for the payload when it gets there, so a burst of changes becomes one frame
+    and none of them can be dropped.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.pending = deque()
+        self.codec = None  # Compression of DATA frames negotiated in HELLO, None for raw bytes
+        self.outbox = OrderedDict()  # (opcode, payload) -> times it was posted, oldest first
+        self.outbox_overflow = 0  # Messages that did not fit into the outbox since it was last flushed
+        self.outbox_cond = threading.Condition()
+        self.writer_thread = None
+        self.closed = False
+        self.change_feed = None  # Callable returning the next CHANGES payload or None, set once the peer watches
+        self.changes_pending = False
+        self.watch_sequence = None  # Last change sequence handed to change_feed's frames
+        self.bytes_sent = 0  # Traffic of this connection, headers included, read by the server's metrics
+        self.bytes_received = 0
+        self.throttle = None  # bandwidth.Transfer of the transfer in progress, paces its DATA frames
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        with self.outbox_cond:
+            self.closed = True
+            self.outbox_cond.notify()
+        # A thread blocked in recv on this socket is only woken by a shutdown, not by close
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    # ---- sending -------------------------------------------------------
+
+    def send_frame(self, opcode, request_id=0, payload=b"", flags=0):
+        header = HEADER.pack(opcode, flags, request_id, len(payload))
+        with self.send_lock:
+            # Small frames go out in a single call, large payloads are not copied
+            if len(payload) <= DATA_CHUNK_SIZE:
+                self.sock.sendall(header + bytes(payload))
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(payload)
+            self.bytes_sent += HEADER_SIZE + len(payload)
+
+    def send_message(self, opcode, request_id=0, **fields):
+        self.send_frame(opcode, request_id, encode_message(**fields))
+
+    def pace(self, count):
+        # Wait for the bandwidth share of count bytes of file content, outside the send lock
+        if self.throttle is not None:
+            self.throttle(count)
+
+    # ---- pushed messages -----------------------------------------------
+
+    def post(self, opcode, **fields):
+        # Queue a message with request id 0 for the writer of this connection, never blocks.
+        # A message already waiting in the outbox is not queued twice but counted, and once
+        # MAX_OUTBOX_FRAMES are waiting further ones are only counted. Returns False once closed.
+        key = (opcode, encode_message(**fields))
+        with self.outbox_cond:
+            if self.closed:
+                return False
+            if key in self.outbox:
+                self.outbox[key] += 1
+            elif len(self.outbox) < MAX_OUTBOX_FRAMES:
+                self.outbox[key] = 1
+            else:
+                self.outbox_overflow += 1
+            self.outbox_cond.notify()
+        self.wake_writer()
+        return True
+
+    def post_changes(self):
+        # Tell the writer there are listing changes to fetch from change_feed, never blocks
+        with self.outbox_cond:
+            if self.closed:
+                return False
+            pending, self.changes_pending = self.changes_pending, True
+            self.outbox_cond.notify()
+        if not pending:
+            self.wake_writer()
+        return True
+
+    def take_outbox(self):
+        # Empty the outbox, returns the (opcode, payload) frames to write for it
+        with self.outbox_cond:
+            items, self.outbox = self.outbox, OrderedDict()
+            overflow, self.outbox_overflow = self.outbox_overflow, 0
+            changes, self.changes_pending = self.changes_pending, False
+        frames = []
+        if changes and self.change_feed is not None:
+            payload = self.change_feed()
+            if payload is not None:
+                frames.append((OP_CHANGES, payload))
+        for (opcode, payload), count in items.items():
+            if count > 1:
+                fields = json.loads(payload)
+                fields["count"] = count
+                payload = encode_message(**fields)
+            frames.append((opcode, payload))
+        if overflow:
+            frames.append((OP_NOTIFICATION, encode_message(
+                message=f"{overflow} more notifications were dropped while you were busy.", dropped=overflow)))
+        return frames
+
+    def wake_writer(self):
+        # The writer thread is only started for connections that get pushed messages
+        with self.outbox_cond:
+            if self.writer_thread is not None or self.closed:
+                return
+            self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def writer_loop(self):
+        # Single writer of the outbox. Each frame takes the send lock on its own, so the frames
+        # of a transfer in progress and pushed messages alternate; a slow peer only stalls this thread.
+        while True:
+            with self.outbox_cond:
+                while not (self.outbox or self.outbox_overflow or self.changes_pending or self.closed):
+                    self.outbox_cond.wait()
+                if self.closed:
+                    return
+            try:
+                for opcode, payload in self.take_outbox():
+                    self.send_frame(opcode, 0, payload)
+            except OSError:
+                with self.outbox_cond:
+                    self.closed = True
+                    self.outbox.clear()
+                return
+
+    def send_stream(self, request_id, fileobj, size, chunk_size=DATA_CHUNK_SIZE, progress=None):
+        # Send `size` bytes from fileobj as a sequence of DATA frames, compressed when a codec was negotiated
+        compressor = FrameCompressor(self.codec) if self.codec is not None else None
+        if compressor:
+            chunk_size = max(chunk_size, COMPRESS_CHUNK_SIZE)
+        sent = 0
+        while sent < size:
+            chunk = fileobj.read(min(chunk_size, size - sent))
+            if not chunk:
+                raise ProtocolError("File ended before the announced size")
+            compressed, payload = compressor.pack(chunk) if compressor else (False, chunk)
+            self.pace(len(payload))
+            self.send_frame(OP_DATA, request_id, payload, FLAG_COMPRESSED if compressed else 0)
+            sent += len(chunk)
+            if progress:
+                progress(sent, size)
+        return sent
+
+    def send_file(self, request_id, fileobj, offset, count, chunk_size=SENDFILE_CHUNK_SIZE, progress=None):
+        # Send `count` bytes of a real file starting at `offset` as DATA frames.
+        # socket.sendfile lets the kernel copy file pages straight to the socket (os.sendfile)
+        # and falls back to read()+send() on platforms or file objects that cannot do that.
+        # The send lock is released between frames so notifications can still get through.
+        sent = 0
+        if self.codec is not None:
+            # With compression the bytes have to pass through Python after all. Content that
+            # turns out not to shrink goes back to sendfile for the rest of the range.
+            compressor = FrameCompressor(self.codec)
+            while sent < count and compressor.enabled:
+                fileobj.seek(offset + sent)
+                chunk = fileobj.read(min(COMPRESS_CHUNK_SIZE, count - sent))
+                if not chunk:
+                    raise ProtocolError("File ended before the announced size")
+                compressed, payload = compressor.pack(chunk)
+                self.pace(len(payload))
+                self.send_frame(OP_DATA, request_id, payload, FLAG_COMPRESSED if compressed else 0)
+                sent += len(chunk)
+                if progress:
+                    progress(sent, count)
+        if self.throttle is not None:
+            chunk_size = self.throttle.frame_size(chunk_size)
+        while sent < count:
+            length = min(chunk_size, count - sent)
+            header = HEADER.pack(OP_DATA, 0, request_id, length)
+            self.pace(length)
+            if self.sendfile_frame(header, fileobj, offset + sent, length) != length:
+                raise ProtocolError("File ended before the announced size")
+            sent += length
+            if progress:
+                progress(sent, count)
+        return sent
+
+    def send_stored(self, request_id, fileobj, offset, count):
+        # Send bytes that are stored compressed with the negotiated codec as one compressed
+        # DATA frame, straight from the file without decompressing them
+        header = HEADER.pack(OP_DATA, FLAG_COMPRESSED, request_id, count)
+        self.pace(count)
+        if self.sendfile_frame(header, fileobj, offset, count) != count:
+            raise ProtocolError("File ended before the announced size")
+
+    def sendfile_frame(self, header, fileobj, offset, length):
+        # Write a frame header and `length` bytes of fileobj as its payload; returns the bytes sent
+        with self.send_lock:
+            self.sock.sendall(header)
+            sent = self.sock.sendfile(fileobj, offset, length)
+            self.bytes_sent += len(header) + sent
+            return sent
+
+    # ---- receiving -----------------------------------------------------
+
+    def recv_some(self, view):
+        # Receive at most len(view) bytes into view, 0 means the peer closed the connection
+        count = self.sock.recv_into(view)
+        self.bytes_received += count
+        return count
+
+    def recv_exact(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.recv_some(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed by peer")
+            received += count
+        return buffer
+
+    def recv_header(self):
+        # Returns (opcode, flags, request_id, length) or None on a clean close
+        header = bytearray(HEADER_SIZE)
+        view = memoryview(header)
+        received = self.recv_some(view)
+        if not received:
+            return None
+        while received < HEADER_SIZE:
+            count = self.recv_some(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed by peer")
+            received += count
+        return HEADER.unpack(header)
+
+    def read_frame(self, max_payload=MAX_MESSAGE_SIZE):
+        # Read the next frame from the socket, ignoring the pending queue
+        header = self.recv_header()
+        if header is None:
+            return None
+        return self.read_payload(header, max_payload)
+
+    def read_payload(self, header, max_payload=MAX_MESSAGE_SIZE):
+        # Read the payload that follows an already received header
+        opcode, flags, request_id, length = header
+        if length > max_payload:
+            raise ProtocolError(f"Frame too large: {length} bytes ({OP_NAMES.get(opcode, opcode)})")
+        payload = self.recv_exact(length) if length else b""
+        return Frame(opcode, flags, request_id, payload)
+
+    def recv_frame(self, max_payload=MAX_MESSAGE_SIZE):
+        # Next frame, including ones put aside while another request was being served
+        if self.pending:
+            return self.pending.popleft()
+        return self.read_frame(max_payload)
+
+    def defer(self, frame):
+        # Keep a frame that belongs to another request for a later recv_frame call
+        if len(self.pending) >= MAX_PENDING_FRAMES:
+            raise ProtocolError("Too many pipelined frames")
+        self.pending.append(frame)
+
+    def take_pending(self, request_id):
+        # Remove and return the oldest deferred frame of `request_id`, if there is one
+        for index, frame in enumerate(self.pending):
+            if frame.request_id == request_id:
+                del self.pending[index]
+                return frame
+        return None
+
+    def recv_reply(self, request_id, max_payload=MAX_MESSAGE_SIZE):
+        # Wait for the next frame of `request_id`, deferring everything else
+        frame = self.take_pending(request_id)
+        if frame is not None:
+            return frame
+        while True:
+            frame = self.read_frame(max_payload)
+            if frame is None:
+                raise ConnectionError("Connection closed by peer")
+            if frame.request_id == request_id:
+                return frame
+            self.defer(frame)
+
+    def receive_stream(self, request_id, fileobj, size, progress=None, buffer=None):
+        """
+        Write the DATA frames of `request_id` to fileobj until `size` bytes arrived.
+        DATA payloads are never materialised as bytes objects: they are received with
+        recv_into straight into `buffer` (a reusable bytearray) and written from a memoryview.
+        Frames of other requests are read whole and deferred as usual, compressed DATA
+        frames are read whole and decompressed.
+        """
+        view = memoryview(buffer if buffer is not None else bytearray(RECEIVE_BUFFER_SIZE))
+        received = 0
+        while received < size:
+            remaining = size - received
+            frame = self.take_pending(request_id)
+            if frame is None:
+                header = self.recv_header()
+                if header is None:
+                    raise ConnectionError("Connection closed by peer")
+                opcode, flags, frame_request_id, length = header
+                if opcode == OP_DATA and frame_request_id == request_id and not flags & FLAG_COMPRESSED:
+                    # Fast path: stream the payload through the reusable buffer
+                    if length > remaining:
+                        raise ProtocolError("DATA frame exceeds the announced size")
+                    while length:
+                        count = self.recv_some(view[:min(length, len(view))])
+                        if not count:
+                            raise ConnectionError("Connection closed by peer")
+                        fileobj.write(view[:count])
+                        self.pace(count)
+                        length -= count
+                        received += count
+                        if progress:
+                            progress(received, size)
+                    continue
+                frame = self.read_payload(header)
+                if frame_request_id != request_id:
+                    self.defer(frame)
+                    continue
+            # A complete frame of this request: a deferred DATA frame, an ERROR or garbage
+            if frame.opcode == OP_ERROR:
+                raise ProtocolError(frame.fields().get("message", "Transfer failed"))
+            if frame.opcode != OP_DATA:
+                raise ProtocolError(f"Unexpected {frame.name} frame during transfer")
+            payload = frame.payload
+            if frame.flags & FLAG_COMPRESSED:
+                payload = self.decompress(payload, remaining)
+            if len(payload) > remaining:
+                raise ProtocolError("DATA frame exceeds the announced size")
+            fileobj.write(payload)
+            self.pace(len(frame.payload))
+            received += len(payload)
+            if progress:
+                progress(received, size)
+        return received
+
+    def decompress(self, payload, limit):
+        # Payload of a compressed DATA frame; more than limit bytes of output is an error
+        if self.codec is None:
+            raise ProtocolError("Compressed DATA frame, but no compression was negotiated")
+        try:
+            return self.codec.decompress(bytes(payload), limit)
+        except ValueError as e:
+            raise ProtocolError(str(e))
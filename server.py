@@ -1,39 +1,205 @@
-import tkinter as tk
-from tkinter import ttk, filedialog
 import socket
 import threading
 import os
+import io
+import sys
+import json
+import queue
+import signal
 import logging
+import argparse
+import functools
 import time
+import secrets
 from datetime import datetime
+from async_server import AsyncServerEngine
+from file_index import FileIndex, FileEntry
+from catalog import Catalog, CATALOG_FILE
+from journal import Journal, JOURNAL_FILE, quarantine
+from bandwidth import BandwidthScheduler
+from storage import FlatStore, BlobStore, file_name
+from upload_sessions import UploadSessionManager
+from download_cache import DownloadCache, build_frames
+from liveness import LivenessMonitor, enable_keepalive
+from metrics import Metrics, ByteCounters, MetricsHTTPServer, TimedWriter, DISK_BUCKETS
+import delta
+import compression
+from protocol import (
+    FrameSocket, ProtocolError, encode_message,
+    OP_HELLO, OP_OK, OP_ERROR, OP_NOTIFICATION, OP_EXIT, OP_PING, OP_PONG,
+    OP_LIST, OP_UPLOAD, OP_DOWNLOAD, OP_DELETE, OP_UPDATE,
+    OP_SESSION_OPEN, OP_SESSION_CHUNK, OP_SESSION_STATUS, OP_SESSION_COMMIT,
+    OP_SIGNATURE, OP_STATS, OP_READY, OP_DATA, OP_CANCEL, OP_NAMES,
+    OP_MULTI_DELETE, OP_MULTI_STAT, OP_MULTI_DOWNLOAD, MAX_BATCH_ITEMS,
+    OP_WATCH, MAX_CHANGES_PER_FRAME,
+)
+
+# Commands that may move file content; is_bulk() tells which ones move more than a small transfer
+BULK_OPCODES = frozenset((OP_UPLOAD, OP_UPDATE, OP_DOWNLOAD, OP_MULTI_DOWNLOAD, OP_SESSION_CHUNK))
+
+ENGINES = ["threaded", "asyncio"]  # Available connection engines
+STORAGE_MODES = ["flat", "dedup"]  # Plain files or the content-addressed chunk store
+
+# Label sets of the metrics, built once so recording a sample allocates nothing
+UPLOAD_LABELS = (("direction", "upload"),)
+DOWNLOAD_LABELS = (("direction", "download"),)
+WRITE_LABELS = (("op", "write"),)
+COMMIT_LABELS = (("op", "commit"),)
+CATALOG_LABELS = (("op", "catalog"),)
+JOURNAL_LABELS = (("op", "journal"),)
+
 
 class FileServer:
-    def __init__(self):
-        # Create the root window for the GUI
-        self.root = tk.Tk()
-        self.root.title("Cloud File System Server")  # Set the title of the window
-        self.root.geometry("800x600")  # Set the initial size of the window
-        self.root.minsize(600, 500)  # Set the minimum size of the window
-        
+    """
+    Protocol engine of the cloud file server. It does not depend on Tkinter: the GUI in
+    server_gui.py is an optional observer that reads log and state events from event_queue.
+    """
+
+    def __init__(self, upload_dir=None, port=12345, engine="threaded", max_workers=32,
+                 listen_backlog=1024, max_connections=None, max_file_size=None,
+                 receive_buffer_size=1024 * 1024, write_buffer_size=1024 * 1024,
+                 storage="flat", chunk_size=256 * 1024, session_ttl=24 * 3600,
+                 compression_codecs=None, compress_at_rest=None,
+                 cache_size=64 * 1024 * 1024, cache_max_file=None, ping_interval=30, ping_timeout=10,
+                 metrics_port=None, metrics_host="127.0.0.1", check_catalog=False,
+                 checkpoint_every=10000, bandwidth_limit=None, user_bandwidth_limit=None,
+                 user_bandwidth_limits=None, user_weights=None, small_transfer=1024 * 1024):
         # Server variables
         self.server_socket = None  # Placeholder for the server socket object
         self.is_running = False  # Boolean flag to track if the server is running
         self.clients = {}  # Dictionary to keep track of connected clients
-        self.upload_dir = os.path.join(os.getcwd(), "uploaded_files")  # Default folder for uploaded files
-        self.chunk_size = 4096  # Size of data chunks to be sent/received over the socket (in bytes)
+        self.upload_dir = upload_dir or os.path.join(os.getcwd(), "uploaded_files")  # Folder for uploaded files
+        self.port = port  # TCP port to listen on
+        self.receive_buffer_size = receive_buffer_size  # recv_into buffer reused by every upload of a thread (in bytes)
+        self.write_buffer_size = write_buffer_size  # Buffer of the file writer behind the receive buffer (in bytes)
+        self.progress_interval = 1.0  # Seconds between two transfer progress log lines
+        self.receive_buffers = threading.local()  # One preallocated receive buffer per handler thread
         self.socket_timeout = 30  # Timeout for the socket operations in seconds
-        self.used_usernames = set()  # Set to track usernames that have ever connected
+        self.listen_backlog = listen_backlog  # Pending connections the kernel queues for accept()
+        self.engine_name = engine  # "threaded" or "asyncio"
+        self.engine = None  # AsyncServerEngine while the asyncio engine is running
+        self.max_workers = max_workers  # Command threads of the asyncio engine
+        self.max_connections = max_connections  # Maximum logged in clients, None for no limit
+        self.max_file_size = max_file_size  # Largest accepted upload in bytes, None for no limit
+        self.used_usernames = set()  # Set to track usernames that have ever connected, loaded from the catalog
+        self.resume_tokens = {}  # username -> token that lets the same client log in again
+        self.attached = {}  # Extra transfer connections of logged in clients: conn -> username
+        self.watchers = set()  # Connections that get the changes of the file list pushed (WATCH)
+        self.max_streams_per_client = 16  # Extra connections a client may attach for parallel transfers
+        self.event_queue = None  # Set by an observer (the GUI) that wants log and state events
+        self.storage_mode = storage  # "flat" or "dedup"
+        self.chunk_size = chunk_size  # Chunk size of the dedup store (in bytes)
+        self.store = None  # FlatStore or BlobStore, created at start
+        self.catalog = None  # Catalog of files and usernames in the storage folder, opened at start
+        self.check_catalog = check_catalog  # Check the catalog against the store even after a clean stop
+        self.journal = None  # Write-ahead journal in front of the catalog, opened at start
+        self.checkpoint_every = checkpoint_every  # Journaled changes between two checkpoints
+        # Shares out the bytes/s of file content (global and per user), small transfers first
+        self.bandwidth = BandwidthScheduler(small_transfer=small_transfer)
+        self.bandwidth.set_limits(bandwidth_limit, user_bandwidth_limit, user_bandwidth_limits, user_weights)
+        self.compression_codecs = (compression.PREFERENCE if compression_codecs is None
+                                   else list(compression_codecs))  # Codecs clients may pick for DATA frames
+        self.compress_at_rest = compress_at_rest  # Codec the dedup store compresses chunk files with, or None
+        self.session_ttl = session_ttl  # Seconds an unfinished upload session is kept
+        self.cache_size = cache_size  # Byte budget of the download cache, 0 to disable it
+        self.cache_max_file = cache_max_file  # Largest file kept in the cache, None for 1/16 of the budget
+        self.download_cache = None  # DownloadCache, created at start
+        # PING after ping_interval idle seconds, drop the client if nothing arrives within ping_timeout
+        self.liveness = LivenessMonitor(ping_interval, ping_timeout, self.reap_client)
+        self.upload_sessions = None  # UploadSessionManager, created at start
+        self.metrics_port = metrics_port  # Port of the Prometheus text listener, None to not open one
+        self.metrics_host = metrics_host
+        self.metrics_server = None  # MetricsHTTPServer while it is listening
+        self.setup_metrics()
+        self.index = FileIndex()  # In-memory metadata of the stored files, built at start
+        # Changes are journaled, then written to the catalog, then announced to watchers
+        self.index.listeners.append(self.journal_changes)
+        self.index.listeners.append(self.sync_catalog)
+        self.index.listeners.append(self.announce_changes)
+        self.index.hash_listeners.append(self.catalog_hash)
+        self.list_page_size = 200  # Default number of entries in a LIST page
+        self.max_list_page_size = 1000  # Largest LIST page a client may ask for
+        # Map each command opcode to the method that serves it
+        self.command_handlers = {
+            OP_UPLOAD: self.handle_upload,
+            OP_DOWNLOAD: self.handle_download,
+            OP_LIST: self.handle_list,
+            OP_DELETE: self.handle_delete,
+            OP_UPDATE: self.handle_update,
+            OP_SESSION_OPEN: self.handle_session_open,
+            OP_SESSION_CHUNK: self.handle_session_chunk,
+            OP_SESSION_STATUS: self.handle_session_status,
+            OP_SESSION_COMMIT: self.handle_session_commit,
+            OP_SIGNATURE: self.handle_signature,
+            OP_STATS: self.handle_stats,
+            OP_MULTI_DELETE: self.handle_multi_delete,
+            OP_MULTI_STAT: self.handle_multi_stat,
+            OP_MULTI_DOWNLOAD: self.handle_multi_download,
+            OP_WATCH: self.handle_watch,
+        }
+        self.command_labels = {opcode: (("command", OP_NAMES[opcode]),) for opcode in self.command_handlers}
 
         # Logger settings
         self.setup_logger()  # Initialize the logger for server activities
-        
-        # Create GUI components
-        self.setup_gui()  # Setup the graphical user interface components
-        
-        # Capture the window close event
-        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)  # Define actions to perform on window close
 
 
+    def setup_metrics(self):
+        # Counters and histograms are recorded per thread and summed when scraped; values the
+        # server keeps anyway (clients, cache statistics) are read by collect_metrics on scrape
+        self.metrics = Metrics()
+        self.byte_counters = ByteCounters()
+        self.command_seconds = self.metrics.histogram(
+            "fileserver_command_seconds", "Time from receiving a command to finishing its reply")
+        self.error_replies = self.metrics.counter(
+            "fileserver_error_replies_total", "ERROR frames sent in reply to a request")
+        self.active_transfers = self.metrics.gauge(
+            "fileserver_active_transfers", "Uploads and downloads moving file content right now")
+        self.disk_write_seconds = self.metrics.histogram(
+            "fileserver_disk_write_seconds", "Duration of store writes (op=write) and of commits with fsync "
+            "and rename (op=commit), of catalog commits (op=catalog) and journal appends (op=journal)", DISK_BUCKETS)
+        self.command_queue = self.metrics.gauge(
+            "fileserver_command_queue_depth", "Commands waiting for a worker thread of the asyncio engine")
+        self.notifications_sent = self.metrics.counter(
+            "fileserver_notifications_total", "Notifications queued for a connected client")
+        self.metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        # Gauges and counters read from the server state at scrape time
+        clients = list(self.clients.values())
+        yield ("fileserver_connected_clients", "gauge", "Logged in clients", (), len(clients))
+        yield ("fileserver_attached_streams", "gauge", "Extra connections of parallel transfers", (), len(self.attached))
+        yield ("fileserver_outbox_depth", "gauge", "Pushed messages waiting in the outboxes of all clients", (),
+               sum(len(conn.outbox) + conn.outbox_overflow for conn in clients))
+        sent, received = self.byte_counters.totals()
+        yield ("fileserver_sent_bytes_total", "counter", "Bytes written to client connections", (), sent)
+        yield ("fileserver_received_bytes_total", "counter", "Bytes read from client connections", (), received)
+        yield ("fileserver_files", "gauge", "Files in the index", (), len(self.index))
+        yield ("fileserver_index_changes_total", "counter", "Changes of the file index since start", (),
+               self.index.sequence)
+        yield ("fileserver_watchers", "gauge", "Connections receiving listing changes", (), len(self.watchers))
+        if self.upload_sessions is not None:
+            yield ("fileserver_upload_sessions", "gauge", "Open resumable upload sessions", (),
+                   len(self.upload_sessions.sessions))
+        bandwidth = self.bandwidth.stats()
+        yield ("fileserver_bandwidth_limit_bytes", "gauge", "Global bandwidth limit in bytes/s, 0 for none", (),
+               bandwidth["limit"] or 0)
+        yield ("fileserver_bandwidth_waiting", "gauge", "Transfers waiting for their bandwidth share", (),
+               bandwidth["waiting"])
+        yield ("fileserver_bandwidth_wait_seconds_total", "counter", "Time transfers spent waiting for bandwidth",
+               (), bandwidth["wait_seconds"])
+        yield ("fileserver_pings_total", "counter", "PINGs sent to idle clients", (), self.liveness.pings)
+        yield ("fileserver_reaped_connections_total", "counter", "Clients dropped for not answering a PING", (),
+               self.liveness.reaped)
+        if self.download_cache is not None:
+            stats = self.download_cache.stats()
+            for name in ("hits", "misses", "evictions", "rejections", "bypasses", "invalidations"):
+                yield (f"fileserver_download_cache_{name}_total", "counter", f"Download cache {name}", (), stats[name])
+            yield ("fileserver_download_cache_entries", "gauge", "Files in the download cache", (), stats["entries"])
+            yield ("fileserver_download_cache_bytes", "gauge", "Bytes held by the download cache", (), stats["bytes"])
+            lookups = stats["hits"] + stats["misses"]
+            yield ("fileserver_download_cache_hit_ratio", "gauge", "Share of cache lookups that were hits", (),
+                   stats["hits"] / lookups if lookups else 0.0)
+
     def setup_logger(self):
         # Configure logging settings
         logging.basicConfig(
@@ -47,90 +213,8 @@ class FileServer:
         # Create a logger instance for the class
         self.logger = logging.getLogger(__name__)
 
-
-    def setup_gui(self):
-        # Main container for the GUI
-        self.main_container = ttk.Frame(self.root)
-        self.main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-
-        # Server control frame
-        control_frame = ttk.LabelFrame(self.main_container, text="Server Control")
-        control_frame.pack(fill=tk.X, padx=5, pady=5)
-
-        # Frame for port and folder settings
-        settings_frame = ttk.Frame(control_frame)
-        settings_frame.pack(fill=tk.X, padx=5, pady=5)
-
-        # Port settings
-        port_frame = ttk.Frame(settings_frame)
-        port_frame.pack(fill=tk.X, padx=5, pady=5)
-            
-        # Port label and entry field
-        ttk.Label(port_frame, text="Port:").pack(side=tk.LEFT, padx=(0, 5))
-        self.port_entry = ttk.Entry(port_frame, width=10)
-        self.port_entry.insert(0, "12345")  # Default port value
-        self.port_entry.pack(side=tk.LEFT)
-
-        # Folder selection
-        folder_frame = ttk.Frame(settings_frame)
-        folder_frame.pack(fill=tk.X, padx=5, pady=5)
-        
-        # Folder label and entry field
-        ttk.Label(folder_frame, text="File:").pack(side=tk.LEFT, padx=(0, 5))
-        self.folder_entry = ttk.Entry(folder_frame)
-        self.folder_entry.insert(0, self.upload_dir)  # Default folder path
-        self.folder_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
-
-        # Browse button to select a folder
-        self.browse_button = ttk.Button(
-            folder_frame,
-            text="Browse",
-            command=self.browse_folder  # Calls browse_folder method when clicked
-        )
-        self.browse_button.pack(side=tk.LEFT)
-
-        # Start/Stop button to toggle the server state
-        self.toggle_button = ttk.Button(
-            settings_frame, 
-            text="Start Server",
-            command=self.toggle_server  # Calls toggle_server method when clicked
-        )
-        self.toggle_button.pack(pady=10)
-
-        # Log frame to display server logs
-        log_frame = ttk.LabelFrame(self.main_container, text="Server Logs")
-        log_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-        # Container for the log text area and scrollbar
-        log_container = ttk.Frame(log_frame)
-        log_container.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-        # Scrollbar for the log text area
-        scrollbar = ttk.Scrollbar(log_container)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
-        # Log text area for displaying log messages
-        self.log_text = tk.Text(
-            log_container,
-            yscrollcommand=scrollbar.set,  # Connect scrollbar to the text widget
-            wrap=tk.WORD,
-            height=20
-        )
-        self.log_text.pack(fill=tk.BOTH, expand=True)
-        
-        # Configure scrollbar to control the log text view
-        scrollbar.config(command=self.log_text.yview)
-
             
     def log_message(self, message, level="INFO"):
-        # Create a timestamp for the log message
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        formatted_message = f"[{timestamp}] {level}: {message}\n"
-        
-        # Add the log message to the GUI log text area
-        self.log_text.insert(tk.END, formatted_message)
-        self.log_text.see(tk.END)  # Scroll to the end to show the latest message
-        
         # Save the log message to the log file
         if level == "INFO":
             self.logger.info(message)
@@ -139,98 +223,215 @@ class FileServer:
         elif level == "WARNING":
             self.logger.warning(message)
         
-        # Update the GUI to reflect the changes
-        self.root.update_idletasks()
+        # Hand the message to the observer; worker threads never touch the GUI themselves
+        if self.event_queue is not None:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.emit_event("log", f"[{timestamp}] {level}: {message}\n")
 
-    def run(self):
-        # Start the main event loop for the GUI
-        self.root.mainloop()
+    def emit_event(self, kind, value):
+        # Non-blocking hand-off to the observer, events are dropped if it falls behind
+        try:
+            self.event_queue.put_nowait((kind, value))
+        except queue.Full:
+            pass
 
-    def toggle_server(self):
-        # Start or stop the server based on its current status
-        if not self.is_running:
-            try:
-                # Check if the folder selection is valid
-                selected_folder = self.folder_entry.get().strip()
-                if not selected_folder:
-                    self.log_message("Please choose a folder!", "ERROR")
-                    return
-                    
-                # Update the upload directory
-                self.upload_dir = selected_folder
-                # Create the folder if it does not exist
-                try:
-                    os.makedirs(self.upload_dir, exist_ok=True)
-                    self.log_message(f"Running folder: {self.upload_dir}")
-                except Exception as e:
-                    self.log_message(f"Folder creation error: {str(e)}", "ERROR")
-                    return
+    def start_server(self):
+        # Bind the listening socket and start the selected engine. Raises on failure.
+        if self.is_running:
+            return
+        if not self.upload_dir:
+            raise ValueError("Please choose a folder!")
+        # Create the folder if it does not exist
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.log_message(f"Running folder: {self.upload_dir}")
 
-                # Validate the port number
-                port = int(self.port_entry.get())
-                if not 1024 <= port <= 65535:
-                    self.log_message("Port number must be between 1024 and 65535!", "ERROR")
-                    return
-                    
+        # Validate the port number
+        if not 1024 <= self.port <= 65535:
+            raise ValueError("Port number must be between 1024 and 65535!")
+        if self.engine_name not in ENGINES:
+            raise ValueError(f"Unknown engine: {self.engine_name}")
+        if self.storage_mode not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode: {self.storage_mode}")
+
+        # Load the index from the catalog, from now on it is kept current by the handlers
+        self.open_metadata()
+        self.log_message(f"File index loaded: {len(self.index)} files ({self.storage_mode} storage)")
+
+        # Hot downloads are served from memory, the cache starts empty on every start
+        self.download_cache = DownloadCache(self.cache_size, self.cache_max_file) if self.cache_size else None
+
+        # Clients that stop answering are found by PING/PONG, without sweeping all of them
+        self.liveness.start()
+        self.bandwidth.start()
+
+        # Prometheus scrapes go to their own small HTTP listener, off the file protocol port
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsHTTPServer(self.metrics, self.metrics_host, self.metrics_port)
+            self.metrics_server.start()
+            self.log_message(f"Metrics listening on http://{self.metrics_host}:{self.metrics_server.port}/metrics")
+
+        # Upload sessions left open by a previous run can be continued
+        self.upload_sessions = UploadSessionManager(os.path.join(self.upload_dir, ".sessions"), ttl=self.session_ttl)
+        open_sessions = self.upload_sessions.load()
+        if open_sessions:
+            self.log_message(f"Upload sessions restored: {open_sessions}")
+
+        try:
+            if self.engine_name == "asyncio":
+                # Serve every connection from one event loop, commands run in a thread pool
+                self.is_running = True
+                self.engine = AsyncServerEngine(self, max_workers=self.max_workers, backlog=self.listen_backlog)
+                self.engine.start('0.0.0.0', self.port)
+            else:
                 # Create and configure the server socket
                 self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 self.server_socket.settimeout(self.socket_timeout)
-                self.server_socket.bind(('0.0.0.0', port))
-                self.server_socket.listen(5)
-                    
-                # Update server status and GUI controls
+                self.server_socket.bind(('0.0.0.0', self.port))
+                self.server_socket.listen(self.listen_backlog)
                 self.is_running = True
-                self.toggle_button.config(text="Stop Server")
-                self.port_entry.config(state='disabled')
-                self.folder_entry.config(state='disabled')
-                self.browse_button.config(state='disabled')
-                    
+                
                 # Start a new thread to accept client connections
                 self.accept_thread = threading.Thread(target=self.accept_connections)
                 self.accept_thread.daemon = True
                 self.accept_thread.start()
-                    
-                self.log_message(f"Server started on port {port}!")
-                
-            except Exception as e:
-                # Log error message if the server fails to start
-                self.log_message(f"Server starting error: {str(e)}", "ERROR")
-                self.cleanup_server()
-        else:
-            # Stop the server if it is currently running
+        except Exception:
             self.cleanup_server()
-            self.log_message("Server stopped.")
-
-    def browse_folder(self):
-            # Open a dialog to select a folder
-            folder = filedialog.askdirectory(
-                title="Choose file folder",
-                initialdir=self.upload_dir
-            )
-            if folder:
-                # Get the absolute path of the selected folder
-                self.upload_dir = os.path.abspath(folder) 
-                # Update the folder entry field with the selected path 
-                self.folder_entry.delete(0, tk.END)
-                self.folder_entry.insert(0, self.upload_dir)
-                # Check and create the folder if it doesn't exist
-                try:
-                    os.makedirs(self.upload_dir, exist_ok=True)
-                    self.log_message(f"Running folder is changed: {self.upload_dir}")
-                    
-                    # If the server is running, stop it and restart with the new folder
-                    if self.is_running:
-                        self.cleanup_server()
-                        self.toggle_server()
-                except Exception as e:
-                    self.log_message(f"Folder creation error: {str(e)}", "ERROR")
-    
+            raise
+
+        if self.event_queue is not None:
+            self.emit_event("state", True)
+        self.log_message(f"Server started on port {self.port} ({self.engine_name} engine)!")
+
+    def open_metadata(self):
+        # Open the store, the catalog and the journal, and load the index and the username
+        # registry from the catalog. What the journal holds since its last checkpoint is
+        # replayed first, so after a crash only the files of interrupted writes are looked at.
+        # Without a journal to tell what changed, an unclean catalog is checked against the
+        # whole store.
+        self.store = self.create_store()
+        self.store.load()
+        self.catalog = Catalog(os.path.join(self.upload_dir, CATALOG_FILE))
+        self.journal = Journal(os.path.join(self.upload_dir, JOURNAL_FILE), self.checkpoint_every)
+        clean = self.catalog.open()
+        recovery = self.journal.open()
+        if recovery:
+            self.recover(recovery)
+        if self.check_catalog or (recovery is None and not clean):
+            report = self.catalog.check(self.store, fix=True)
+            self.log_message(f"Catalog checked: {report['files']} files, {len(report['missing'])} added, "
+                             f"{len(report['vanished'])} removed, {len(report['changed'])} changed")
+        self.index.load((FileEntry(*row) for row in self.catalog.entries()), self.store)
+        self.catalog.sequence = self.journal.sequence = self.index.sequence
+        # The catalog has everything the journal held, it starts empty
+        self.checkpoint()
+        self.resume_tokens = self.catalog.users()
+        self.used_usernames = set(self.resume_tokens)
+
+    def recover(self, recovery):
+        # Bring the catalog forward after a crash: replay the journaled changes, quarantine what
+        # the interrupted writes staged and compare their files with the catalog
+        self.catalog.replay(recovery.changes)
+        interrupted = sorted(recovery.interrupted)
+        staged = []
+        for name in interrupted:
+            try:
+                staged.extend(self.store.staged_files(name))
+            except FileNotFoundError:
+                pass
+        moved = quarantine(staged, self.upload_dir)
+        report = self.catalog.check(self.store, fix=True, names=interrupted)
+        self.log_message(f"Journal replayed: {len(recovery.changes)} changes, {len(interrupted)} interrupted "
+                         f"writes, {len(report['changed']) + len(report['missing']) + len(report['vanished'])} "
+                         f"files corrected, {len(moved)} staged files quarantined")
+        if recovery.torn:
+            self.log_message("The journal ended in a damaged record, it was dropped", "WARNING")
+        for path in moved:
+            self.log_message(f"Quarantined: {path}", "WARNING")
+
+    def checkpoint(self):
+        # Make the catalog durable and drop the journaled changes it holds
+        self.journal.checkpoint(self.catalog.checkpoint())
+
+    def journal_changes(self):
+        # Index listener: the changes are on disk in the journal before anyone else sees them
+        if self.journal is not None:
+            with self.disk_write_seconds.time(JOURNAL_LABELS):
+                self.journal.log_changes(self.index)
+
+    def sync_catalog(self):
+        # Index listener: commit the changes before the handler replies
+        if self.catalog is not None:
+            with self.disk_write_seconds.time(CATALOG_LABELS):
+                self.catalog.sync(self.index)
+            if self.journal.due():
+                self.checkpoint()
+
+    def catalog_hash(self, name, digest):
+        if self.catalog is not None:
+            self.catalog.set_hash(name, digest)
+
+    def count_download(self, filename):
+        self.index.count_download(filename)
+        if self.catalog is not None:
+            self.catalog.count_download(filename)
+
+    def create_store(self):
+        if self.storage_mode == "dedup":
+            # Chunks are compressed one by one, so a download can send them in their stored form
+            return BlobStore(self.upload_dir, chunk_size=self.chunk_size,
+                             codec=compression.storage_codec(self.compress_at_rest))
+        if self.compress_at_rest:
+            self.log_message("Compression at rest needs the dedup storage, files are stored as is", "WARNING")
+        return FlatStore(self.upload_dir, write_buffer_size=self.write_buffer_size)
+
+    def set_bandwidth(self, limit, user_limit, user_limits=None, weights=None):
+        # Change the bandwidth limits (bytes/s, None for no limit), also while transfers run
+        self.bandwidth.set_limits(limit, user_limit, user_limits, weights)
+        self.log_message(f"Bandwidth limit: {self.format_rate(limit)} in total, "
+                         f"{self.format_rate(user_limit)} per user"
+                         + (f", {len(user_limits)} users with their own limit" if user_limits else ""))
+
+    def format_rate(self, rate):
+        return f"{self.format_size(rate)}/s" if rate else "unlimited"
+
+    def is_bulk(self, frame):
+        # Commands that move more file content than a small transfer. The asyncio engine runs
+        # them on their own workers, so they never hold up listings and small files.
+        if frame is None or frame.opcode not in BULK_OPCODES:
+            return False
+        try:
+            fields = frame.fields()
+            if frame.opcode == OP_DOWNLOAD:
+                entry = self.index.get(os.path.basename(str(fields["filename"])))
+                size = entry.size - int(fields.get("offset") or 0) if entry is not None else 0
+                if fields.get("length") is not None:
+                    size = min(size, int(fields["length"]))
+            elif frame.opcode in (OP_UPLOAD, OP_UPDATE):
+                size = int(fields["filesize"])
+            else:
+                return True
+        except Exception:
+            return True  # The handler reports the broken command
+        return size > self.bandwidth.small_transfer
+
+    def features(self):
+        # Optional protocol features announced in the HELLO reply
+        features = {}
+        if self.store is not None and self.store.dedup:
+            features["dedup"] = {"chunk_size": self.store.chunk_size, "hash": "sha256"}
+        if self.upload_sessions is not None:
+            features["sessions"] = {"chunk_size": self.upload_sessions.default_chunk_size}
+        features["delta"] = {"weak": "adler32", "strong": "blake2b-128"}
+        features["batch"] = {"max_items": MAX_BATCH_ITEMS}
+        features["watch"] = {"epoch": self.index.epoch}
+        return features
+
     def cleanup_server(self):
         # Set server status to not running
         self.is_running = False
         # Close all client connections
-        for username, client in self.clients.items():
+        for username, client in list(self.clients.items()):
             try:
                 client.close()
                 self.log_message(f"{username} disconnected")
@@ -247,12 +448,31 @@ class FileServer:
                 self.log_message(f"Error: {str(e)}", "ERROR")
             # Set server socket to None after closing
             self.server_socket = None
-        
-        # Update the GUI to reflect the server stopped state
-        self.toggle_button.config(text="Start Server")
-        self.port_entry.config(state='normal')
-        self.folder_entry.config(state='normal')
-        self.browse_button.config(state='normal')
+
+        # Stop the event loop of the asyncio engine
+        if self.engine:
+            try:
+                self.engine.stop()
+            except Exception as e:
+                self.log_message(f"Error: {str(e)}", "ERROR")
+            self.engine = None
+
+        if self.download_cache is not None:
+            self.log_message(f"Download cache: {self.download_cache.stats()}")
+        self.liveness.stop()
+        self.bandwidth.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        # Marks the catalog clean and empties the journal, the next start has nothing to replay
+        if self.catalog is not None:
+            self.catalog.close()
+            self.journal.checkpoint(self.catalog.sequence)
+            self.journal.close()
+
+        # Let the observer reflect the stopped state
+        if self.event_queue is not None:
+            self.emit_event("state", False)
 
     def accept_connections(self):
             # Continuously accept incoming client connections while the server is running
@@ -262,6 +482,11 @@ class FileServer:
                     client_socket, address = self.server_socket.accept()
                     # Set the socket timeout for the client
                     client_socket.settimeout(self.socket_timeout)
+                    # Small frames (replies, notifications, a header before its sendfile payload)
+                    # must not wait for the ACK of the previous segment; asyncio sets this itself
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    # Let the kernel notice vanished peers, also in the middle of a transfer
+                    enable_keepalive(client_socket)
                     
                     # Start a new thread to handle the client
                     client_thread = threading.Thread(
@@ -280,152 +505,201 @@ class FileServer:
                     if self.is_running:
                         self.log_message(f"Connection accept error: {str(e)}", "ERROR")
 
-    def safe_send(self, socket, message, retries=3, timeout=5.0):
-        # Store the original timeout of the socket
-        original_timeout = socket.gettimeout()
-        # Set the socket timeout for the send operation
-        socket.settimeout(timeout)
-        
+    def safe_send(self, conn, opcode, request_id=0, **fields):
+        # Send a framed control message, returning False instead of raising on failure.
+        # A frame is never retried: a partially written frame would desynchronise the stream.
         try:
-            # Attempt to send the message up to the specified number of retries
-            for attempt in range(retries):
-                try:
-                    # If the message is a string, encode it to bytes
-                    if isinstance(message, str):
-                        message = message.encode()
-                    # Send the entire message to the socket
-                    socket.sendall(message)
-                    return True  # Return True if the message is successfully sent
-                except socket.timeout as e:
-                    # Log a warning if sending times out
-                    self.log_message(f"Send timeout, attempt {attempt + 1}/{retries}: {str(e)}", "WARNING")
-                    if attempt < retries - 1:
-                        time.sleep(1)  # Wait before retrying
-                except Exception as e:
-                    # Log any other error that occurs during sending
-                    self.log_message(f"Send error: {str(e)}", "ERROR")
-                    break
-            # Return False if all attempts fail
+            conn.send_message(opcode, request_id, **fields)
+            return True  # Return True if the message is successfully sent
+        except Exception as e:
+            # Log any error that occurs during sending
+            self.log_message(f"Send error: {str(e)}", "ERROR")
             return False
-        finally:
-            # Restore the original socket timeout
-            socket.settimeout(original_timeout)
-
-    def safe_receive(self, socket, buffer_size=4096, retries=3, timeout=5.0):
-        # Store the original timeout of the socket
-        original_timeout = socket.gettimeout()
-        # Set the socket timeout for the receive operation
-        socket.settimeout(timeout)
-        
-        try:
-            # Attempt to receive data up to the specified number of retries
-            for attempt in range(retries):
-                try:
-                    # Receive data from the socket with the specified buffer size
-                    data = socket.recv(buffer_size)
-                    if data:
-                        # Decode data if it is in bytes format
-                        decoded_data = data.decode() if isinstance(data, bytes) else data
-                        # Log an error if the received data starts with "ERROR"
-                        if decoded_data.startswith("ERROR"):
-                            self.log_message(decoded_data, "ERROR")
-                        return decoded_data  # Return the received data
-                    return None  # Return None if no data is received
-                except socket.timeout as e:
-                    # Log a warning if receiving times out
-                    self.log_message(f"Receive timeout, attempt {attempt + 1}/{retries}: {str(e)}", "WARNING")
-                    if attempt < retries - 1:
-                        time.sleep(1)  # Wait before retrying
-                except Exception as e:
-                    # Log any other error that occurs during receiving
-                    self.log_message(f"Receive error: {str(e)}", "ERROR")
-                    break
-            # Return None if all attempts fail
-            return None
-        finally:
-            # Restore the original socket timeout
-            socket.settimeout(original_timeout)
-
-    def on_closing(self):
-        # Handle the closing event for the application window
-        if self.is_running:
-            # Stop the server if it is running
-            self.cleanup_server()
-        # Quit the main GUI loop
-        self.root.quit()
 
+    def send_error(self, conn, request_id, message):
+        # Reply to a request with an ERROR frame
+        self.error_replies.inc()
+        return self.safe_send(conn, OP_ERROR, request_id, message=message)
 
     def handle_client(self, client_socket, address):
         username = None
+        conn = FrameSocket(client_socket)
+        self.byte_counters.open(conn)
         try:
-            # Remove the socket timeout for the client
-            client_socket.settimeout(None)
-            # Receive the username from the client
-            username = self.safe_receive(client_socket)
-            
+            # The first frame must be a HELLO carrying the username, within the socket timeout
+            username = self.register_client(conn, conn.recv_frame(), address)
             if not username:
-                client_socket.close()
-                return
-            
-            # Check if the username has ever been used before
-            if username in self.used_usernames:
-                self.safe_send(client_socket, "ERROR: This username has been used before and is blocked!")
-                client_socket.close()  # Close the connection immediately
-                return
-            
-            # Check if the username is currently taken by another client
-            if username in self.clients:
-                self.safe_send(client_socket, "ERROR: This username is taken!")
-                client_socket.close()  # Close the connection immediately
                 return
-            
-            # If we reach here, the username is available for new connection
-            self.used_usernames.add(username)   # Mark this username as used permanently
-            self.clients[username] = client_socket
-            self.safe_send(client_socket, "SUCCESS: Connection is successful!")
-            self.log_message(f"New connection: {username} ({address[0]}:{address[1]})")
+            # Logged in: wait for commands as long as it takes, liveness is checked by PING
+            client_socket.settimeout(None)
             
             # Handle incoming commands from the client while the server is running
             while self.is_running:
                 try:
-                    command = self.safe_receive(client_socket)
-                    if not command:
-                        continue
-                    
-                    if command == "EXIT":
-                        break
-                    
-                    command_parts = command.split('|')
-                    command_type = command_parts[0]
-                    
-                    if command_type in ["UPLOAD", "DOWNLOAD", "LIST", "DELETE", "UPDATE"]:
-                        handler = getattr(self, f"handle_{command_type.lower()}")
-                        handler(client_socket, username, command)
-                        
-                except ConnectionResetError as e:
-                    self.log_message(f"Connection reset error: {str(e)}", "WARNING")
+                    frame = conn.recv_frame()
+                except (ConnectionError, ProtocolError) as e:
+                    self.log_message(f"Connection error ({username}): {str(e)}", "WARNING")
+                    break
+                if not self.dispatch_frame(conn, username, frame):
                     break
-                except Exception as e:
-                    if self.is_running:
-                        self.log_message(f"Client error: {str(e)}", "ERROR")
             
+        except Exception as e:
+            self.log_message(f"Handshake error ({address[0]}:{address[1]}): {str(e)}", "WARNING")
         finally:
             # Ensure the client is removed from the clients dictionary and the socket is closed
-            if username in self.clients:
-                del self.clients[username]
-                self.log_message(f"{username} disconnected")
-            client_socket.close()
+            self.unregister_client(username, conn)
+            self.byte_counters.close(conn)
+            conn.close()
+
+    def register_client(self, conn, hello, address):
+        # Validate the HELLO frame of a new connection and return the username, or None if refused
+        if hello is None or hello.opcode != OP_HELLO:
+            return None
+        fields = hello.fields()
+        username = str(fields.get("username", "")).strip()
+        # A client that lost its connection proves it is the same one with the token it was given
+        token = self.resume_tokens.get(username)
+        resuming = token is not None and fields.get("token") == token
+        
+        if not username:
+            self.send_error(conn, hello.request_id, "ERROR: Username cannot be empty!")
+            return None
+
+        if fields.get("attach"):
+            return self.attach_stream(conn, hello, fields, username, resuming, address)
+        
+        # Check if the username has ever been used before
+        if username in self.used_usernames and not resuming:
+            self.send_error(conn, hello.request_id, "ERROR: This username has been used before and is blocked!")
+            return None
+        
+        # Check if the username is currently taken by another client.
+        # A resuming client replaces its own stale connection instead.
+        stale = self.clients.get(username)
+        if stale is not None and resuming:
+            self.log_message(f"Replacing the stale connection of {username}")
+            try:
+                stale.close()
+            except Exception:
+                pass
+            self.liveness.remove(stale)
+            del self.clients[username]
+        if username in self.clients:
+            self.send_error(conn, hello.request_id, "ERROR: This username is taken!")
+            return None
+
+        # Respect the configured connection limit
+        if self.max_connections is not None and len(self.clients) >= self.max_connections:
+            self.send_error(conn, hello.request_id, "ERROR: Server is full, try again later!")
+            return None
+        
+        # If we reach here, the username is available for new connection
+        self.used_usernames.add(username)   # Mark this username as used permanently
+        self.clients[username] = conn
+        self.liveness.add(conn, username)
+        token = self.resume_tokens.setdefault(username, secrets.token_hex(16))
+        if self.catalog is not None:
+            self.catalog.register_user(username, token)
+        codec = self.negotiate_compression(conn, fields)
+        self.safe_send(conn, OP_OK, hello.request_id, message="SUCCESS: Connection is successful!",
+                       features=self.features(), token=token, compression=codec)
+        if resuming:
+            self.log_message(f"Reconnected: {username} ({address[0]}:{address[1]})")
+        else:
+            self.log_message(f"New connection: {username} ({address[0]}:{address[1]})")
+        return username
+
+    def attach_stream(self, conn, hello, fields, username, resuming, address):
+        # An extra connection of a logged in client, used for parallel range transfers.
+        # It proves its identity with the resume token and does not take the username.
+        if not resuming:
+            self.send_error(conn, hello.request_id, "ERROR: Invalid token for an extra stream!")
+            return None
+        streams = sum(1 for owner in list(self.attached.values()) if owner == username)
+        if streams >= self.max_streams_per_client:
+            self.send_error(conn, hello.request_id, "ERROR: Too many parallel streams!")
+            return None
+        self.attached[conn] = username
+        codec = self.negotiate_compression(conn, fields)
+        self.safe_send(conn, OP_OK, hello.request_id, message="SUCCESS: Stream attached!",
+                       features=self.features(), compression=codec)
+        return username
+
+    def negotiate_compression(self, conn, fields):
+        # The client lists the codecs it has by preference; the first one allowed here is used
+        # for the DATA frames of this connection. Returns its name for the HELLO reply.
+        codec = compression.negotiate(fields.get("compression"), self.compression_codecs)
+        conn.codec = codec
+        return codec.name if codec is not None else None
+
+    def dispatch_frame(self, conn, username, frame):
+        # Serve one frame of a registered client. Returns False when the connection should end.
+        try:
+            if frame is None:
+                return False  # The client closed the connection
+            
+            if frame.opcode == OP_EXIT:
+                return False
+            
+            self.liveness.touch(conn)
+            if frame.opcode == OP_PING:
+                self.safe_send(conn, OP_PONG, frame.request_id)
+                return True
+            
+            handler = self.command_handlers.get(frame.opcode)
+            if handler is not None:
+                # A connection running a command is not pinged
+                self.liveness.begin(conn)
+                try:
+                    with self.command_seconds.time(self.command_labels[frame.opcode]):
+                        handler(conn, username, frame.request_id, frame.fields())
+                finally:
+                    self.liveness.end(conn)
+            elif frame.opcode not in (OP_DATA, OP_READY, OP_CANCEL, OP_PONG):
+                # Leftover DATA/READY/CANCEL frames of a rejected request are dropped silently
+                self.send_error(conn, frame.request_id, f"ERROR: Unknown command {frame.name}")
+            return True
+                
+        except (ConnectionError, ProtocolError) as e:
+            # The stream cannot be trusted anymore, drop the client
+            self.log_message(f"Connection error ({username}): {str(e)}", "WARNING")
+            return False
+        except Exception as e:
+            if self.is_running:
+                self.log_message(f"Client error: {str(e)}", "ERROR")
+            return True
+
+    def unregister_client(self, username, conn):
+        # Forget a client, unless the name was already taken over by a newer connection
+        self.watchers.discard(conn)
+        if self.attached.pop(conn, None) is not None:
+            return  # An extra stream, the client itself is still connected
+        if username and self.clients.get(username) is conn:
+            del self.clients[username]
+            self.log_message(f"{username} disconnected")
+        self.liveness.remove(conn)
+
+    def reap_client(self, conn, username):
+        # Called by the liveness monitor for a client that did not answer its PING. Closing
+        # the connection ends its handler, which unregisters the name and frees its buffers.
+        self.log_message(f"Connection timed out: {username}", "WARNING")
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 
     def send_notification(self, username, message):
         try:
             # Check if the username is in the list of connected clients
-            if username in self.clients:
-                notification = f"NOTIFICATION|{message}"
-                # Send the notification to the specified client
-                if self.safe_send(self.clients[username], notification):
-                    # Log a success message if the notification was sent successfully
-                    self.log_message(f"Notification sent -> {username}: {message}")
+            conn = self.clients.get(username)
+            if conn is not None:
+                # Queue the notification for the writer of that connection. This never blocks on a
+                # slow recipient and never cuts into a transfer running on its socket.
+                if conn.post(OP_NOTIFICATION, message=message):
+                    self.notifications_sent.inc()
+                    # Log a success message if the notification was queued
+                    self.log_message(f"Notification queued -> {username}: {message}")
                 else:
                     # Log an error if the notification failed to send
                     self.log_message(f"Notification did not send: {username}", "ERROR")
@@ -434,21 +708,28 @@ class FileServer:
             self.log_message(f"Notification error ({username}): {str(e)}", "ERROR")
 
 
-    def handle_list(self, client_socket, username, data=None):
+    def owner_of(self, filename):
+        # Owner of a stored file, from the index (which has it from the storage layout, not from
+        # the name); None if there is no such file
+        entry = self.index.get(filename)
+        return entry.owner if entry is not None else None
+
+    def handle_list(self, conn, username, request_id, data=None):
         try:
-            # Check if the upload directory exists, and create it if not
-            if not os.path.exists(self.upload_dir):
-                os.makedirs(self.upload_dir)
+            # Optional filters and paging: {"owner", "prefix", "cursor", "limit"}
+            data = data or {}
+            owner = data.get("owner")
+            prefix = str(data.get("prefix") or "")
+            cursor = data.get("cursor")
+            limit = int(data.get("limit") or self.list_page_size)
+            limit = max(1, min(limit, self.max_list_page_size))
                 
-            # List all files in the upload directory
-            files = os.listdir(self.upload_dir)
-            if not files:
-                response = "There is no file in server."
-            else:
-                response = "\n".join(files)  # Join all filenames with a newline
+            # One page of the index, the cost depends on the page size only
+            entries, next_cursor = self.index.list(owner=owner, prefix=prefix, cursor=cursor, limit=limit)
             
-            # Use the safe send function to send the file list to the client
-            if self.safe_send(client_socket, response, retries=3, timeout=5.0):
+            if self.safe_send(conn, OP_OK, request_id,
+                              entries=[entry.to_dict() for entry in entries],
+                              next_cursor=next_cursor):
                 self.log_message(f"File list sent: {username}")
             else:
                 self.log_message(f"File list did not send: {username}", "ERROR")
@@ -456,272 +737,641 @@ class FileServer:
         except Exception as e:
             # Handle any errors that occur during file listing
             error_msg = f"File listing error: {str(e)}"
-            self.safe_send(client_socket, f"ERROR: {error_msg}")
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
             self.log_message(error_msg, "ERROR")
 
     def verify_file_ownership(self, username, filename):
-        # Check if the file belongs to the specified user by verifying the filename prefix
-        if not filename.startswith(f"{username}_"):
-            return False, "You do not have permission on this file."
-        
-        # Verify if the file exists in the upload directory
-        filepath = os.path.join(self.upload_dir, filename)
-        if not os.path.exists(filepath):
+        # Check if the file exists and belongs to the specified user
+        owner = self.owner_of(filename)
+        if owner is None:
             return False, "File cannot be found."
+        if owner != username:
+            return False, "You do not have permission on this file."
         
-        # If checks pass, return True along with the file path
-        return True, filepath
+        # If checks pass, return True along with the file name
+        return True, filename
+
+    def check_file_size(self, filesize):
+        # Reject negative sizes and uploads above the configured limit
+        if filesize < 0:
+            raise Exception("Invalid file size")
+        if self.max_file_size is not None and filesize > self.max_file_size:
+            raise Exception(f"File is larger than the limit of {self.format_size(self.max_file_size)}")
+
+    def get_receive_buffer(self):
+        # The buffer is allocated once per handler thread and reused for every transfer
+        buffer = getattr(self.receive_buffers, "buffer", None)
+        if buffer is None or len(buffer) != self.receive_buffer_size:
+            buffer = bytearray(self.receive_buffer_size)
+            self.receive_buffers.buffer = buffer
+        return buffer
 
+    def receive_content(self, conn, request_id, writer, data, filesize, label, base=None):
+        # Receive engine shared by uploads and updates: the DATA frames of a request go
+        # through recv_into on the thread's reusable buffer into the store writer.
+        # Returns the StoredVersion the writer committed; it hashes the content on the way.
+        # A delta update rebuilds the content from base, the version being replaced.
+        start_time = time.time()
+        next_report = [start_time + self.progress_interval]
+        received = [0]
+
+        def progress(total_received, total):
+            # Log the progress at most once per progress_interval
+            now = time.time()
+            if now >= next_report[0]:
+                next_report[0] = now + self.progress_interval
+                done = received[0] + total_received
+                percent = (done / max(filesize, 1)) * 100
+                speed = done / max(now - start_time, 1e-6)
+                self.log_message(f"{label}: %{percent:.1f} - Speed: {self.format_size(speed)}/s")
+
+        buffer = self.get_receive_buffer()
+        # Every write into the store is timed, so slow disks show up in the metrics
+        timed = TimedWriter(writer, self.disk_write_seconds, WRITE_LABELS)
+        self.active_transfers.add(1, UPLOAD_LABELS)
+        try:
+            if "chunks" in data and self.store.dedup:
+                # Deduplicated transfer: reply with the chunks the store is missing,
+                # then receive only those, each one as its own run of DATA frames
+                missing = writer.plan_chunks(data["chunks"], filesize)
+                conn.send_message(OP_OK, request_id, missing=missing)
+                chunk = io.BytesIO()
+                for index in missing:
+                    chunk.seek(0)
+                    chunk.truncate()
+                    length = writer.chunk_length(index)
+                    conn.receive_stream(request_id, chunk, length, progress, buffer=buffer)
+                    with self.disk_write_seconds.time(WRITE_LABELS):
+                        writer.fill_chunk(index, chunk.getvalue())
+                    received[0] += length
+                skipped = filesize - sum(writer.chunk_length(index) for index in missing)
+                if skipped:
+                    self.log_message(f"{label}: {self.format_size(skipped)} already stored, not transferred")
+            elif base is not None:
+                # Delta update: the DATA frames are COPY/LITERAL records against the signature
+                # the client fetched, which must still describe the current version
+                info = data["delta"]
+                if base.size != int(info["base_size"]) or base.mtime != info["base_mtime"]:
+                    raise Exception("File changed on the server since its signature was sent")
+                applier = delta.DeltaApplier(base, int(info["block_size"]), timed, filesize)
+                length = int(info["length"])
+                conn.receive_stream(request_id, applier, length, buffer=buffer)
+                applier.finish()
+                self.log_message(f"{label}: rebuilt {self.format_size(filesize)} "
+                                 f"from {self.format_size(length)} of delta")
+            else:
+                conn.receive_stream(request_id, timed, filesize, progress, buffer=buffer)
+        except ProtocolError as e:
+            raise Exception(f"Data receiving error: {str(e)}")
+        finally:
+            self.active_transfers.add(-1, UPLOAD_LABELS)
+        # With the hash the client announced, a wrong result is refused before it replaces anything
+        with self.disk_write_seconds.time(COMMIT_LABELS):
+            return writer.commit(expected_hash=data.get("hash"))
+
+    def store_content(self, conn, username, request_id, filename, data, filesize, label):
+        # Write a new version of filename. It only replaces the current one once it is complete,
+        # downloads in progress keep reading the version they opened.
+        base = self.store.open_snapshot(filename) if "delta" in data else None
+        try:
+            writer = self.store.create_writer(filename)
+            try:
+                with self.bandwidth.transfer(conn, username, filesize):
+                    return self.receive_content(conn, request_id, writer, data, filesize, label, base)
+            except BaseException:
+                writer.abort()
+                raise
+        finally:
+            if base is not None:
+                base.close()
+
+    def index_file(self, filename, owner, version):
+        # Record the version an upload or update committed. Its size and mtime come from the
+        # commit, not from the store, which may already hold a newer version of the same name.
+        self.index.put(FileEntry(filename, owner, version.size, version.mtime, version.hash))
+        if self.download_cache is not None:
+            self.download_cache.invalidate(filename)
     
-    def handle_upload(self, client_socket, username, data):
+    def handle_upload(self, conn, username, request_id, data):
         try:
             # Parse the command to get filename and filesize
-            _, filename, filesize = data.split('|')
-            filesize = int(filesize)
+            filename = os.path.basename(str(data["filename"]))
+            filesize = int(data["filesize"])
+            self.check_file_size(filesize)
 
              # Construct the server filename with the user's name as a prefix
-            server_filename = f"{username}_{filename}"
-            filepath = os.path.join(self.upload_dir, server_filename)
+            server_filename = file_name(username, filename)
             
             self.log_message(f"File uploading started: {server_filename} ({self.format_size(filesize)})")
             
-            # Initialize variables for file receiving
-            total_received = 0
-            start_time = time.time()
-            
             # Receive the file and write it to the specified path
-            with open(filepath, 'wb') as f:
-                while total_received < filesize:
-                    # Calculate the size of the next chunk to receive
-                    chunk_size = min(self.chunk_size, filesize - total_received)
-                    try:
-                        # Receive a chunk of data from the client
-                        chunk = client_socket.recv(chunk_size)
-                        if not chunk:
-                            raise Exception("Connection failed")
-                        # Write the received chunk to the file
-                        f.write(chunk)
-                        total_received += len(chunk)
-                        
-                        # Update the progress log every 10 chunks
-                        if total_received % (self.chunk_size * 10) == 0:  
-                            progress = (total_received / filesize) * 100
-                            speed = total_received / (time.time() - start_time)
-                            status = f"Loading: %{progress:.1f} - Speed: {self.format_size(speed)}/s"
-                            self.log_message(status)
-                            
-                    except socket.timeout as e:
-                        # Continue if a socket timeout occurs during receiving
-                        continue
-                    except Exception as e:
-                        # Raise an exception if any other error occurs while receiving data
-                        raise Exception(f"Data receiving error: {str(e)}")
+            with self.journal.operation(server_filename):
+                version = self.store_content(conn, username, request_id, server_filename, data, filesize, "Loading")
+                self.index_file(server_filename, username, version)
             
             # Send success message to client once the file is successfully uploaded
-            self.safe_send(client_socket, "SUCCESS: File successfully uploaded!")
+            self.safe_send(conn, OP_OK, request_id, message="SUCCESS: File successfully uploaded!")
             self.log_message(f"File successfully uploaded: {server_filename}")
             
+        except (ConnectionError, ProtocolError):
+            raise
         except Exception as e:
             # Handle any errors that occur during the upload process
             error_msg = f"File uploading error: {str(e)}"
-            self.safe_send(client_socket, f"ERROR: {error_msg}")
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
             self.log_message(error_msg, "ERROR")
 
-    def handle_download(self, client_socket, username, data):
+    def handle_download(self, conn, username, request_id, data):
         """
-        It meets the "DOWNLOAD|fileName" command on the server.
+        It meets the DOWNLOAD {"filename", "offset", "length"} command on the server.
         1) It finds the file owner, if the downloader is different, it sends NOTIFICATION.
-        2) It waits for a 'READY' signal from the client.
-        3) It sends the file in 65536 byte chunks.
-        4) It sets the timeout to 600 seconds or you can make it None if you want.
+        2) It replies OK with the file size, the byte range it will send and the version
+           (mtime, hash) so a resuming client can check its partial file is still valid,
+           then waits for a READY frame with the same request id.
+        3) It sends the range with sendfile, so the bytes never pass through Python; a whole
+           file that is downloaded often is sent from the download cache instead.
         """
-        original_timeout = client_socket.gettimeout()
         try:
-            #1) We increase the Timeout (example: 10 minutes = 600 sec)
-            client_socket.settimeout(600)
-
-            # Command format: "DOWNLOAD|fileName"
-            _, filename = data.split('|', 1)
-            filepath = os.path.join(self.upload_dir, filename)
+            filename = os.path.basename(str(data["filename"]))
+            offset = int(data.get("offset") or 0)
+            length = data.get("length")
+            length = None if length is None else int(length)
+            if offset < 0 or (length is not None and length < 0):
+                self.send_error(conn, request_id, "ERROR: Invalid byte range.")
+                return
 
-            # Does the file exist?
-            if not os.path.exists(filepath):
-                client_socket.send(b"ERROR: Cannot find file\u0131.")
+            # Does the file exist? The snapshot keeps this version readable until the end
+            try:
+                snapshot = self.store.open_snapshot(filename)
+            except (FileNotFoundError, KeyError):
+                self.send_error(conn, request_id, "ERROR: Cannot find file.")
                 return
+            with snapshot:
+                self.send_snapshot(conn, username, request_id, filename, snapshot, offset, length)
 
-            # Notify the file owner (downloader = username)
-            owner = filename.split('_')[0]
-            if owner != username and owner in self.clients:
-                # NOTIFICATION
-                msg = f"NOTIFICATION|{username} is downloading your {filename} file."
-                self.clients[owner].send(msg.encode())
-                self.log_message(f"Notification sent -> {owner}: {msg}")
+        except (ConnectionError, ProtocolError):
+            raise
+        except Exception as e:
+            error_msg = f"File downloading error: {str(e)}"
+            self.log_message(error_msg, "ERROR")
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
 
-            #2) Get size, send title
-            filesize = os.path.getsize(filepath)
-            header = f"DOWNLOAD|{filename}|{filesize}".encode()
-            client_socket.sendall(header)
+    def send_snapshot(self, conn, username, request_id, filename, snapshot, offset=0, length=None):
+        # Notify the file owner (downloader = username), resumed ranges are not announced again
+        owner = self.owner_of(filename)
+        if owner is not None and owner != username and offset == 0:
+            self.send_notification(owner, f"{username} is downloading your {filename} file.")
 
-            # 3) READY wait
-            try:
-                ready = client_socket.recv(1024).decode()
-                if ready != "READY":
-                    return
-            except Exception:
-                return
+        #1) Get size and range, send title
+        filesize = snapshot.size
+        offset, end = snapshot.clip(offset, length)
+        entry = self.index.get(filename)
+        conn.send_message(OP_OK, request_id, filename=filename, filesize=filesize,
+                          offset=offset, length=end - offset, mtime=snapshot.mtime,
+                          hash=entry.hash if entry is not None else None)
 
-            # 4) Send file in chunks
-            self.log_message(f"Starting file transfer: {filename} to {username}")
-            with open(filepath, 'rb') as f:
-                bytes_sent = 0
-                while bytes_sent < filesize:
-                    chunk = f.read(min(65536, filesize - bytes_sent))
-                    if not chunk:
-                        break
-                    client_socket.sendall(chunk)
-                    bytes_sent += len(chunk)
+        #2) READY wait, the client may also CANCEL after seeing the size
+        ready = conn.recv_reply(request_id)
+        if ready.opcode != OP_READY:
+            return
 
-            self.log_message(f"File sent: {filename} ({username}) - {self.format_size(filesize)}")
+        #3) Send the segments of the range (one file, or the chunks of a manifest)
+        if offset:
+            self.log_message(f"Resuming file transfer: {filename} to {username} from byte {offset}")
+        else:
+            self.log_message(f"Starting file transfer: {filename} to {username}")
+        self.stream_snapshot(conn, username, request_id, filename, snapshot, offset, end)
+        if offset == 0:
+            self.count_download(filename)
 
-        except Exception as e:
-            error_msg = f"File downloading error\u0131: {str(e)}"
-            self.log_message(error_msg, "ERROR")
-            try:
-                client_socket.send(error_msg.encode())
-            except Exception:
-                pass
+        self.log_message(f"File sent: {filename} ({username}) - {self.format_size(end - offset)}")
 
+    def stream_snapshot(self, conn, username, request_id, filename, snapshot, offset, end):
+        # DATA frames of bytes offset..end of a snapshot. Chunks stored compressed with the
+        # codec of this connection go out as they are on disk.
+        frames = self.cached_frames(filename, snapshot, conn.codec) if offset == 0 and end == snapshot.size else None
+        self.active_transfers.add(1, DOWNLOAD_LABELS)
+        try:
+            with self.bandwidth.transfer(conn, username, end - offset):
+                if frames is not None:
+                    for flags, payload in frames:
+                        conn.pace(len(payload))
+                        conn.send_frame(OP_DATA, request_id, payload, flags)
+                else:
+                    for fileobj, file_offset, count, stored in snapshot.stored_segments(offset, end - offset,
+                                                                                        conn.codec):
+                        if stored:
+                            conn.send_stored(request_id, fileobj, file_offset, count)
+                        else:
+                            conn.send_file(request_id, fileobj, file_offset, count)
         finally:
-            # You can reset the timeout (optional)
-            # client_socket.settimeout(original_timeout)
-            pass
+            self.active_transfers.add(-1, DOWNLOAD_LABELS)
 
+    def cached_frames(self, filename, snapshot, codec):
+        # DATA frames of a whole download from the cache. A file asked for often enough is
+        # read and encoded once and kept; None means it is sent from the store as usual.
+        if self.download_cache is None or snapshot.size == 0:
+            return None
+        key = (filename, codec.name if codec is not None else None)
+        version = (snapshot.size, snapshot.mtime)
+        frames = self.download_cache.get(key, version)
+        if frames is None and self.download_cache.wants(key, snapshot.size):
+            frames = build_frames(snapshot, codec)
+            self.download_cache.put(key, version, frames)
+        return frames
 
-    
-    def handle_delete(self, client_socket, username, data):
+    def handle_delete(self, conn, username, request_id, data):
         try:
             # Parse the command to get the filename
-            _, filename = data.split('|')
-            filepath = os.path.join(self.upload_dir, filename)
+            filename = os.path.basename(str(data["filename"]))
             
-            # Check file ownership by verifying the prefix of the filename
-            owner = filename.split('_')[0]  
+            # Check file ownership with the owner recorded for the file
+            owner = self.owner_of(filename)
             
             # If the user is not the owner, they don't have permission to delete the file
-            if owner != username:
-                self.safe_send(client_socket, "ERROR: You do not have permission on this file.")
+            if owner is not None and owner != username:
+                self.send_error(conn, request_id, "ERROR: You do not have permission on this file.")
                 
                 # Notify the file owner about the unauthorized delete attempt
-                if owner in self.clients:
-                    notification = f"NOTIFICATION|{username} tried to delete your {filename} named file."
-                    self.clients[owner].send(notification.encode())
+                self.send_notification(owner, f"{username} tried to delete your {filename} named file.")
                 return
 
             # Attempt to delete the file 
             try:
-                os.remove(filepath)
+                if owner is None:
+                    raise FileNotFoundError(filename)
+                # Chunks of a dedup store are collected once no other file refers to them
+                with self.journal.operation(filename):
+                    self.store.delete(filename)
+                    self.index.remove(filename)
+                if self.download_cache is not None:
+                    self.download_cache.invalidate(filename)
                 # Notify the client of the successful deletion
-                self.safe_send(client_socket, "SUCCESS: File successfully deleted.")
+                self.safe_send(conn, OP_OK, request_id, message="SUCCESS: File successfully deleted.")
                 # Log the file deletion event
                 self.log_message(f"File deleted: {filename} ({username})")
             except PermissionError as e:
                 # Raise an exception if there are issues with file permissions
                 raise Exception("File is not deletable: Access denied")
             except FileNotFoundError as e:
-                # Raise an exception if the file doesn't exist
+                # Raise an exception if the file doesn't exist, and forget the stale entry
+                self.index.remove(filename)
                 raise Exception("File could not found.")
                 
         except Exception as e:
             # Handle any errors that occur during the delete process
             error_msg = f"File deletion error: {str(e)}"
             # Send an error message back to the client
-            self.safe_send(client_socket, f"ERROR: {error_msg}")
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
             # Log the error
             self.log_message(error_msg, "ERROR")
 
-    def handle_update(self, client_socket, username, data):
+    def batch_names(self, data):
+        # File names of a batch command, without repeats and in request order
+        filenames = data.get("filenames")
+        if not isinstance(filenames, list):
+            raise Exception("filenames must be a list")
+        if len(filenames) > MAX_BATCH_ITEMS:
+            raise Exception(f"At most {MAX_BATCH_ITEMS} files per batch")
+        return list(dict.fromkeys(os.path.basename(str(filename)) for filename in filenames))
+
+    def handle_multi_delete(self, conn, username, request_id, data):
+        # MULTI_DELETE {"filenames"}: delete many files of the user in one request. The store
+        # removes them with a single folder fsync and the index drops them under one lock.
+        try:
+            filenames = self.batch_names(data)
+            results = {}
+            denied = {}  # owner -> files of that owner the user tried to delete
+            owned = []
+            for filename in filenames:
+                owner = self.owner_of(filename)
+                if owner == username:
+                    owned.append(filename)
+                elif owner is None:
+                    results[filename] = "File cannot be found."
+                else:
+                    results[filename] = "You do not have permission on this file."
+                    denied.setdefault(owner, []).append(filename)
+
+            with self.journal.operation(*owned):
+                failures = self.store.delete_many(owned)
+                # Files that were already gone are dropped from the index as well
+                self.index.remove_many([name for name in owned
+                                        if not isinstance(failures.get(name), PermissionError)])
+            for name in owned:
+                error = failures.get(name)
+                if isinstance(error, FileNotFoundError):
+                    results[name] = "File cannot be found."
+                elif isinstance(error, PermissionError):
+                    results[name] = "File is not deletable: Access denied"
+                elif error is not None:
+                    results[name] = f"File deletion error: {str(error)}"
+                if self.download_cache is not None:
+                    self.download_cache.invalidate(name)
+
+            # One notification per owner, however many of their files were in the batch
+            for owner, names in denied.items():
+                if len(names) == 1:
+                    self.send_notification(owner, f"{username} tried to delete your {names[0]} named file.")
+                else:
+                    self.send_notification(owner, f"{username} tried to delete {len(names)} of your files.")
+
+            deleted = sum(1 for name in filenames if name not in results)
+            self.safe_send(conn, OP_OK, request_id, results=[
+                {"filename": name, "ok": name not in results, "message": results.get(name, "Deleted")}
+                for name in filenames
+            ])
+            self.log_message(f"Files deleted: {deleted} of {len(filenames)} ({username})")
+
+        except Exception as e:
+            error_msg = f"File deletion error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+
+    def handle_multi_stat(self, conn, username, request_id, data):
+        # MULTI_STAT {"filenames"}: index entries of many files, answered from memory
+        try:
+            results = []
+            for filename in self.batch_names(data):
+                entry = self.index.get(filename)
+                if entry is None:
+                    results.append({"filename": filename, "ok": False, "message": "File cannot be found."})
+                else:
+                    results.append({"filename": filename, "ok": True, **entry.to_dict()})
+            self.safe_send(conn, OP_OK, request_id, results=results)
+        except Exception as e:
+            error_msg = f"File stat error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+
+    def handle_multi_download(self, conn, username, request_id, data):
+        """
+        MULTI_DOWNLOAD {"filenames"}: several whole files on one request.
+        1) Every file is opened as a snapshot first, so the manifest in the OK reply (size,
+           mtime and hash of each file, or why it cannot be sent) matches what follows.
+        2) After READY the DATA frames of the files follow back to back in manifest order;
+           the client cuts the stream with the sizes of the manifest. CANCEL sends nothing.
+        """
+        snapshots = []
+        try:
+            manifest = []
+            for filename in self.batch_names(data):
+                try:
+                    snapshot = self.store.open_snapshot(filename)
+                except (FileNotFoundError, KeyError):
+                    manifest.append({"filename": filename, "ok": False, "message": "Cannot find file."})
+                    continue
+                snapshots.append((filename, snapshot))
+                entry = self.index.get(filename)
+                manifest.append({"filename": filename, "ok": True, "filesize": snapshot.size,
+                                 "mtime": snapshot.mtime, "hash": entry.hash if entry is not None else None})
+            total = sum(snapshot.size for _, snapshot in snapshots)
+            conn.send_message(OP_OK, request_id, files=manifest, total=total)
+
+            ready = conn.recv_reply(request_id)
+            if ready.opcode != OP_READY:
+                return
+            for filename, snapshot in snapshots:
+                owner = self.owner_of(filename)
+                if owner is not None and owner != username:
+                    self.send_notification(owner, f"{username} is downloading your {filename} file.")
+                self.stream_snapshot(conn, username, request_id, filename, snapshot, 0, snapshot.size)
+                self.count_download(filename)
+            self.log_message(f"Files sent: {len(snapshots)} ({username}) - {self.format_size(total)}")
+
+        except (ConnectionError, ProtocolError):
+            raise
+        except Exception as e:
+            error_msg = f"File downloading error: {str(e)}"
+            self.log_message(error_msg, "ERROR")
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+        finally:
+            for _, snapshot in snapshots:
+                snapshot.close()
+
+    def handle_update(self, conn, username, request_id, data):
         try:
             # Parse the command to get the old filename, new filename, and file size
-            _, old_filename, new_filename, filesize = data.split('|')
-            filesize = int(filesize)
-            filepath = os.path.join(self.upload_dir, old_filename)
+            old_filename = os.path.basename(str(data["filename"]))
+            filesize = int(data["filesize"])
+            self.check_file_size(filesize)
              # Check file ownership to ensure user has permission to update the file
             is_owner, message = self.verify_file_ownership(username, old_filename)
             if not is_owner:
-                # Send an error message if the user does not own the file
-                self.safe_send(client_socket, f"ERROR: {message}")
+                # Send an error message if the user does not own the file.
+                # The DATA frames that follow are dropped by the command loop.
+                self.send_error(conn, request_id, f"ERROR: {message}")
                 return
             
-            filepath = os.path.join(self.upload_dir, old_filename)
-            
             self.log_message(f"File updating started: {old_filename}")
             
-             # Start receiving the new version of the file
-            total_received = 0
-            start_time = time.time()
-            
-             # Open the file in write-binary mode to overwrite the content
-            with open(filepath, 'wb') as f:
-                while total_received < filesize and self.is_running:
-                    # Determine the chunk size to receive
-                    chunk_size = min(self.chunk_size, filesize - total_received)
-                    try:
-                        # Receive a chunk of the file from the client
-                        chunk = client_socket.recv(chunk_size)
-                        if not chunk:
-                            raise Exception("Connection failed")
-                        
-                        # Write the received chunk to the file
-                        f.write(chunk)
-                        total_received += len(chunk)
-                        
-                        # Update progress log every 10 chunks
-                        if total_received % (self.chunk_size * 10) == 0:
-                            progress = (total_received / filesize) * 100
-                            speed = total_received / (time.time() - start_time)
-                            status = f"Updating: %{progress:.1f} - Hız: {self.format_size(speed)}/s"
-                            self.log_message(status)
-                            
-                    except socket.timeout as e:
-                        # Continue if a socket timeout occurs during receiving
-                        continue
-                    except Exception as e:
-                        # Raise an exception if any other error occurs while receiving data
-                        raise Exception(f"Data receiving error: {str(e)}")
+             # Receive the new version of the file, it is swapped in atomically once complete
+            with self.journal.operation(old_filename):
+                version = self.store_content(conn, username, request_id, old_filename, data, filesize, "Updating")
+                self.index_file(old_filename, username, version)
             
             # Send success message to client once the file is successfully updated
-            self.safe_send(client_socket, "SUCCESS: File successfully updated!")
+            self.safe_send(conn, OP_OK, request_id, message="SUCCESS: File successfully updated!")
             self.log_message(f"File successfully updated: {old_filename}")
             
+        except (ConnectionError, ProtocolError):
+            raise
         except Exception as e:
             # Handle any errors that occur during the update process
             error_msg = f"File updating error: {str(e)}"
             # Send an error message back to the client
-            self.safe_send(client_socket, f"ERROR: {error_msg}")
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
             # Log the error
             self.log_message(error_msg, "ERROR")
 
+    def handle_signature(self, conn, username, request_id, data):
+        # SIGNATURE {"filename"}: block signatures of the current version for a delta update.
+        # The reply names the version (size, mtime) and is followed by the signature as DATA frames.
+        try:
+            filename = os.path.basename(str(data["filename"]))
+            is_owner, message = self.verify_file_ownership(username, filename)
+            if not is_owner:
+                self.send_error(conn, request_id, f"ERROR: {message}")
+                return
+            with self.store.open_snapshot(filename) as snapshot:
+                block_size = delta.block_size_for(snapshot.size)
+                signature = delta.signature(snapshot, block_size)
+                size, mtime = snapshot.size, snapshot.mtime
+        except (FileNotFoundError, KeyError):
+            self.send_error(conn, request_id, "ERROR: Cannot find file.")
+            return
+        except Exception as e:
+            error_msg = f"Signature error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+            return
+
+        conn.send_message(OP_OK, request_id, filename=filename, filesize=size, mtime=mtime,
+                          block_size=block_size, length=len(signature))
+        conn.send_stream(request_id, io.BytesIO(signature), len(signature))
+        self.log_message(f"Signature sent: {filename} ({len(signature) // delta.SIGNATURE_RECORD.size} blocks) to {username}")
+
+    def handle_session_open(self, conn, username, request_id, data):
+        # SESSION_OPEN {"filename", "filesize", "chunk_size", "update"}: start a resumable upload.
+        # With update=true, filename is an existing stored file of the user that gets replaced.
+        try:
+            filename = os.path.basename(str(data["filename"]))
+            filesize = int(data["filesize"])
+            self.check_file_size(filesize)
+            if data.get("update"):
+                is_owner, message = self.verify_file_ownership(username, filename)
+                if not is_owner:
+                    self.send_error(conn, request_id, f"ERROR: {message}")
+                    return
+                target = filename
+            else:
+                target = file_name(username, filename)
+
+            session = self.upload_sessions.create(username, target, filesize, data.get("chunk_size"))
+            self.safe_send(conn, OP_OK, request_id, **session.to_dict())
+            self.log_message(f"Upload session opened: {target} ({self.format_size(filesize)}, "
+                             f"{session.chunk_count} chunks) by {username}")
+
+        except Exception as e:
+            error_msg = f"Upload session error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+
+    def handle_session_chunk(self, conn, username, request_id, data):
+        # SESSION_CHUNK {"session", "index"} + DATA frames: store one chunk, in any order
+        try:
+            session = self.upload_sessions.get(data["session"], username)
+            index = int(data["index"])
+            fd, writer, length = self.upload_sessions.open_chunk(session, index)
+        except Exception as e:
+            # The DATA frames that follow are dropped by the command loop
+            self.send_error(conn, request_id, f"ERROR: Upload session error: {str(e)}")
+            return
+
+        try:
+            self.active_transfers.add(1, UPLOAD_LABELS)
+            try:
+                # A chunk is paced as part of the whole upload, so large sessions count as bulk
+                with self.bandwidth.transfer(conn, username, session.filesize):
+                    conn.receive_stream(request_id, TimedWriter(writer, self.disk_write_seconds, WRITE_LABELS),
+                                        length, buffer=self.get_receive_buffer())
+            except ProtocolError as e:
+                # An ERROR frame from the client, the connection itself is still fine
+                self.send_error(conn, request_id, f"ERROR: Data receiving error: {str(e)}")
+                return
+            finally:
+                self.active_transfers.add(-1, UPLOAD_LABELS)
+            with self.disk_write_seconds.time(COMMIT_LABELS):
+                self.upload_sessions.mark_received(session, fd, index)
+        except (ConnectionError, ProtocolError):
+            raise
+        except Exception as e:
+            self.send_error(conn, request_id, f"ERROR: Upload session error: {str(e)}")
+            return
+        finally:
+            os.close(fd)
+        self.safe_send(conn, OP_OK, request_id, index=index)
+
+    def handle_session_status(self, conn, username, request_id, data):
+        # SESSION_STATUS {"session"}: which chunks the server already has
+        try:
+            session = self.upload_sessions.get(data["session"], username)
+        except Exception as e:
+            self.send_error(conn, request_id, f"ERROR: Upload session error: {str(e)}")
+            return
+        self.safe_send(conn, OP_OK, request_id, **session.to_dict())
+
+    def handle_session_commit(self, conn, username, request_id, data):
+        # SESSION_COMMIT {"session", "hash"}: move the assembled file into the store
+        try:
+            session = self.upload_sessions.get(data["session"], username)
+            path = self.upload_sessions.begin_commit(session)
+            with self.journal.operation(session.target):
+                try:
+                    # The client may send the hash of the whole file to have the reassembly verified
+                    version = self.store.import_file(session.target, path, expected_hash=data.get("hash"))
+                except BaseException:
+                    self.upload_sessions.abort_commit(session)
+                    raise
+                self.index_file(session.target, username, version)
+            self.upload_sessions.remove(session)
+            self.safe_send(conn, OP_OK, request_id, message="SUCCESS: File successfully uploaded!")
+            self.log_message(f"Upload session committed: {session.target}")
+
+        except Exception as e:
+            error_msg = f"Upload session error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+
+    def handle_stats(self, conn, username, request_id, data):
+        # STATS {}: the current metrics, the same values the Prometheus listener serves
+        try:
+            self.safe_send(conn, OP_OK, request_id, metrics=self.metrics.snapshot())
+        except Exception as e:
+            error_msg = f"Stats error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+
+    def handle_watch(self, conn, username, request_id, data):
+        # WATCH {"epoch", "sequence"}: push the changes of the file list to this connection from
+        # now on. A client naming the epoch and sequence of the list it has cached first gets the
+        # changes it missed (resumed); any other starts at the current sequence and loads the
+        # list with LIST, changes made meanwhile still reach it afterwards.
+        try:
+            sequence = data.get("sequence")
+            resumed = (data.get("epoch") == self.index.epoch and isinstance(sequence, int)
+                       and self.index.changes_since(sequence, 0) is not None)
+            if not resumed:
+                sequence = self.index.sequence
+            conn.watch_sequence = sequence
+            conn.change_feed = functools.partial(self.next_changes, conn)
+            self.watchers.add(conn)
+            self.safe_send(conn, OP_OK, request_id, epoch=self.index.epoch, sequence=sequence, resumed=resumed)
+            conn.post_changes()
+            self.log_message(f"Watching the file list: {username} (from {sequence}, "
+                             f"{'resumed' if resumed else 'full list'})")
+        except Exception as e:
+            error_msg = f"Watch error: {str(e)}"
+            self.send_error(conn, request_id, f"ERROR: {error_msg}")
+            self.log_message(error_msg, "ERROR")
+
+    def announce_changes(self):
+        # Index listener: flag new changes to every watcher, their writers fetch them
+        for conn in list(self.watchers):
+            conn.post_changes()
+
+    def next_changes(self, conn):
+        # Payload of the next CHANGES frame of a watcher, None when it is up to date. Only the
+        # connection's writer calls this, so the cursor moves in one place.
+        result = self.index.changes_since(conn.watch_sequence, MAX_CHANGES_PER_FRAME)
+        if result is None:
+            # Fell behind the change log: the client has to load the whole list again
+            conn.watch_sequence = self.index.sequence
+            return encode_message(epoch=self.index.epoch, reset=True, sequence=conn.watch_sequence)
+        changes, more = result
+        if not changes:
+            return None
+        conn.watch_sequence = changes[-1]["seq"]
+        if more:
+            conn.post_changes()
+        return encode_message(epoch=self.index.epoch, changes=changes)
+
     def start_auto_cleanup(self):
-        # Define a function to run in a separate thread to clean up disconnected clients
+        # Define a function to run in a separate thread for periodic housekeeping.
+        # Dead clients are not swept here, the liveness monitor reaps them as their PING times out.
         def cleanup_loop():
             while self.is_running:
-                disconnected_users = []
-                # Iterate through all connected clients
-                for username, client in self.clients.items():
-                    try:
-                        # Check if the connection is still alive by setting a short timeout
-                        client.settimeout(1)
-                        client.send(b'') # Send an empty byte to verify connection
-                    except Exception as e:
-                        # If an error occurs, consider the client disconnected
-                        disconnected_users.append(username)
-                
-                # Remove all disconnected clients from the list of active clients
-                for username in disconnected_users:
-                    if username in self.clients:
-                        del self.clients[username]
-                        self.log_message(f"Connection failed: {username}")
-                        
+                # Drop the upload sessions nobody continued within the TTL
+                if self.upload_sessions is not None:
+                    for session in self.upload_sessions.expire():
+                        self.log_message(f"Upload session expired: {session.target} ({session.owner})")
+                # Write the download counters added up since the last round
+                if self.catalog is not None:
+                    self.catalog.flush()
+                    # Failed writes journal their intents without any change that would
+                    # trigger a checkpoint
+                    if self.journal.due():
+                        self.checkpoint()
                 
                 time.sleep(30)  # Wait for 30 seconds before the next cleanup check
         
@@ -739,14 +1389,142 @@ class FileServer:
             unit += 1
         return f"{size:.2f} {units[unit]}"
 
+def load_config(path):
+    # Settings file: a JSON object whose keys are the long option names, e.g. {"port": 12345}
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} must contain a JSON object")
+    return {key.replace('-', '_'): value for key, value in config.items()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cloud File System Server")
+    parser.add_argument("--config", help="JSON file with default values for the options below")
+    parser.add_argument("--headless", action="store_true", help="Run without the Tkinter window")
+    parser.add_argument("--port", type=int, default=12345, help="TCP port to listen on")
+    parser.add_argument("--storage-dir", default=os.path.join(os.getcwd(), "uploaded_files"),
+                        help="Folder the uploaded files are stored in")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded", help="Connection engine")
+    parser.add_argument("--max-workers", type=int, default=32, help="Command threads of the asyncio engine")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen() backlog")
+    parser.add_argument("--max-connections", type=int, default=None, help="Maximum logged in clients")
+    parser.add_argument("--max-file-size", type=int, default=None, help="Largest accepted upload in bytes")
+    parser.add_argument("--receive-buffer", type=int, default=1024 * 1024, help="Upload receive buffer in bytes")
+    parser.add_argument("--write-buffer", type=int, default=1024 * 1024, help="File write buffer in bytes")
+    parser.add_argument("--storage", choices=STORAGE_MODES, default="flat",
+                        help="flat: one file per upload, dedup: content-addressed chunks shared between files")
+    parser.add_argument("--chunk-size", type=int, default=256 * 1024, help="Chunk size of the dedup store in bytes")
+    parser.add_argument("--session-ttl", type=int, default=24 * 3600,
+                        help="Seconds an unfinished upload session is kept")
+    parser.add_argument("--compression", default=",".join(compression.PREFERENCE),
+                        help="Comma separated codecs clients may use on the wire, or 'none'")
+    parser.add_argument("--compress-at-rest", choices=sorted(compression.CODECS), default=None,
+                        help="Store the chunks of the dedup storage compressed with this codec")
+    parser.add_argument("--cache-size", type=int, default=64 * 1024 * 1024,
+                        help="Bytes of memory for caching hot downloads, 0 to disable")
+    parser.add_argument("--ping-interval", type=float, default=30,
+                        help="Idle seconds after which a client is checked with a PING")
+    parser.add_argument("--ping-timeout", type=float, default=10,
+                        help="Seconds a client has to answer a PING before it is disconnected")
+    parser.add_argument("--cache-max-file", type=int, default=None,
+                        help="Largest file in bytes the download cache keeps (default: 1/16 of --cache-size)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics over HTTP on this port (off by default)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address of the metrics listener")
+    parser.add_argument("--check-catalog", action="store_true",
+                        help="Check the catalog against the stored files at start, even after a clean stop")
+    parser.add_argument("--checkpoint-every", type=int, default=10000,
+                        help="Journaled changes after which the catalog is checkpointed and the journal emptied")
+    parser.add_argument("--bandwidth-limit", type=int, default=0,
+                        help="Bytes/s of file content for all clients together, 0 for no limit")
+    parser.add_argument("--user-bandwidth-limit", type=int, default=0,
+                        help="Bytes/s of file content per user, 0 for no limit")
+    parser.add_argument("--small-transfer", type=int, default=1024 * 1024,
+                        help="Transfers up to this many bytes go ahead of larger ones")
+    # Only settable in the config file: {"user_bandwidth_limits": {"alice": 1048576}, "user_weights": {"bob": 2}}
+    parser.set_defaults(user_bandwidth_limits={}, user_weights={})
+
+    # Values from the config file become the defaults, explicit flags still win
+    known, _ = parser.parse_known_args(argv)
+    if known.config:
+        parser.set_defaults(**load_config(known.config))
+    return parser.parse_args(argv)
+
+
+def create_server(args):
+    return FileServer(
+        upload_dir=os.path.abspath(args.storage_dir),
+        port=args.port,
+        engine=args.engine,
+        max_workers=args.max_workers,
+        listen_backlog=args.backlog,
+        max_connections=args.max_connections,
+        max_file_size=args.max_file_size,
+        receive_buffer_size=args.receive_buffer,
+        write_buffer_size=args.write_buffer,
+        storage=args.storage,
+        chunk_size=args.chunk_size,
+        session_ttl=args.session_ttl,
+        compression_codecs=[name for name in args.compression.split(",") if name and name != "none"],
+        compress_at_rest=args.compress_at_rest,
+        cache_size=args.cache_size,
+        cache_max_file=args.cache_max_file,
+        ping_interval=args.ping_interval,
+        ping_timeout=args.ping_timeout,
+        metrics_port=args.metrics_port,
+        metrics_host=args.metrics_host,
+        check_catalog=args.check_catalog,
+        checkpoint_every=args.checkpoint_every,
+        bandwidth_limit=args.bandwidth_limit,
+        user_bandwidth_limit=args.user_bandwidth_limit,
+        user_bandwidth_limits=args.user_bandwidth_limits,
+        user_weights=args.user_weights,
+        small_transfer=args.small_transfer,
+    )
+
+
+def run_headless(server, argv=None):
+    # Serve until SIGINT/SIGTERM, no display required. SIGHUP reads the options again and
+    # applies the bandwidth limits, e.g. after editing the --config file.
+    stop_event = threading.Event()
+    reload_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    if hasattr(signal, "SIGHUP"):  # Not available on Windows
+        signal.signal(signal.SIGHUP, lambda *_: reload_event.set())
+
+    server.start_server()
+    # Start the automatic cleanup process
+    server.start_auto_cleanup()
+    while not stop_event.wait(1):
+        if reload_event.is_set():
+            reload_event.clear()
+            try:
+                args = parse_args(argv)
+                server.set_bandwidth(args.bandwidth_limit, args.user_bandwidth_limit,
+                                     args.user_bandwidth_limits, args.user_weights)
+            except (OSError, ValueError, SystemExit) as e:
+                server.log_message(f"Could not reload the settings: {str(e)}", "ERROR")
+    server.cleanup_server()
+    server.log_message("Server stopped.")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = create_server(args)
+    if args.headless:
+        run_headless(server, argv)
+    else:
+        # The GUI is only imported when it is wanted, headless hosts need no Tkinter
+        from server_gui import ServerGUI
+        ServerGUI(server).run()
+
+
 if __name__ == "__main__":
     try:
-        # Create an instance of the FileServer class
-        server = FileServer()
-        # Start the automatic cleanup process
-        server.start_auto_cleanup()
-        # Run the server application
-        server.run()
+        main()
     except Exception as e:
         # Print any critical errors that occur during the server operation
-        print(f"Critical error: {str(e)}")
\ No newline at end of file
+        print(f"Critical error: {str(e)}")
+        sys.exit(1)
@@ -0,0 +1,261 @@
+import tkinter as tk
+from tkinter import ttk, filedialog
+import os
+import queue
+
+from server import ENGINES, STORAGE_MODES
+
+
+class ServerGUI:
+    """
+    Tkinter window for a FileServer. It is only an observer: worker threads put log and
+    state events on the server's event queue and the window drains it on the Tk thread.
+    """
+
+    def __init__(self, server, poll_interval=100, max_lines=5000, max_events=10000):
+        self.server = server
+        self.poll_interval = poll_interval  # Milliseconds between two queue drains
+        self.max_lines = max_lines  # Oldest log lines are removed beyond this count
+        self.server.event_queue = queue.Queue(maxsize=max_events)
+
+        # Create the root window for the GUI
+        self.root = tk.Tk()
+        self.root.title("Cloud File System Server")  # Set the title of the window
+        self.root.geometry("800x600")  # Set the initial size of the window
+        self.root.minsize(600, 500)  # Set the minimum size of the window
+
+        # Create GUI components
+        self.setup_gui()  # Setup the graphical user interface components
+
+        # Capture the window close event
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)  # Define actions to perform on window close
+
+        # Start draining the event queue on the Tk thread
+        self.root.after(self.poll_interval, self.poll_events)
+
+
+    def setup_gui(self):
+        # Main container for the GUI
+        self.main_container = ttk.Frame(self.root)
+        self.main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+        # Server control frame
+        control_frame = ttk.LabelFrame(self.main_container, text="Server Control")
+        control_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        # Frame for port and folder settings
+        settings_frame = ttk.Frame(control_frame)
+        settings_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        # Port settings
+        port_frame = ttk.Frame(settings_frame)
+        port_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        # Port label and entry field
+        ttk.Label(port_frame, text="Port:").pack(side=tk.LEFT, padx=(0, 5))
+        self.port_entry = ttk.Entry(port_frame, width=10)
+        self.port_entry.insert(0, str(self.server.port))  # Default port value
+        self.port_entry.pack(side=tk.LEFT)
+
+        # Folder selection
+        folder_frame = ttk.Frame(settings_frame)
+        folder_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        # Folder label and entry field
+        ttk.Label(folder_frame, text="File:").pack(side=tk.LEFT, padx=(0, 5))
+        self.folder_entry = ttk.Entry(folder_frame)
+        self.folder_entry.insert(0, self.server.upload_dir)  # Default folder path
+        self.folder_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+
+        # Browse button to select a folder
+        self.browse_button = ttk.Button(
+            folder_frame,
+            text="Browse",
+            command=self.browse_folder  # Calls browse_folder method when clicked
+        )
+        self.browse_button.pack(side=tk.LEFT)
+
+        # Engine selection: one thread per client or a single asyncio event loop
+        engine_frame = ttk.Frame(settings_frame)
+        engine_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        ttk.Label(engine_frame, text="Engine:").pack(side=tk.LEFT, padx=(0, 5))
+        self.engine_var = tk.StringVar(value=self.server.engine_name)
+        self.engine_combo = ttk.Combobox(
+            engine_frame,
+            textvariable=self.engine_var,
+            values=ENGINES,
+            state="readonly",
+            width=10
+        )
+        self.engine_combo.pack(side=tk.LEFT)
+
+        # Storage selection: plain files or deduplicated chunks
+        ttk.Label(engine_frame, text="Storage:").pack(side=tk.LEFT, padx=(10, 5))
+        self.storage_var = tk.StringVar(value=self.server.storage_mode)
+        self.storage_combo = ttk.Combobox(
+            engine_frame,
+            textvariable=self.storage_var,
+            values=STORAGE_MODES,
+            state="readonly",
+            width=10
+        )
+        self.storage_combo.pack(side=tk.LEFT)
+
+        # Bandwidth limits in MB/s, 0 for none; they can be changed while the server runs
+        bandwidth_frame = ttk.Frame(settings_frame)
+        bandwidth_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        ttk.Label(bandwidth_frame, text="Bandwidth MB/s, total:").pack(side=tk.LEFT, padx=(0, 5))
+        self.bandwidth_entry = ttk.Entry(bandwidth_frame, width=8)
+        self.bandwidth_entry.insert(0, self.format_rate(self.server.bandwidth.limit))
+        self.bandwidth_entry.pack(side=tk.LEFT)
+        ttk.Label(bandwidth_frame, text="per user:").pack(side=tk.LEFT, padx=(10, 5))
+        self.user_bandwidth_entry = ttk.Entry(bandwidth_frame, width=8)
+        self.user_bandwidth_entry.insert(0, self.format_rate(self.server.bandwidth.user_limit))
+        self.user_bandwidth_entry.pack(side=tk.LEFT)
+        ttk.Button(bandwidth_frame, text="Apply", command=self.apply_bandwidth).pack(side=tk.LEFT, padx=(10, 0))
+
+        # Start/Stop button to toggle the server state
+        self.toggle_button = ttk.Button(
+            settings_frame,
+            text="Start Server",
+            command=self.toggle_server  # Calls toggle_server method when clicked
+        )
+        self.toggle_button.pack(pady=10)
+
+        # Log frame to display server logs
+        log_frame = ttk.LabelFrame(self.main_container, text="Server Logs")
+        log_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        # Container for the log text area and scrollbar
+        log_container = ttk.Frame(log_frame)
+        log_container.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        # Scrollbar for the log text area
+        scrollbar = ttk.Scrollbar(log_container)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # Log text area for displaying log messages
+        self.log_text = tk.Text(
+            log_container,
+            yscrollcommand=scrollbar.set,  # Connect scrollbar to the text widget
+            wrap=tk.WORD,
+            height=20
+        )
+        self.log_text.pack(fill=tk.BOTH, expand=True)
+
+        # Configure scrollbar to control the log text view
+        scrollbar.config(command=self.log_text.yview)
+
+    def poll_events(self):
+        # Drain everything the server queued since the last poll, in one widget update
+        lines = []
+        try:
+            while True:
+                kind, value = self.server.event_queue.get_nowait()
+                if kind == "log":
+                    lines.append(value)
+                elif kind == "state":
+                    self.show_state(value)
+        except queue.Empty:
+            pass
+
+        if lines:
+            self.log_text.insert(tk.END, "".join(lines))
+            # Keep the widget bounded on long running servers
+            line_count = int(self.log_text.index('end-1c').split('.')[0])
+            if line_count > self.max_lines:
+                self.log_text.delete('1.0', f"{line_count - self.max_lines}.0")
+            self.log_text.see(tk.END)  # Scroll to the end to show the latest message
+
+        self.root.after(self.poll_interval, self.poll_events)
+
+    def show_state(self, running):
+        # Update the controls to reflect the running or stopped server
+        if running:
+            self.toggle_button.config(text="Stop Server")
+            self.port_entry.config(state='disabled')
+            self.folder_entry.config(state='disabled')
+            self.browse_button.config(state='disabled')
+            self.engine_combo.config(state='disabled')
+            self.storage_combo.config(state='disabled')
+        else:
+            self.toggle_button.config(text="Start Server")
+            self.port_entry.config(state='normal')
+            self.folder_entry.config(state='normal')
+            self.browse_button.config(state='normal')
+            self.engine_combo.config(state='readonly')
+            self.storage_combo.config(state='readonly')
+
+    def run(self):
+        # Start the main event loop for the GUI
+        self.root.mainloop()
+
+    def toggle_server(self):
+        # Start or stop the server based on its current status
+        if not self.server.is_running:
+            try:
+                # Take the settings from the form
+                self.server.upload_dir = self.folder_entry.get().strip()
+                self.server.port = int(self.port_entry.get())
+                self.server.engine_name = self.engine_var.get()
+                self.server.storage_mode = self.storage_var.get()
+                self.server.start_server()
+                # Start the automatic cleanup process
+                self.server.start_auto_cleanup()
+            except Exception as e:
+                # Log error message if the server fails to start
+                self.server.log_message(f"Server starting error: {str(e)}", "ERROR")
+        else:
+            # Stop the server if it is currently running
+            self.server.cleanup_server()
+            self.server.log_message("Server stopped.")
+
+    def format_rate(self, rate):
+        # Bytes/s as the MB/s shown in the form, 0 for no limit
+        return f"{(rate or 0) / (1024 * 1024):g}"
+
+    def apply_bandwidth(self):
+        try:
+            limit = float(self.bandwidth_entry.get() or 0)
+            user_limit = float(self.user_bandwidth_entry.get() or 0)
+            if limit < 0 or user_limit < 0:
+                raise ValueError("limits cannot be negative")
+        except ValueError as e:
+            self.server.log_message(f"Invalid bandwidth limit: {str(e)}", "ERROR")
+            return
+        self.server.set_bandwidth(int(limit * 1024 * 1024), int(user_limit * 1024 * 1024))
+
+    def browse_folder(self):
+            # Open a dialog to select a folder
+            folder = filedialog.askdirectory(
+                title="Choose file folder",
+                initialdir=self.server.upload_dir
+            )
+            if folder:
+                # Get the absolute path of the selected folder
+                upload_dir = os.path.abspath(folder)
+                # Update the folder entry field with the selected path
+                self.folder_entry.delete(0, tk.END)
+                self.folder_entry.insert(0, upload_dir)
+                # Check and create the folder if it doesn't exist
+                try:
+                    os.makedirs(upload_dir, exist_ok=True)
+                    self.server.upload_dir = upload_dir
+                    self.server.log_message(f"Running folder is changed: {upload_dir}")
+
+                    # If the server is running, stop it and restart with the new folder
+                    if self.server.is_running:
+                        self.server.cleanup_server()
+                        self.toggle_server()
+                except Exception as e:
+                    self.server.log_message(f"Folder creation error: {str(e)}", "ERROR")
+
+    def on_closing(self):
+        # Handle the closing event for the application window
+        if self.server.is_running:
+            # Stop the server if it is running
+            self.server.cleanup_server()
+        # Quit the main GUI loop
+        self.root.quit()
@@ -0,0 +1,728 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import unquote
+
+from compression import MIN_SAVING, get_codec, looks_compressed
+from file_index import HashingWriter, file_sha256
+
+
+TEMP_PREFIX = ".tmp-"  # Staged files; hidden, so scans and listings never see them
+LAYOUT_FILE = ".layout"  # Marks a folder that uses the sharded layout
+LAYOUT = {"layout": "sharded", "version": 2}
+
+# What a writer's commit() put in place. The size and mtime are taken from the staged file itself,
+# so they can never belong to a version another writer committed to the same name just after.
+StoredVersion = namedtuple("StoredVersion", ["hash", "size", "mtime"])
+
+
+def quote_owner(owner):
+    # The owner part of a file name ends at the first "_", so it is escaped inside usernames
+    return owner.replace("%", "%25").replace("_", "%5F").replace("/", "%2F").replace("\\", "%5C")
+
+
+def file_name(owner, filename):
+    # Name of a stored file as clients see it: "<owner>_<filename>", unambiguous for any username
+    if not filename:
+        raise ValueError("File name is empty")
+    return f"{quote_owner(owner)}_{filename}"
+
+
+def split_file_name(name):
+    # (owner, filename) of a stored file name; ValueError for a name no upload could have produced
+    quoted, separator, filename = name.partition("_")
+    owner = unquote(quoted)
+    if not separator or not quoted or not filename or quote_owner(owner) != quoted:
+        raise ValueError(f"Not a stored file name: {name}")
+    return owner, filename
+
+
+def path_component(text):
+    # A user-chosen name as one path component: no separators, never hidden, "." or ".."
+    text = text.replace("%", "%25").replace("/", "%2F").replace("\\", "%5C").replace("\0", "%00")
+    return "%2E" + text[1:] if text.startswith(".") else text
+
+
+def fan_out(text):
+    # Two hex digits, spreads owners (and the files of one owner) over 256 folders
+    return hashlib.blake2b(text.encode(), digest_size=1).hexdigest()
+
+
+def shard_path(base, name, suffix=""):
+    """
+    Where a stored file lives in the sharded layout: base/<aa>/<owner>/<bb>/<filename><suffix>,
+    with aa a hash of the owner and bb a hash of the file name. The path is computed from the
+    name, so a lookup never lists a folder, each owner has its own subtree and no folder grows
+    past a few thousand entries even with millions of files.
+    """
+    owner, filename = split_file_name(name)
+    return os.path.join(base, fan_out(owner), path_component(owner), fan_out(filename),
+                        path_component(filename) + suffix)
+
+
+def walk_shards(base, suffix=""):
+    # Yield (name, owner, DirEntry) of every file of a sharded tree. Staged files of writes that
+    # were interrupted by a stop or crash are removed on the way.
+    with os.scandir(base) as shards:
+        shard_dirs = [shard.path for shard in shards if len(shard.name) == 2 and shard.is_dir()]
+    for shard_dir in shard_dirs:
+        with os.scandir(shard_dir) as owners:
+            owner_dirs = [(unquote(item.name), item.path) for item in owners if item.is_dir()]
+        for owner, owner_dir in owner_dirs:
+            with os.scandir(owner_dir) as buckets:
+                bucket_dirs = [bucket.path for bucket in buckets if bucket.is_dir()]
+            for bucket_dir in bucket_dirs:
+                with os.scandir(bucket_dir) as items:
+                    for item in items:
+                        if item.name.startswith(TEMP_PREFIX):
+                            try:
+                                os.remove(item.path)
+                            except OSError:
+                                pass
+                            continue
+                        if not item.name.endswith(suffix) or not item.is_file():
+                            continue
+                        filename = unquote(item.name[:len(item.name) - len(suffix)])
+                        yield file_name(owner, filename), owner, item
+
+
+def list_staged(folder):
+    # Staged files in folder, left by writes that never committed
+    try:
+        with os.scandir(folder) as items:
+            return [item.path for item in items if item.name.startswith(TEMP_PREFIX)]
+    except FileNotFoundError:
+        return []
+
+
+def check_layout(root, legacy_files):
+    # Refuse a folder written by the old flat layout instead of showing it as empty, and mark a
+    # new folder as sharded
+    marker = os.path.join(root, LAYOUT_FILE)
+    try:
+        with open(marker) as f:
+            layout = json.load(f)
+    except FileNotFoundError:
+        layout = None
+    if layout is not None and layout != LAYOUT:
+        raise RuntimeError(f"Unknown storage layout in {root}: {layout}")
+    if layout is None:
+        if legacy_files:
+            raise RuntimeError(f"{root} holds {legacy_files} files in the old flat layout, "
+                               f"convert it first: python migrate_storage.py {root}")
+        with open(marker, 'w') as f:
+            json.dump(LAYOUT, f)
+
+
+def count_legacy_files(folder, suffix=""):
+    # Files directly in folder, where the flat layout kept them
+    count = 0
+    with os.scandir(folder) as it:
+        for item in it:
+            if not item.name.startswith('.') and item.name.endswith(suffix) and item.is_file():
+                count += 1
+    return count
+
+
+def check_hash(digest, expected_hash):
+    # Refuse content that does not match the hash the client announced
+    if expected_hash is not None and digest != expected_hash:
+        raise ValueError("Content does not match the announced hash")
+
+
+def fsync_directory(path):
+    # Make the removals and renames in a folder durable. Folders cannot be opened on Windows,
+    # there the file system keeps its own order and this does nothing.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileSnapshot:
+    """
+    An open, immutable version of a stored file. segments(offset, length) yields the
+    (fileobj, file_offset, count) pieces that form that byte range of the content,
+    ready for FrameSocket.send_file.
+    """
+
+    def __init__(self, size, mtime):
+        self.size = size
+        self.mtime = mtime
+
+    def segments(self, offset=0, length=None):
+        raise NotImplementedError
+
+    def stored_segments(self, offset=0, length=None, codec=None):
+        # Like segments, plus a flag per piece: True means the piece is a whole chunk stored
+        # compressed with codec, to be sent as is in a compressed DATA frame
+        for fileobj, file_offset, count in self.segments(offset, length):
+            yield fileobj, file_offset, count, False
+
+    def read(self, offset, length):
+        # The bytes of a range, for the few readers that need the content in Python
+        parts = []
+        for fileobj, file_offset, count in self.segments(offset, length):
+            fileobj.seek(file_offset)
+            parts.append(fileobj.read(count))
+        return b"".join(parts)
+
+    def clip(self, offset, length):
+        # Bound a requested range to the content, returns (offset, end)
+        offset = min(max(offset, 0), self.size)
+        end = self.size if length is None else min(self.size, offset + max(length, 0))
+        return offset, end
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FlatSnapshot(FileSnapshot):
+    def __init__(self, path):
+        # Opening first means the rest of the snapshot works on this inode
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        super().__init__(stat.st_size, stat.st_mtime)
+
+    def segments(self, offset=0, length=None):
+        offset, end = self.clip(offset, length)
+        if end > offset:
+            yield self.file, offset, end - offset
+
+    def close(self):
+        self.file.close()
+
+
+class FlatWriter:
+    """
+    Stages a new version in a hidden temp file next to the target, hashing on the way,
+    and swaps it in with an atomic rename on commit. Downloads that already opened the
+    old version keep reading it; a failed transfer leaves the old version untouched.
+    """
+
+    def __init__(self, path, buffer_size):
+        self.path = path
+        folder, name = os.path.split(path)
+        fd, self.tmp_path = tempfile.mkstemp(dir=folder, prefix=f"{TEMP_PREFIX}{name}-")
+        self.file = os.fdopen(fd, 'wb', buffering=buffer_size)
+        self.hashing = HashingWriter(self.file)
+
+    def write(self, data):
+        return self.hashing.write(data)
+
+    def commit(self, expected_hash=None):
+        # Durable before visible: the rename must never expose a file whose data is not on disk
+        digest = self.hashing.hexdigest()
+        check_hash(digest, expected_hash)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        stat = os.fstat(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        # The rename itself must survive a power loss before the change is journaled
+        fsync_directory(os.path.dirname(self.path))
+        return StoredVersion(digest, stat.st_size, stat.st_mtime)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class FlatStore:
+    """
+    One file per upload, stored verbatim at shard_path(upload_dir, name).
+    New versions are staged and renamed into place, so readers never see a partial file.
+    """
+
+    dedup = False  # Clients must send every byte
+
+    def __init__(self, root, write_buffer_size=1024 * 1024):
+        self.root = root
+        self.write_buffer_size = write_buffer_size
+
+    def load(self):
+        os.makedirs(self.root, exist_ok=True)
+        check_layout(self.root, count_legacy_files(self.root))
+
+    def path(self, name):
+        try:
+            return shard_path(self.root, name)
+        except ValueError:
+            raise FileNotFoundError(name)
+
+    def exists(self, name):
+        try:
+            return os.path.isfile(self.path(name))
+        except FileNotFoundError:
+            return False
+
+    def stat(self, name):
+        # (size, mtime) of a stored file
+        stat = os.stat(self.path(name))
+        return stat.st_size, stat.st_mtime
+
+    def scan(self):
+        # Yield (name, owner, size, mtime, hash) of every stored file; hashes are not known here.
+        # The owner is the folder the file is in, it is never guessed from the name.
+        for name, owner, item in walk_shards(self.root):
+            stat = item.stat()
+            yield name, owner, stat.st_size, stat.st_mtime, None
+
+    def file_hash(self, name):
+        return file_sha256(self.path(name))
+
+    def staged_files(self, name):
+        # Temp files of interrupted writes in the folder of name (after a crash, every one is)
+        return list_staged(os.path.dirname(self.path(name)))
+
+    def open_snapshot(self, name):
+        return FlatSnapshot(self.path(name))
+
+    def create_writer(self, name):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return FlatWriter(path, self.write_buffer_size)
+
+    def import_file(self, name, path, expected_hash=None):
+        # Move a complete file (e.g. an upload session) in place; returns its StoredVersion
+        digest = file_sha256(path)
+        check_hash(digest, expected_hash)
+        stat = os.stat(path)
+        target = self.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+        fsync_directory(os.path.dirname(target))
+        return StoredVersion(digest, stat.st_size, stat.st_mtime)
+
+    def delete(self, name):
+        os.remove(self.path(name))
+
+    def delete_many(self, names):
+        # Remove several files and make the removals durable with one fsync per folder touched.
+        # Returns {name: exception} for the files that could not be removed.
+        failures = {}
+        folders = set()
+        for name in names:
+            try:
+                path = self.path(name)
+                os.remove(path)
+            except OSError as e:
+                failures[name] = e
+                continue
+            folders.add(os.path.dirname(path))
+        for folder in folders:
+            fsync_directory(folder)
+        return failures
+
+
+class BlobSnapshot(FileSnapshot):
+    # A manifest whose chunks stay pinned (and therefore on disk) until close()
+    def __init__(self, store, manifest):
+        super().__init__(manifest["size"], manifest["mtime"])
+        self.store = store
+        self.chunks = manifest["chunks"]
+        self.closed = False
+
+    def segments(self, offset=0, length=None):
+        for fileobj, file_offset, count, _ in self.stored_segments(offset, length):
+            yield fileobj, file_offset, count
+
+    def stored_segments(self, offset=0, length=None, codec=None):
+        # Chunk files are opened one at a time, a large file does not hold thousands of descriptors.
+        # Chunks outside the range are skipped without being opened. A compressed chunk is
+        # passed on in its stored form when the receiver uses the same codec and wants all of it,
+        # otherwise it is decompressed here.
+        offset, end = self.clip(offset, length)
+        position = 0
+        for digest, chunk_length in self.chunks:
+            start, stop = max(offset, position), min(end, position + chunk_length)
+            if start < stop:
+                encoding = self.store.encodings.get(digest)
+                if encoding is None:
+                    with open(self.store.blob_path(digest), 'rb') as f:
+                        yield f, start - position, stop - start, False
+                elif codec is not None and codec.name == encoding and stop - start == chunk_length:
+                    with open(self.store.blob_path(digest), 'rb') as f:
+                        yield f, 0, os.fstat(f.fileno()).st_size, True
+                else:
+                    data = self.store.read_chunk(digest, chunk_length)
+                    yield io.BytesIO(data), start - position, stop - start, False
+            position += chunk_length
+            if position >= end:
+                break
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.store.unpin_all(digest for digest, _ in self.chunks)
+
+
+class BlobWriter:
+    """
+    Builds a new manifest. Bytes passed to write() are cut into fixed-size chunks;
+    a deduplicating upload instead announces its chunk hashes with plan_chunks() and
+    only sends the missing ones through fill_chunk(). Every chunk the writer refers to
+    is pinned, so a concurrent delete cannot collect it before the manifest is committed.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.buffer = bytearray()
+        self.chunks = []  # [digest, length] in file order
+        self.pinned = []  # Digests pinned by this writer, released on abort
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.streamed = True  # False once chunks were referenced without their bytes
+        self.planned = None
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        self.buffer += data
+        chunk_size = self.store.chunk_size
+        while len(self.buffer) >= chunk_size:
+            self.add_chunk(bytes(self.buffer[:chunk_size]))
+            del self.buffer[:chunk_size]
+        return len(data)
+
+    def add_chunk(self, data):
+        digest = self.store.put_chunk(data)
+        self.pinned.append(digest)
+        self.chunks.append([digest, len(data)])
+
+    def plan_chunks(self, digests, size):
+        # Pin the chunks the store already has; returns the indices the client must send
+        chunk_size = self.store.chunk_size
+        expected = (size + chunk_size - 1) // chunk_size
+        if len(digests) != expected:
+            raise ValueError(f"Expected {expected} chunk hashes, got {len(digests)}")
+        self.size = size
+        self.streamed = False
+        self.planned = [str(digest) for digest in digests]
+        self.chunks = [[digest, min(chunk_size, size - index * chunk_size)]
+                       for index, digest in enumerate(self.planned)]
+        self.filled = [False] * len(self.planned)
+        missing = []
+        for index, digest in enumerate(self.planned):
+            if self.store.pin_existing(digest):
+                self.pinned.append(digest)
+                self.filled[index] = True
+            else:
+                missing.append(index)
+        return missing
+
+    def chunk_length(self, index):
+        return self.chunks[index][1]
+
+    def fill_chunk(self, index, data):
+        # Store the bytes of a missing chunk and check they match the announced hash
+        if len(data) != self.chunk_length(index):
+            raise ValueError(f"Chunk {index} has the wrong length")
+        digest = self.store.put_chunk(data)
+        self.pinned.append(digest)
+        if digest != self.planned[index]:
+            raise ValueError(f"Chunk {index} does not match its hash")
+        self.filled[index] = True
+
+    def commit(self, expected_hash=None):
+        if self.planned is None and self.buffer:
+            self.add_chunk(bytes(self.buffer))
+            self.buffer.clear()
+        if self.planned is not None and not all(self.filled):
+            raise ValueError("Upload is missing chunks")
+        digest = self.hasher.hexdigest() if self.streamed else self.store.content_hash(self.chunks)
+        check_hash(digest, expected_hash)
+        # Chunk files are synced as they are written; their names must be durable too before a
+        # manifest refers to them. One fsync per chunk folder covers the reused chunks as well.
+        for folder in {os.path.dirname(self.store.blob_file(digest, None)) for digest, _ in self.chunks}:
+            fsync_directory(folder)
+        manifest = {"size": self.size, "mtime": time.time(), "hash": digest, "chunks": self.chunks}
+        # The manifest takes over the pins of this writer
+        self.store.commit_manifest(self.name, manifest)
+        self.pinned = []
+        return StoredVersion(digest, self.size, manifest["mtime"])
+
+    def abort(self):
+        self.store.unpin_all(self.pinned)
+        self.pinned = []
+
+
+class BlobStore:
+    """
+    Content-addressed, deduplicated storage.
+    File contents are cut into fixed-size chunks stored once under .blobs/<aa>/<sha256>;
+    each file name maps to a JSON manifest listing its chunks, at shard_path(.manifests, name). Chunks are
+    reference-counted across manifests, open snapshots and running uploads, and a chunk
+    file is removed as soon as its last reference is released.
+    With a codec, chunks that shrink are stored compressed as .blobs/<aa>/<sha256>.<codec>.
+    """
+
+    dedup = True  # Clients may skip chunks the store already has
+
+    def __init__(self, root, chunk_size=256 * 1024, codec=None):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.codec = codec  # Compression of new chunk files, None to store them raw
+        self.blob_dir = os.path.join(root, ".blobs")
+        self.manifest_dir = os.path.join(root, ".manifests")
+        self.lock = threading.Lock()
+        self.refs = {}  # chunk digest -> reference count
+        self.encodings = {}  # chunk digest -> codec name, for the chunks stored compressed
+        self.manifests = {}  # name -> manifest dict
+        self.owners = {}  # name -> owner, from the folder of the manifest
+
+    def load(self):
+        # Rebuild manifests and reference counts, then drop chunks nothing refers to
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        check_layout(self.root, count_legacy_files(self.manifest_dir, ".json"))
+        manifests = {}
+        refs = {}
+        self.owners = {}
+        # Manifest writes interrupted before their rename are removed by the walk
+        for name, owner, entry in walk_shards(self.manifest_dir, ".json"):
+            try:
+                with open(entry.path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            manifests[name] = manifest
+            self.owners[name] = owner
+            for digest, _ in manifest["chunks"]:
+                refs[digest] = refs.get(digest, 0) + 1
+
+        encodings = {}
+        for folder in os.scandir(self.blob_dir):
+            if not folder.is_dir():
+                continue
+            for blob in os.scandir(folder.path):
+                digest, _, encoding = blob.name.partition(".")
+                if digest in refs and digest not in encodings:
+                    encodings[digest] = encoding or None
+                    continue
+                try:
+                    os.remove(blob.path)  # Orphan left by an interrupted upload, or a second copy
+                except OSError:
+                    pass
+
+        with self.lock:
+            self.manifests = manifests
+            self.refs = refs
+            self.encodings = {digest: encoding for digest, encoding in encodings.items() if encoding}
+
+    # ---- chunks -----------------------------------------------------------
+
+    def blob_path(self, digest):
+        # Path of a chunk file in its current stored form
+        return self.blob_file(digest, self.encodings.get(digest))
+
+    def blob_file(self, digest, encoding):
+        name = f"{digest}.{encoding}" if encoding else digest
+        return os.path.join(self.blob_dir, digest[:2], name)
+
+    def write_blob(self, path, data):
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=TEMP_PREFIX)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def write_chunk(self, digest, data):
+        # Write a chunk file, compressed when the store has a codec and the chunk shrinks enough
+        encoding, payload = None, data
+        if self.codec is not None and not looks_compressed(data):
+            compressed = self.codec.compress(data)
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                encoding, payload = self.codec.name, compressed
+        self.write_blob(self.blob_file(digest, encoding), payload)
+        with self.lock:
+            if encoding:
+                self.encodings[digest] = encoding
+            else:
+                self.encodings.pop(digest, None)
+
+    def read_chunk(self, digest, length):
+        # Content of a chunk of the given length, decompressed if it is stored compressed
+        with open(self.blob_path(digest), 'rb') as f:
+            data = f.read()
+        encoding = self.encodings.get(digest)
+        if encoding:
+            data = get_codec(encoding).decompress(data, length)
+        return data
+
+    def put_chunk(self, data):
+        # Store a chunk if it is new and pin it; returns its digest
+        digest = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.blob_path(digest)):
+            self.write_chunk(digest, data)
+        with self.lock:
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            collected = not os.path.exists(self.blob_path(digest))
+        if collected:
+            # Removed by a concurrent release before our pin, write it again
+            self.write_chunk(digest, data)
+        return digest
+
+    def pin_existing(self, digest):
+        # Add a reference to a chunk that is already stored
+        with self.lock:
+            if self.refs.get(digest):
+                self.refs[digest] += 1
+                return True
+            return False
+
+    def unpin_all(self, digests):
+        # Release references; a chunk whose count drops to zero is deleted
+        with self.lock:
+            for digest in digests:
+                count = self.refs.get(digest, 0) - 1
+                if count > 0:
+                    self.refs[digest] = count
+                    continue
+                self.refs.pop(digest, None)
+                try:
+                    os.remove(self.blob_path(digest))
+                except OSError:
+                    pass
+                self.encodings.pop(digest, None)
+
+    def content_hash(self, chunks):
+        # SHA-256 of the whole content, read back from the chunk files
+        hasher = hashlib.sha256()
+        for digest, length in chunks:
+            hasher.update(self.read_chunk(digest, length))
+        return hasher.hexdigest()
+
+    # ---- manifests ----------------------------------------------------------
+
+    def manifest_path(self, name):
+        return shard_path(self.manifest_dir, name, ".json")
+
+    def commit_manifest(self, name, manifest):
+        path = self.manifest_path(name)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        # Durable before visible, like FlatWriter.commit; only the rename needs the lock
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=TEMP_PREFIX)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            old = self.manifests.get(name)
+            os.replace(tmp_path, path)
+            self.manifests[name] = manifest
+            self.owners[name] = split_file_name(name)[0]
+        fsync_directory(folder)
+        if old is not None:
+            self.unpin_all(digest for digest, _ in old["chunks"])
+
+    # ---- store interface ----------------------------------------------------
+
+    def exists(self, name):
+        return name in self.manifests
+
+    def stat(self, name):
+        manifest = self.manifests[name]
+        return manifest["size"], manifest["mtime"]
+
+    def scan(self):
+        for name, manifest in list(self.manifests.items()):
+            yield name, self.owners[name], manifest["size"], manifest["mtime"], manifest["hash"]
+
+    def file_hash(self, name):
+        return self.manifests[name]["hash"]
+
+    def staged_files(self, name):
+        # Manifests of interrupted writes. load() has already removed them with their chunks,
+        # so this only finds something when called before it.
+        return list_staged(os.path.dirname(self.manifest_path(name)))
+
+    def open_snapshot(self, name):
+        with self.lock:
+            manifest = self.manifests.get(name)
+            if manifest is None:
+                raise FileNotFoundError(name)
+            for digest, _ in manifest["chunks"]:
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+        return BlobSnapshot(self, manifest)
+
+    def create_writer(self, name):
+        return BlobWriter(self, name)
+
+    def import_file(self, name, path, expected_hash=None):
+        # Chunk a complete file into the store and remove it; returns its StoredVersion
+        writer = self.create_writer(name)
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk_size), b""):
+                    writer.write(block)
+            check_hash(writer.hasher.hexdigest(), expected_hash)
+            version = writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        os.remove(path)
+        return version
+
+    def delete(self, name):
+        # The manifest file goes first: a file that cannot be removed stays in the store
+        with self.lock:
+            manifest = self.manifests.get(name)
+            if manifest is None:
+                raise FileNotFoundError(name)
+            os.remove(self.manifest_path(name))
+            del self.manifests[name]
+            self.owners.pop(name, None)
+        self.unpin_all(digest for digest, _ in manifest["chunks"])
+
+    def delete_many(self, names):
+        # Remove several manifests with one fsync per folder touched, then release all their
+        # chunks in one pass. Returns {name: exception} for the files that failed.
+        failures = {}
+        released = []
+        folders = set()
+        with self.lock:
+            for name in names:
+                manifest = self.manifests.get(name)
+                if manifest is None:
+                    failures[name] = FileNotFoundError(name)
+                    continue
+                path = self.manifest_path(name)
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    failures[name] = e
+                    continue
+                del self.manifests[name]
+                self.owners.pop(name, None)
+                folders.add(os.path.dirname(path))
+                released.extend(digest for digest, _ in manifest["chunks"])
+        for folder in folders:
+            fsync_directory(folder)
+        self.unpin_all(released)
+        return failures
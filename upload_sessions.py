@@ -0,0 +1,227 @@
+import json
+import os
+import re
+import secrets
+import shutil
+import struct
+import threading
+import time
+
+SESSION_ID = re.compile(r"[0-9a-f]{32}")
+RECEIVED_RECORD = struct.Struct("!I")  # One chunk index per record in the "received" log
+
+
+class UploadSession:
+    # One upload in progress; chunks of chunk_size bytes, the last one may be shorter
+    def __init__(self, session_id, path, owner, target, filesize, chunk_size, created):
+        self.id = session_id
+        self.path = path  # Folder holding session.json, data and received
+        self.owner = owner  # Username that opened the session
+        self.target = target  # Stored name the file gets on commit
+        self.filesize = filesize
+        self.chunk_size = chunk_size
+        self.created = created
+        self.updated = created  # Last activity, used for the TTL
+        self.received = set()  # Indices of the chunks that are safely on disk
+        self.committing = False
+        self.lock = threading.Lock()
+
+    @property
+    def chunk_count(self):
+        return max(1, (self.filesize + self.chunk_size - 1) // self.chunk_size)
+
+    def chunk_length(self, index):
+        if not 0 <= index < self.chunk_count:
+            raise ValueError(f"Chunk index out of range: {index}")
+        return min(self.chunk_size, self.filesize - index * self.chunk_size)
+
+    def missing(self):
+        return [index for index in range(self.chunk_count) if index not in self.received]
+
+    @property
+    def data_path(self):
+        return os.path.join(self.path, "data")
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, "received")
+
+    def to_dict(self):
+        return {
+            "session": self.id,
+            "filename": self.target,
+            "filesize": self.filesize,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunk_count,
+            "received": sorted(self.received),
+        }
+
+
+class ChunkWriter:
+    # File-like target for receive_stream that writes one chunk (or range) at its offset in a
+    # file shared by several writers. Without os.pwrite (Windows) the seek and the write are
+    # done under one lock, so writers on other threads cannot move the file position between them.
+    seek_lock = threading.Lock()
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        # Writes all of data; receive_stream does not look at the count, so a short write
+        # must not leave a hole
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self.fd, view, self.offset)
+            else:
+                with self.seek_lock:
+                    os.lseek(self.fd, self.offset, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+            self.offset += written
+            view = view[written:]
+        return len(data)
+
+
+class UploadSessionManager:
+    """
+    Resumable upload sessions stored under <upload_dir>/.sessions/<id>/.
+    session.json describes the upload, "data" is a file of the final size that chunks are
+    written into at their offsets, and "received" is an append-only log of the chunk indices
+    that were written and synced. Everything needed to continue an upload is on disk, so a
+    session survives reconnects and server restarts; sessions idle for longer than ttl are removed.
+    """
+
+    def __init__(self, root, ttl=24 * 3600, default_chunk_size=4 * 1024 * 1024,
+                 min_chunk_size=64 * 1024, max_chunk_size=64 * 1024 * 1024):
+        self.root = root
+        self.ttl = ttl  # Seconds an uncommitted session may stay idle
+        self.default_chunk_size = default_chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.lock = threading.Lock()
+        self.sessions = {}  # id -> UploadSession
+
+    def load(self):
+        # Pick up the sessions that were open when the server stopped
+        os.makedirs(self.root, exist_ok=True)
+        sessions = {}
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not SESSION_ID.fullmatch(entry.name):
+                continue
+            try:
+                session = self.read_session(entry.path)
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(entry.path, ignore_errors=True)  # Half created session
+                continue
+            sessions[session.id] = session
+        with self.lock:
+            self.sessions = sessions
+        return len(sessions)
+
+    def read_session(self, path):
+        with open(os.path.join(path, "session.json")) as f:
+            info = json.load(f)
+        session = UploadSession(
+            info["session"], path, info["owner"], info["target"],
+            int(info["filesize"]), int(info["chunk_size"]), info["created"]
+        )
+        updated = os.path.getmtime(os.path.join(path, "session.json"))
+        if os.path.exists(session.log_path):
+            updated = max(updated, os.path.getmtime(session.log_path))
+            with open(session.log_path, 'rb') as f:
+                log = f.read()
+            # A torn last record is ignored, that chunk is simply sent again
+            usable = len(log) - len(log) % RECEIVED_RECORD.size
+            for (index,) in RECEIVED_RECORD.iter_unpack(log[:usable]):
+                if index < session.chunk_count:
+                    session.received.add(index)
+        session.updated = updated
+        return session
+
+    def create(self, owner, target, filesize, chunk_size=None):
+        chunk_size = int(chunk_size or self.default_chunk_size)
+        chunk_size = max(self.min_chunk_size, min(chunk_size, self.max_chunk_size))
+        session_id = secrets.token_hex(16)
+        path = os.path.join(self.root, session_id)
+        os.makedirs(path)
+        session = UploadSession(session_id, path, owner, target, filesize, chunk_size, time.time())
+
+        # The data file gets its final size up front, chunks are written at their offsets
+        with open(session.data_path, 'wb') as f:
+            f.truncate(filesize)
+        info = {
+            "session": session_id,
+            "owner": owner,
+            "target": target,
+            "filesize": filesize,
+            "chunk_size": chunk_size,
+            "created": session.created,
+        }
+        # session.json is written last: a folder without it is incomplete and dropped at load
+        tmp_path = os.path.join(path, "session.json.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, os.path.join(path, "session.json"))
+
+        with self.lock:
+            self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id, owner):
+        # Look up a session of owner; raises ValueError for unknown or foreign sessions
+        with self.lock:
+            session = self.sessions.get(str(session_id))
+        if session is None or session.owner != owner:
+            raise ValueError("Upload session not found")
+        session.updated = time.time()
+        return session
+
+    def open_chunk(self, session, index):
+        # Returns (fd, ChunkWriter, length) for receiving one chunk
+        length = session.chunk_length(index)
+        fd = os.open(session.data_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))  # No newline translation on Windows
+        return fd, ChunkWriter(fd, index * session.chunk_size), length
+
+    def mark_received(self, session, fd, index):
+        # Make the chunk durable before it is recorded, then append it to the log
+        os.fsync(fd)
+        with session.lock:
+            if session.committing:
+                raise ValueError("Upload session is being committed")
+            if index in session.received:
+                return
+            with open(session.log_path, 'ab') as f:
+                f.write(RECEIVED_RECORD.pack(index))
+            session.received.add(index)
+            session.updated = time.time()
+
+    def begin_commit(self, session):
+        # Freeze the session; returns the path of the complete data file
+        with session.lock:
+            if session.committing:
+                raise ValueError("Upload session is already being committed")
+            missing = session.missing()
+            if missing:
+                raise ValueError(f"{len(missing)} chunks are missing")
+            session.committing = True
+        return session.data_path
+
+    def abort_commit(self, session):
+        with session.lock:
+            session.committing = False
+
+    def remove(self, session):
+        with self.lock:
+            self.sessions.pop(session.id, None)
+        shutil.rmtree(session.path, ignore_errors=True)
+
+    def expire(self, now=None):
+        # Remove the uncommitted sessions that saw no activity for ttl seconds
+        now = now or time.time()
+        with self.lock:
+            expired = [s for s in self.sessions.values()
+                       if not s.committing and now - s.updated > self.ttl]
+        for session in expired:
+            self.remove(session)
+        return expired